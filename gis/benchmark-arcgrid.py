@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+# Benchmark the ArcGrid -> tiled GeoTIFF conversion (rasterconvert.arcgrid2geotiff, --convert-arcgrid)
+# - generates synthetic ArcGrids of the given sizes (a smooth field with noise, like a concentration
+#   map, and nodata blocks)
+# - converts every grid on its own (in a child process: time and peak memory of one conversion)
+# - converts --files copies of a grid in a process pool for every --jobs value
+# - reports text MB/s, million cells/s, peak memory (resident) and the GeoTIFF size
+#
+# The grids are created in a temporary directory; NumPy is needed.
+
+import sys
+import os
+import time
+import json
+import shutil
+import tempfile
+import resource
+import subprocess
+import multiprocessing
+
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, scriptdir)
+import rasterconvert
+
+# help tekst
+if len(sys.argv) > 1 and sys.argv[1] in ('-h', '--help'):
+  print """Usage: benchmark-arcgrid.py <options>
+Times ArcGrid -> tiled GeoTIFF conversions (generate-geoserverpublishdata.py --convert-arcgrid).
+
+Options (any order):
+--sizes=[n,n,...]             grid sizes, n x n cells (default: 1000,4000,8000; max 40000)
+--files=[n]                   number of grids converted at once in the pool runs (default: 4)
+--jobs=[n,n,...]              pool sizes (default: 1,4)
+--keep                        keep the generated grids (the directory is printed)
+"""
+  exit(0)
+
+#########################################################
+# Initialization (vars, commandline)
+sizes=[1000, 4000, 8000]
+nfiles=4
+jobslist=[1, 4]
+keep=False
+convertfile=None
+
+for arg in sys.argv:
+  # get commandline options (and optionally values)
+  an = arg.split('=')[0]
+  if len(arg.split('=')) > 1:
+    av = arg.split('=')[1]
+
+  # process commandline options
+  if an == '--sizes':
+    sizes=[min(int(n), 40000) for n in av.split(',')]
+  if an == '--files':
+    nfiles=max(1, int(av))
+  if an == '--jobs':
+    jobslist=[int(n) for n in av.split(',')]
+  if an == '--keep':
+    keep=True
+  # (internal) one conversion in a child process
+  if an == '--convert':
+    convertfile=av
+
+# ##########################
+# Functions
+# Peak resident memory of this process in MB (ru_maxrss: kilobytes on Linux, bytes on macOS)
+def peakmemory():
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return maxrss / (1048576.0 if sys.platform == 'darwin' else 1024.0)
+
+# Generate a synthetic ArcGrid of n x n cells (written 256 rows at a time)
+def gengrid(path, n):
+  numpy = rasterconvert.numpy
+  f = open(path, 'w')
+  f.write(str.format("ncols {0}\nnrows {0}\nxllcorner 0\nyllcorner 300000\ncellsize 25\nNODATA_value -9999\n", n))
+  numpy.random.seed(n)
+  for start in range(0, n, 256):
+    y, x = numpy.mgrid[start:min(start + 256, n), 0:n]
+    rows = (50 + 40 * numpy.sin(x / 300.0) * numpy.cos(y / 200.0) + numpy.random.rand(*x.shape)).round(2)
+    # nodata blocks (e.g. outside the country)
+    rows[:, :n // 10] = -9999
+    if start % 1024 == 0:
+      rows[:16, n // 2:] = -9999
+    numpy.savetxt(f, rows, fmt='%g')
+  f.close()
+  open(os.path.splitext(path)[0] + '.prj', 'w').write('PROJCS["Amersfoort / RD New",AUTHORITY["EPSG","28992"]]')
+
+def removeconverted(path):
+  if os.path.exists(rasterconvert.convertedfile(path)):
+    os.remove(rasterconvert.convertedfile(path))
+
+# Convert one grid in a child process, returns (seconds, peak MB, message)
+def convertrun(path):
+  removeconverted(path)
+  p = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--convert=' + path], stdout=subprocess.PIPE)
+  result = json.loads(p.communicate()[0])
+  return result['seconds'], result['peak'], result['message']
+
+# Convert files in a process pool, returns seconds
+def poolrun(files, jobs):
+  for f in files:
+    removeconverted(f)
+  start = time.time()
+  pool = multiprocessing.Pool(jobs)
+  try:
+    results = pool.map_async(rasterconvert.arcgrid2geotiff, files, 1).get(sys.maxint)
+  finally:
+    pool.terminate()
+    pool.join()
+  for path, output, message in results:
+    if output is None:
+      print "WARNING:", path + ":", message
+  return time.time() - start
+
+def report(name, n, files, jobs, textsize, seconds, peak, tifsize):
+  print str.format("{0:<8} {1:>11} {2:>5} {3:>5} {4:>9.1f} {5:>8.2f} {6:>8.1f} {7:>9.2f} {8:>8} {9:>8.1f}"
+    , name, str(n) + 'x' + str(n), files, jobs, textsize * files / 1048576.0, seconds
+    , textsize * files / 1048576.0 / seconds, n * n * files / 1e6 / seconds
+    , peak if isinstance(peak, str) else str.format("{0:.1f}", peak), tifsize / 1048576.0)
+  sys.stdout.flush()
+
+# #####################################################################
+# Ze script (MAIN)
+if rasterconvert.numpy is None:
+  print "ERROR: NumPy is not installed"
+  exit(1)
+
+if convertfile is not None:
+  start = time.time()
+  path, output, message = rasterconvert.arcgrid2geotiff(convertfile)
+  print json.dumps({'seconds': time.time() - start, 'peak': peakmemory(), 'message': message})
+  exit(0)
+
+basedir = tempfile.mkdtemp(prefix='benchmark-arcgrid-')
+print "Grids:              ", basedir
+print "Tiles:              ", str(rasterconvert.BLOCKSIZE) + 'x' + str(rasterconvert.BLOCKSIZE), rasterconvert.COMPRESSION, "level", rasterconvert.ZLEVEL
+print "Parse block (MB):   ", rasterconvert.PARSEBYTES / 1048576
+print
+print str.format("{0:<8} {1:>11} {2:>5} {3:>5} {4:>9} {5:>8} {6:>8} {7:>9} {8:>8} {9:>8}"
+  , 'run', 'grid', 'files', 'jobs', 'text MB', 'seconds', 'MB/s', 'Mcells/s', 'peak MB', 'tif MB')
+
+try:
+  for n in sizes:
+    path = os.path.join(basedir, str.format("grid_{0}_0.asc", n))
+    gengrid(path, n)
+    textsize = os.path.getsize(path)
+    seconds, peak, message = convertrun(path)
+    if not message.startswith('converted'):
+      print "WARNING:", path + ":", message
+    report('convert', n, 1, 1, textsize, seconds, peak, os.path.getsize(rasterconvert.convertedfile(path)))
+    files = [path]
+    for i in range(1, nfiles):
+      files.append(os.path.join(basedir, str.format("grid_{0}_{1}.asc", n, i)))
+      shutil.copy(path, files[-1])
+      shutil.copy(os.path.splitext(path)[0] + '.prj', os.path.splitext(files[-1])[0] + '.prj')
+    for jobs in jobslist:
+      seconds = poolrun(files, jobs)
+      report('pool', n, nfiles, jobs, textsize, seconds, '-', os.path.getsize(rasterconvert.convertedfile(path)))
+    for f in files[1:]:
+      os.remove(f)
+      removeconverted(f)
+finally:
+  if keep:
+    print "\nGrids kept in:", basedir
+  else:
+    shutil.rmtree(basedir)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+# Benchmark publish2geoserver.py against the mock Geoserver (mock-geoserver.py)
+# - generates synthetic publish trees (config.session + N .gpd files)
+# - starts the mock Geoserver, runs full publish runs (stores, coverages, layers)
+# - reports wall clock time and requests per second for every tree size / --jobs value
+#
+# Nothing is sent to a real Geoserver; the trees are created in a temporary directory.
+
+import sys
+import os
+import time
+import json
+import shutil
+import socket
+import tempfile
+import subprocess
+import urllib2
+
+# help tekst
+if len(sys.argv) > 1 and sys.argv[1] in ('-h', '--help'):
+  print """Usage: benchmark-publish.py <options>
+Times full publish2geoserver.py runs against the mock Geoserver.
+
+Options (any order):
+--sizes=[n,n,...]             number of .gpd files per tree (default: 100,1000,10000; max 50000)
+--jobs=[n,n,...]              values for publish2geoserver.py --jobs (default: 1,8)
+--latency=[ms]                mock Geoserver response time in milliseconds (default: 5)
+--jitter=[ms]                 mock Geoserver random extra response time (default: 0)
+--error-rate=[fraction]       mock Geoserver error rate (default: 0)
+--publish-options=[opt,...]   extra publish2geoserver.py options, e.g. --sync,--update
+--rerun                       also time a second run on the same catalog (re-publish)
+--port=[port]                 mock Geoserver port (default: 8091)
+--keep                        keep the generated trees (the directory is printed)
+"""
+  exit(0)
+
+#########################################################
+# Initialization (vars, commandline)
+sizes=[100, 1000, 10000]
+jobslist=[1, 8]
+latency="5"
+jitter="0"
+errorrate="0"
+publishoptions=[]
+rerun=False
+port=8091
+keep=False
+
+for arg in sys.argv:
+  # get commandline options (and optionally values)
+  an = arg.split('=')[0]
+  if len(arg.split('=')) > 1:
+    av = arg.split('=')[1]
+
+  # process commandline options
+  if an == '--sizes':
+    sizes=[min(int(n), 50000) for n in av.split(',')]
+  if an == '--jobs':
+    jobslist=[int(n) for n in av.split(',')]
+  if an == '--latency':
+    latency=av
+  if an == '--jitter':
+    jitter=av
+  if an == '--error-rate':
+    errorrate=av
+  if an == '--publish-options':
+    publishoptions=av.split(',')
+  if an == '--rerun':
+    rerun=True
+  if an == '--port':
+    port=int(av)
+  if an == '--keep':
+    keep=True
+
+scriptdir = os.path.dirname(os.path.abspath(__file__))
+
+# ##########################
+# Functions
+# Generate a synthetic publish tree: <basedir>/<name>/config.session + n .gpd files
+def gentree(basedir, name, n):
+  processdir = os.path.join(basedir, name)
+  os.makedirs(processdir)
+  config_file = open(os.path.join(processdir, 'config.session'), 'w')
+  config_file.write("geoserver.host=localhost:" + str(port) + "\n")
+  config_file.write("geoserver.instance=/geoserver\n")
+  config_file.write("geoserver.user=admin\n")
+  config_file.write("geoserver.coveragerootdir=coverage-raster/\n")
+  config_file.close()
+  for i in range(n):
+    f2 = str.format("bench_{0:05d}", i)
+    gpd = open(os.path.join(processdir, f2 + '.gpd'), 'w')
+    gpd.write("coveragestore.workspace=bench\n")
+    gpd.write("coveragestore.datatype=GeoTIFF\n")
+    gpd.write("coveragestore.filename=" + name + "/" + f2 + ".tif\n")
+    gpd.write("coveragestore.name=bench_" + f2 + "\n")
+    gpd.write("coveragestore.description=Benchmark raster file\n")
+    gpd.write("coverage.coveragestore.name=bench_" + f2 + "\n")
+    gpd.write("coverage.name=" + f2 + "\n")
+    gpd.write("coverage.title=Benchmark coverage " + str(i) + "\n")
+    gpd.write("coverage.description=Benchmark coverage\n")
+    gpd.write("coverage.abstract=Synthetic coverage for benchmarking\n")
+    gpd.write("coverage.keywords=benchmark,raster\n")
+    gpd.write("layer.coverage.name=" + f2 + "\n")
+    gpd.write("layer.style=raster\n")
+    gpd.close()
+  return processdir
+
+def mockrequest(path, data=None):
+  return urllib2.urlopen("http://localhost:" + str(port) + path, data).read()
+
+def startmock():
+  mock = subprocess.Popen([sys.executable, os.path.join(scriptdir, 'mock-geoserver.py')
+    , '--port=' + str(port), '--latency=' + latency, '--jitter=' + jitter
+    , '--error-rate=' + errorrate, '--quiet'], stdout=open(os.devnull, 'w'))
+  for i in range(100):
+    try:
+      socket.create_connection(('localhost', port), 1).close()
+      return mock
+    except socket.error:
+      time.sleep(0.1)
+  mock.kill()
+  print "ERROR: mock Geoserver did not start"
+  exit(1)
+
+# One full publish run, returns (seconds, mock stats)
+def publishrun(basedir, name, jobs, options):
+  command = [sys.executable, os.path.join(scriptdir, 'publish2geoserver.py')
+    , '--process-dir=' + name, '--pub-stores', '--pub-coverages', '--set-layeroptions'
+    , '--jobs=' + str(jobs), '--no-proxy'] + options
+  start = time.time()
+  p = subprocess.Popen(command, cwd=basedir, stdin=subprocess.PIPE, stdout=open(os.devnull, 'w'))
+  p.communicate('benchmark\n')
+  seconds = time.time() - start
+  if p.returncode != 0:
+    print "WARNING: publish2geoserver.py exited with", p.returncode
+  return seconds, json.loads(mockrequest('/mock/stats'))
+
+def report(name, n, jobs, seconds, stats):
+  requests = stats.get('requests', 0)
+  print str.format("{0:<10} {1:>7} {2:>5} {3:>9} {4:>7} {5:>10.2f} {6:>10.1f} {7:>10.1f}"
+    , name, n, jobs, requests, stats.get('errors', 0), seconds, requests / seconds, n / seconds)
+  sys.stdout.flush()
+
+# #####################################################################
+# Ze script (MAIN)
+basedir = tempfile.mkdtemp(prefix='benchmark-publish-')
+print "Publish trees:      ", basedir
+print "Mock latency (ms):  ", latency, "+ 0 ..", jitter
+print "Mock error rate:    ", errorrate
+print "Publish options:    ", ' '.join(publishoptions)
+print
+print str.format("{0:<10} {1:>7} {2:>5} {3:>9} {4:>7} {5:>10} {6:>10} {7:>10}"
+  , 'run', 'files', 'jobs', 'requests', 'errors', 'seconds', 'req/s', 'files/s')
+
+mock = startmock()
+try:
+  for n in sizes:
+    name = 'tree' + str(n)
+    processdir = gentree(basedir, name, n)
+    for jobs in jobslist:
+      mockrequest('/mock/reset', '')
+      if os.path.exists(os.path.join(processdir, 'publish.manifest')):
+        os.remove(os.path.join(processdir, 'publish.manifest'))
+      seconds, stats = publishrun(basedir, name, jobs, publishoptions)
+      report('publish', n, jobs, seconds, stats)
+      if rerun:
+        mockrequest('/mock/reset-stats', '')
+        seconds, stats = publishrun(basedir, name, jobs, publishoptions)
+        report('republish', n, jobs, seconds, stats)
+finally:
+  mock.terminate()
+  if keep:
+    print "\nTrees kept in:", basedir
+  else:
+    shutil.rmtree(basedir)
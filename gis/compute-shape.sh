@@ -4,6 +4,7 @@
 PRGNAM="compute-shape.sh"
 USAGE="Use: ${PRGNAM} \"directory\""
 DIR=${1}
+SCRIPT_DIR=`cd $(dirname $0) && pwd`
 DANK_SHAPE=/home/martine/data/projects/dank/data/shape
 WORKING_DIR=${DANK_SHAPE}/${DIR}
 
@@ -34,6 +35,8 @@ cd ${WORKING_DIR}
 CSV_FILE="`ls *.csv`"
 SHP="`ls *.shp`"
 SHAPE_FILE=$SHP
+# geometry type from the shapefile header (Point, LineString, Polygon, MultiPoint, ...)
+GEOM_TYPE="`python ${SCRIPT_DIR}/shapeheader.py --geometry \"$SHAPE_FILE\" 2>/dev/null`"
 SLD_FILE="`ls *.sld`"
 
 #echo ${CSV_FILE} 
@@ -46,7 +49,8 @@ while [[ $SHP =~ $re ]]; do
 done
 
 LAYER_NAME=$SHP
-TABLE_NAME=$LAYER_NAME
+# table (and view) name: laundered as shape2postgis.py does (lowercase, other characters than a-z, 0-9 and _ become _)
+TABLE_NAME="`echo "$LAYER_NAME" | tr 'A-Z' 'a-z' | sed 's/[^a-z0-9_]/_/g'`"
 VIEW_NAME=$TABLE_NAME
 STYLE_NAME=$LAYER_NAME
 
@@ -57,51 +61,32 @@ STYLE_NAME=$LAYER_NAME
 #### DB functions
 create_db_table()
 {
-if (ogrinfo "$SHAPE_FILE" |grep -i point)
-then
-  ogr2ogr -overwrite -a_srs "EPSG:28992" -f "PostgreSQL" PG:"host=$DB_HOST dbname=$DB_NAME user=$USER password=$PASSWORD" $SHAPE_FILE -lco "GEOMETRY_NAME=geom" -nlt Point -nln dank.$TABLE_NAME
-elif (ogrinfo "$SHAPE_FILE" |grep -i polygon)
-then
-  ogr2ogr -overwrite -a_srs "EPSG:28992" -f "PostgreSQL" PG:"host=$DB_HOST dbname=$DB_NAME user=$USER password=$PASSWORD" $SHAPE_FILE -lco "GEOMETRY_NAME=geom" -nlt MultiPolygon -nln dank.$TABLE_NAME
-fi
- }
- 
-create_db_view()
-{
-  psql -h $DB_HOST -U $USER $DB_NAME -c "create view dank_pub.vw_$VIEW_NAME as select * from dank.$TABLE_NAME;"
-}
-
-grant_ro()
-{
-  psql -h $DB_HOST -U $USER $DB_NAME -c "grant select on table dank_pub.vw_$LAYER_NAME to dank_pub_ro;"
-}
-
-populate_geo()
-{
-  psql -h $DB_HOST -U $USER $DB_NAME -c "select populate_geometry_columns();"
+  # table (COPY), spatial index, view dank_pub.vw_<name> and grant in one transaction (shape2postgis.py)
+  PGPASSWORD=$PASSWORD python ${SCRIPT_DIR}/shape2postgis.py --process-dir=. --file-filter="${SHAPE_FILE%.*}" --table="$TABLE_NAME" --db-host=$DB_HOST --db-name=$DB_NAME --db-user=$USER --schema=dank --view-schema=dank_pub --grant=dank_pub_ro --srs=EPSG:28992
 }
 
 ### Geoserver functions
-reload_geo_conf()
+reset_datastore()
 {
-  curl -v -u $GEOADM:$PASSWDADM -XPOST  http://$GEO_HOST:8080/geoserver/rest/reload
+  # the table was replaced: reset only the PostGIS store (cached feature types), no full catalog reload
+  curl -v -u $GEOADM:$PASSWDADM -XPOST  http://$GEO_HOST:8080/geoserver/rest/workspaces/dank/datastores/pg_dank/reset
 }
 
-create_style()
-{
-  curl -v -u $GEOADM:$PASSWDADM -XPOST -H "Content-type: text/xml" -d "<style><name>$STYLE_NAME</name><filename>$SLD_FILE</filename></style>" http://$GEO_HOST:8080/geoserver/rest/workspaces/dank/styles
-} 
-
-update_style()
+sync_styles()
 {
-  curl -v -u $GEOADM:$PASSWDADM -XPUT -H "Content-type: application/vnd.ogc.se+xml" -d @${SLD_FILE} http://$GEO_HOST:8080/geoserver/rest/workspaces/dank/styles/$STYLE_NAME
+  # Upload the SLD files of the whole shape tree (publish2geoserver.py --styles): identical SLD files
+  # share one style, only new and changed styles are uploaded (in parallel); STYLE_NAME is set to the
+  # style of this directory's SLD file
+  if [ ! -f ${DANK_SHAPE}/config.session ]; then
+    printf "geoserver.host=$GEO_HOST:8080\ngeoserver.instance=/geoserver\ngeoserver.user=$GEOADM\ngeoserver.coveragerootdir=\n" > ${DANK_SHAPE}/config.session
+  fi
+  (cd ${DANK_SHAPE} && echo "$PASSWDADM" | python ${SCRIPT_DIR}/publish2geoserver.py --process-dir=. --recursive --styles --style-workspace=dank --jobs=8)
+  STYLE_NAME=`grep "^${DIR%/}/${SLD_FILE}=" ${DANK_SHAPE}/styles.map | cut -d "=" -f 2`
 }
 
 create_layer()
 {
-  TITLE=`grep titel $CSV_FILE | cut -d ";" -f 2`
-  ABSTRACT=`grep samenvatting $CSV_FILE | cut -d ";" -f 2`
-  METALINK=`grep metadatalink $CSV_FILE | cut -d ";" -f 2`
+  read_metadata
   #curl -v -u $GEOADM:$PASSWDADM -XPUT -H "Content-type: text/xml" -d "<featureType><title>$TITLE</title><abstract>$ABSTRACT</abstract><metadataLinks><metadataLink><type>text/plain</type><metadataType>ISO19115:2003</metadataType><content>$METALINK</content></metadataLink></metadataLinks></featureType>" http://$GEO_HOST:8080/geoserver/rest/workspaces/dank/datastores/pg_dank/featuretypes
   #curl -v -u $GEOADM:$PASSWDADM -XPOST -H "Content-type: text/xml" -d "<featureType><name>$LAYER_NAME</name><nativeName>vw_$VIEW_NAME</nativeName><title>$TITLE</title><abstract>$ABSTRACT</abstract><metadataLink><content>$METALINK</content></metadataLink></featureType>" http://$GEO_HOST:8080/geoserver/rest/workspaces/dank/datastores/pg_dank/featuretypes
   curl -v -u $GEOADM:$PASSWDADM -XPOST -H "Content-type: text/xml" -d "<featureType><name>$LAYER_NAME</name><nativeName>vw_$VIEW_NAME</nativeName><title>$TITLE</title><abstract>$ABSTRACT</abstract></featureType>" http://$GEO_HOST:8080/geoserver/rest/workspaces/dank/datastores/pg_dank/featuretypes
@@ -109,9 +94,7 @@ create_layer()
 
 update_layer()
 {
-  TITLE=`grep titel $CSV_FILE | cut -d ";" -f 2`
-  ABSTRACT=`grep samenvatting $CSV_FILE | cut -d ";" -f 2`
-  METALINK=`grep metadatalink $CSV_FILE | cut -d ";" -f 2`
+  read_metadata
   curl -v -u $GEOADM:$PASSWDADM -XPUT -H "Content-type: text/xml" -d "<featureType><title>$TITLE</title><abstract>$ABSTRACT</abstract><metadataLinks><metadataLink><type>text/plain</type><metadataType>ISO19115:2003</metadataType><content>$METALINK</content></metadataLink></metadataLinks></featureType>" http://$GEO_HOST:8080/geoserver/rest/workspaces/dank/datastores/pg_dank/featuretypes
 }
 
@@ -126,12 +109,18 @@ enable_layer()
 }
 
 ### Help functions
-convert_csv(){
-if (file "$CSV_FILE" |grep -i ISO-8859)
-then
-  cp $CSV_FILE $CSV_FILE-ORG
-  iconv --from-code=ISO-8859-1 --to-code=UTF-8 $CSV_FILE-ORG --output $CSV_FILE
-fi
+read_metadata(){
+  # TITLE, ABSTRACT and METALINK from the metadata CSV in one pass (gpdlib.readmetadata: UTF-8,
+  # ISO-8859-1 lines are converted), XML escaped
+  { IFS= read -r TITLE; IFS= read -r ABSTRACT; IFS= read -r METALINK; } < <(python -c "
+import sys
+from xml.sax.saxutils import escape
+sys.path.insert(0, sys.argv[1])
+import gpdlib
+values = gpdlib.readmetadata(sys.argv[2])[1] or {}
+for key in ('coverage.title', 'coverage.abstract', 'dank.metadatalink'):
+  print escape(' '.join(values.get(key, '').split()))
+" "${SCRIPT_DIR}" "$CSV_FILE")
 }
 
 is_csv(){
@@ -151,13 +140,16 @@ is_view(){
 }
 
 is_geom_point(){
-  [ ogrinfo "$SHP" | grep -i 'point']
+  [[ "$GEOM_TYPE" == *Point* ]]
 }
 
 #### main
 
-convert_csv
 create_layer
+if is_sld
+then
+  sync_styles
+fi
 assign_style
 enable_layer
 
@@ -168,30 +160,17 @@ exit
 if is_shape
 then
   create_db_table
-  echo "### TABLE created"
+  echo "### TABLE and VIEW created"
 else
   echo "*** No shape file found"
   exit
 fi
 
-if is_view
-then
-  create_db_view
-  echo "### VIEW created"
-else
-  echo "*** No view's name found"
-  exit
-fi
-
-grant_ro
-populate_geo
-
-reload_geo_conf
+reset_datastore
 
 if is_sld
 then
-  create_style
-  update_style
+  sync_styles
   echo "### STYLE created"
 else
   echo "*** No SLD file found"
@@ -200,7 +179,6 @@ fi
 
 #exit
 
-convert_csv
 create_layer
 assign_style
 enable_layer
@@ -23,6 +23,13 @@ DEBUG=False
 import sys
 import os
 import glob
+import csv
+import json
+import collections
+import multiprocessing
+import gpdlib
+import rasterheader
+import rasterconvert
 
 # help tekst
 if len(sys.argv) == 1:
@@ -37,14 +44,41 @@ Options (any order):
 --coverage-key=[key]                      key (string) to add in front of coverage name
 --workspace=[geoserver_workspace]         name of workspace to add coveragestores (must exist)
 --interactive                             interactive mode: asks info for individual coverages
+--scan-jobs=[n]                           number of processes reading the raster headers (default: number of cpu's)
+--no-scan                                 do not read the raster headers, see remark 8
+--preflight                               only report the layout of the GeoTIFFs (tiles, compression, overviews)
+                                          and which ones are not cloud optimized, see remark 13
+--optimize-geotiff                        convert GeoTIFFs that are not cloud optimized (<name>.cog.tif) and
+                                          publish the converted files, see remark 13
+--convert-arcgrid                         convert ArcGrids (.asc/.txt) to tiled GeoTIFFs (<name>.grid.tif) and
+                                          publish those as GeoTIFF, see remark 14
+--convert-jobs=[n]                        number of processes converting rasters (default: number of cpu's)
+--recursive                               process all subdirectories of the process dir too, see remark 7
 --set-param=[key]                         set only information for key (in .gpd), see remark 4
 --show-param=[key]                        show only information for key (in .gpd), see remark 4
 --update-param=[key]                      update information for specified key (in .gpd), see remark 4
 --update-value=[value]                    the value to update, see remark 5
+--edit=[expression]                       bulk edit (can be repeated, applied in order), see remark 10
+--edit-file=[file]                        bulk edits from a file, one expression per line, see remark 10
+--edit-jobs=[n]                           number of processes editing .gpd files (default: number of cpu's)
+--dry-run                                 bulk edit: only show the changes (diff), no files will be written
+--query[=conditions]                      list the datasets of the whole tree matching the conditions, see remark 11
+--columns=[key,key,...]                   query: columns to show (default: path,coverage.name,layer.style)
+--format=[table|csv|json]                 query: output format (default: table)
+--catalog                                 use the SQLite catalog (gpd.sqlite in the process dir) instead of
+                                          .gpd files, see remark 6
+--import-gpd                              import the .gpd files into the catalog
+--export-gpd                              export the catalog to .gpd files
+--batch                                   no questions: the GLOBAL settings are taken from --global, the manifest,
+                                          config.session and config.default, see remark 12
+--manifest=[file]                         generate the datasets listed in a CSV or JSON file (implies --batch),
+                                          see remark 12
+--global=[key=value]                      GLOBAL setting for --batch (can be repeated), e.g.
+                                          --global=coverage.abstract=Concentrations --global=geoserver.host=host:8080
 --debug                                   if set: debugging mode, no files will be written, verbose
 
 Remarks:
-1) The script will ask for the global settings, even in non-interactive mode.
+1) The script will ask for the global settings, even in non-interactive mode (except with --batch).
 2) Defaults will be showed within [] for each option, they can be accepted by hitting <enter>.
    A new value can be entered, example:
      Coverage title (displayed) [auto_title]: mytitle
@@ -61,10 +95,63 @@ Remarks:
      coverage.description
      coverage.abstract
      coverage.keywords
+     coverage.srs, coverage.bbox, coverage.grid, coverage.datatype, coverage.nodata (see remark 8)
      layer.style
 5) While updating a specified key, it is possible to specify the name of another key to extract data
    from, use a semi-colon in front of the key, e.g.:
    --update-param=coverage.description --update-value=:coverage.abstract
+6) With --catalog all datasets of a directory are kept in one SQLite file (gpd.sqlite), a row per
+   dataset (the .gpd file name without extension). --show-param, --set-param and --update-param
+   work on the catalog (--file-filter selects datasets by name), updates are one query.
+   publish2geoserver.py --catalog publishes from the catalog. --import-gpd / --export-gpd convert
+   between .gpd files and the catalog (--file-filter applies).
+7) With --recursive the whole tree below the process dir is processed in one run. The GLOBAL settings
+   are asked once (for the process dir); a subdirectory with its own config.session uses those
+   settings for itself and its subdirectories, including the workspace when the config.session
+   contains coveragestore.workspace.
+8) The headers of the raster files (GeoTIFF tags, ArcGrid header; no pixel data) are read to fill in
+   coverage.srs, coverage.bbox, coverage.grid, coverage.datatype and coverage.nodata, which
+   publish2geoserver.py sends with the coverage, so Geoserver does not have to scan the files.
+9) .gpd files are written with a fixed key order, via a temporary file, and only when their content
+   changes: unchanged files keep their modification time (incremental rsync/upload of the tree).
+10) Bulk edits change many keys in one pass over the .gpd files (or the catalog). An expression:
+      key=value [if condition [and condition ...]]      set a value
+      key+=value [if ...]                               append to a value
+    In a value {key} is replaced by the value of another key ({dataset}: the .gpd name), :key copies
+    another key. Conditions: key==value, key!=value, key~pattern, key!~pattern (shell pattern).
+    Example:
+      --edit="layer.style=ozon if coveragestore.filename~*o3_* and layer.style==" \
+      --edit="coverage.keywords+=,health if coverage.keywords!~*health*" \
+      --edit="coverage.description=:coverage.abstract if coverage.description=="
+11) --query lists the .gpd files of the whole tree below the process dir (--file-filter applies to the
+    file names) that match all conditions (as in remark 10), e.g.:
+      --query="coveragestore.workspace==gcn and layer.style==" --columns=path,coverage.name --format=csv
+    Columns are .gpd keys, path (relative to the process dir) or dataset. The .gpd files are indexed
+    in gpd.index in the process dir; only new or changed files are read again.
+12) --batch runs without any question (cron, CI). GLOBAL settings: --global values, then "global" of a
+    JSON manifest, config.session and config.default; they are saved in config.session as usual.
+    A manifest lists datasets, in any number of directories, with per dataset values:
+      directory,file,coverage.title,coverage.abstract,layer.style
+      gcn/2013,conc_o3_2013.tif,Ozon 2013,Ozon concentraties,ozon
+      gcn/2014,*.tif,,,default
+    directory is relative to the process dir, file is a file name or pattern (empty: --file-filter);
+    empty cells are ignored, other values overrule existing .gpd values (and a row for a single file
+    overrules pattern rows). JSON: a list of such rows or
+    {"global": {key: value}, "datasets": [rows]}. Directories without their own config.session use the
+    one of the process dir; the workspace is --workspace, coveragestore.workspace (global, session or row).
+13) Geoserver reads only the tiles and overview level a request needs from a cloud optimized GeoTIFF:
+    tiled, compressed and (over 1024 pixels) with internal overviews. --preflight lists all GeoTIFFs
+    (--recursive: of the tree) with their layout and what is missing. --optimize-geotiff converts the
+    other GeoTIFFs with the GDAL tools (gdal_translate, gdaladdo; 512x512 tiles, DEFLATE, nearest
+    neighbour overviews) to <name>.cog.tif next to the source, in parallel (--convert-jobs), and sets
+    coveragestore.filename to the converted file. Converted files are reused while they are newer
+    than the source, and are never published as datasets of their own.
+14) Geoserver parses an ArcGrid (text) for every request. --convert-arcgrid converts the ArcGrids to
+    <name>.grid.tif next to the source, without GDAL (NumPy): Float32, 512x512 tiles, DEFLATE, nearest
+    neighbour overviews, the nodata value and georeferencing (bbox, EPSG code of the .prj) of the
+    grid. The text is read in blocks, so large grids do not have to fit in memory. The .gpd gets
+    coveragestore.datatype=GeoTIFF and the converted file; conversion runs as in remark 13
+    (--convert-jobs, reused while newer than the source). Benchmark: benchmark-arcgrid.py.
 """
   exit(0)
 
@@ -80,6 +167,25 @@ showparam=""
 setparam=""
 updateparam=""
 updatevalue=""
+edits=[]
+editjobs=multiprocessing.cpu_count()
+dryrun=False
+query=None
+columns=['path', 'coverage.name', 'layer.style']
+outputformat='table'
+batch=False
+manifest=None
+globalvalues={}
+catalog=False
+importgpd=False
+exportgpd=False
+recursive=False
+scan=True
+scanjobs=multiprocessing.cpu_count()
+preflight=False
+optimizegeotiff=False
+convertarcgrid=False
+convertjobs=multiprocessing.cpu_count()
 
 for arg in sys.argv:
   # get commandline options (and optionally values)
@@ -89,7 +195,7 @@ for arg in sys.argv:
 
   # process commandline options
   if an == '--process-dir':
-    processdirectory=av.strip('/')
+    processdirectory=av.rstrip('/') or '/'
   if an == '--strip-name':
     stripfromfilename=av.split(',')
   if an == '--covstore-key':
@@ -102,6 +208,20 @@ for arg in sys.argv:
     coveragestore_workspace=av
   if an == '--interactive':
     interactive=True
+  if an == '--recursive':
+    recursive=True
+  if an == '--no-scan':
+    scan=False
+  if an == '--scan-jobs':
+    scanjobs=max(1, int(av))
+  if an == '--preflight':
+    preflight=True
+  if an == '--optimize-geotiff':
+    optimizegeotiff=True
+  if an == '--convert-arcgrid':
+    convertarcgrid=True
+  if an == '--convert-jobs':
+    convertjobs=max(1, int(av))
   if an == '--show-param':
     showparam=av
   if an == '--set-param':
@@ -110,17 +230,47 @@ for arg in sys.argv:
     updateparam=av
   if an == '--update-value':
     updatevalue=av
+  if an == '--edit':
+    edits.append(arg.split('=', 1)[1])
+  if an == '--edit-file':
+    edits.extend([l.strip() for l in open(av) if l.strip() != '' and not l.startswith('#')])
+  if an == '--edit-jobs':
+    editjobs=max(1, int(av))
+  if an == '--dry-run':
+    dryrun=True
+  if an == '--query':
+    query=arg.split('=', 1)[1] if '=' in arg else ''
+  if an == '--columns':
+    columns=av.split(',')
+  if an == '--format':
+    outputformat=av
+  if an == '--batch':
+    batch=True
+  if an == '--manifest':
+    manifest=av
+    batch=True
+  if an == '--global':
+    globalvalues[arg.split('=')[1]] = arg.split('=', 2)[2] if arg.count('=') > 1 else ''
+  if an == '--catalog':
+    catalog=True
+  if an == '--import-gpd':
+    importgpd=True
+  if an == '--export-gpd':
+    exportgpd=True
   if an == '--debug':
     DEBUG=True
 
 #########################################################
 # Configuration helper functions
 # Get config parameters
+# 0. manifest value for the dataset (batch)
 # 1. existing .gpd file
 # 2. session value from process-dir defaults
 # 3. default value from script dir defaults
 def getconfigparam(param):
-  if param in gpdconfig:
+  if param in datasetvalues.get(currentfile, {}):
+    return datasetvalues[currentfile][param]
+  elif param in gpdconfig:
     return gpdconfig[param]
   elif param in sessionconfig:
     return sessionconfig[param]
@@ -156,23 +306,134 @@ def getuserinput(prompt, param):
   else:
     return currentvalue
 
-GPD_CONTENT = ""
-def addtogpd(datarow):
-  global GPD_CONTENT
+# Write a .gpd file (only when changed), counts written / unchanged files
+gpdwrites = {'written': 0, 'unchanged': 0}
+def writegpdfile(publish_file, gpdconfig):
+  if gpdlib.writegpd(publish_file, gpdconfig):
+    print "Writing .gpd file"
+    gpdwrites['written'] += 1
+  else:
+    print "Unchanged .gpd file"
+    gpdwrites['unchanged'] += 1
+
+# Read the raster headers (memory-mapped, header only) of all files, in parallel
+# (process pool, not on Windows: child processes would restart this script)
+# returns {file: header (or None)}
+def scanrasterheaders(files):
+  rasterfiles = [f for f in files if os.path.splitext(f.lower())[1] in ('.txt', '.asc', '.tif', '.tiff')]
+  if not scan:
+    return {}
+  print "Reading raster headers:", len(rasterfiles), "files"
+  if scanjobs > 1 and len(rasterfiles) > 1 and sys.platform != 'win32':
+    pool = multiprocessing.Pool(min(scanjobs, len(rasterfiles)))
+    try:
+      # map_async + get(timeout): keeps Ctrl-C working while waiting
+      headers = pool.map_async(rasterheader.readheader, rasterfiles, 16).get(sys.maxint)
+    finally:
+      pool.terminate()
+      pool.join()
+  else:
+    headers = [rasterheader.readheader(f) for f in rasterfiles]
+  return dict(zip(rasterfiles, headers))
+
+# Convert rasters before publishing, in parallel (process pool, not on Windows):
+# GeoTIFFs that are not cloud optimized (--optimize-geotiff, GDAL), ArcGrids (--convert-arcgrid, NumPy)
+# returns {file: converted file}
+def convertrasters(rasterheaders):
+  files = sorted([f for f, header in rasterheaders.items() if header is not None and (
+    (optimizegeotiff and header['format'] == 'GeoTIFF' and len(rasterheader.cogissues(header)) > 0)
+    or (convertarcgrid and header['format'] == 'ArcGrid'))])
+  converted = dict([(f, rasterconvert.convertedfile(f)) for f in files if rasterconvert.uptodate(f)])
+  files = [f for f in files if f not in converted]
+  geotiffs = [f for f in files if rasterheaders[f]['format'] == 'GeoTIFF']
+  arcgrids = [f for f in files if rasterheaders[f]['format'] == 'ArcGrid']
+  version = None
+  if len(geotiffs) > 0:
+    version = rasterconvert.gdalversion()
+    if version is None:
+      print "WARNING: GDAL (gdal_translate) not found,", len(geotiffs), "GeoTIFFs are published as they are"
+      files = arcgrids
+    else:
+      print "Optimizing GeoTIFFs:", len(geotiffs), "files (GDAL " + '.'.join([str(v) for v in version]) + ")"
+  if len(arcgrids) > 0:
+    if rasterconvert.numpy is None:
+      print "WARNING: NumPy not found,", len(arcgrids), "ArcGrids are published as they are"
+      files = [f for f in files if f not in arcgrids]
+    else:
+      print "Converting ArcGrids:", len(arcgrids), "files"
+  if len(files) == 0:
+    return converted
   if DEBUG:
-    print datarow
+    for f in files:
+      print "  DEBUG: not converted:", f
+    return converted
+  args = [(f, version) for f in files]
+  if convertjobs > 1 and len(files) > 1 and sys.platform != 'win32':
+    pool = multiprocessing.Pool(min(convertjobs, len(files)))
+    try:
+      results = pool.map_async(rasterconvert.convert, args, 1).get(sys.maxint)
+    finally:
+      pool.terminate()
+      pool.join()
   else:
-    GPD_CONTENT = GPD_CONTENT + datarow + "\n"
+    results = [rasterconvert.convert(a) for a in args]
+  for path, output, message in results:
+    print "  " + os.path.basename(path) + ": " + message
+    if output is not None:
+      converted[path] = output
+  return converted
+
+# Preflight (--preflight): layout of the GeoTIFFs (tiles, compression, overviews) and what keeps
+# them from being cloud optimized (remark 13)
+def preflightgeotiffs():
+  if recursive:
+    files = [f for d, session, matches in gpdlib.walktree(processdirectory, filefilter) for f in matches]
+  else:
+    files = sorted(glob.glob(processdirectory + "/" + filefilter))
+  files = [f for f in files if os.path.splitext(f.lower())[1] in ('.tif', '.tiff') and not rasterconvert.isconvertedfile(f)]
+  headers = scanrasterheaders(files)
+  columns = ['file', 'size', 'layout', 'compression', 'overviews', 'status']
+  rows = []
+  issuecounts = collections.OrderedDict([('stripped', 0), ('uncompressed', 0), ('no overviews', 0)])
+  for f in files:
+    header = headers.get(f)
+    if header is None:
+      rows.append([f, '', '', '', '', 'header not readable'])
+      continue
+    issues = rasterheader.cogissues(header)
+    for i in issues:
+      issuecounts[i] += 1
+    if rasterconvert.uptodate(f):
+      status = 'converted: ' + os.path.basename(rasterconvert.convertedfile(f))
+    else:
+      status = ', '.join(issues) or 'ok'
+    rows.append([f, str(header['width']) + 'x' + str(header['height'])
+      , 'tiled ' + 'x'.join([str(b) for b in header['blocksize']]) if header['tiled'] else 'stripped'
+      , header['compression'], str(header['overviews']), status])
+  widths = [max([len(c)] + [len(r[i]) for r in rows]) for i, c in enumerate(columns)]
+  print "  ".join([c.ljust(w) for c, w in zip(columns, widths)]).rstrip()
+  print "  ".join(["-" * w for w in widths])
+  for r in rows:
+    print "  ".join([v.ljust(w) for v, w in zip(r, widths)]).rstrip()
+  print len(files), "GeoTIFFs,", len([r for r in rows if r[5] == 'ok']), "cloud optimized;", \
+    ", ".join([str(n) + " " + i for i, n in issuecounts.items()])
 
 ############################################################	
 # Generate Geoserver Publish Data (.gpd)
 # Loop through the data files, generate
 def genrasterpublishfiles(files):
   global gpdconfig  # test files (type, name)
-  global GPD_CONTENT
-
-  for f in MyFiles:
-    GPD_CONTENT = ""
+  global currentfile
+  catalogdatasets = []
+  # converted files (--optimize-geotiff, --convert-arcgrid) belong to their source file
+  files = [f for f in files if not rasterconvert.isconvertedfile(f)]
+  rasterheaders = scanrasterheaders(files)
+  converted = {}
+  if optimizegeotiff or convertarcgrid:
+    converted = convertrasters(rasterheaders)
+
+  for f in files:
+    currentfile = f
     fileext = os.path.splitext(f.lower())[1]
     filename = os.path.basename(f)
     # gridstore_type (extension)
@@ -186,6 +447,10 @@ def genrasterpublishfiles(files):
       coveragestore_type="GeoTIFF"
     else:
       coveragestore_type="UNKNOWN"
+    # an ArcGrid converted to a GeoTIFF (--convert-arcgrid) is published as GeoTIFF
+    if coveragestore_type=="ArcGrid" and f in converted:
+      coveragestore_type="GeoTIFF"
+      rasterheaders[f] = rasterheader.readheader(converted[f])
 
     if coveragestore_type!="UNKNOWN":
       if f.find(' ') > 0:
@@ -213,8 +478,12 @@ def genrasterpublishfiles(files):
 
         # Load an existing configuration
         publish_file = processdirectory + "/" + filename.split(".")[0] + ".gpd"
-        gpdconfig = loadconfigfile(publish_file)
-        print "  Geoserver Publish Data filename (.gpd):", publish_file
+        if catalog:
+          gpdconfig = gpdlib.getdataset(catalogconn, gpdlib.datasetname(f))
+          print "  Geoserver Publish Data catalog dataset:", gpdlib.datasetname(f)
+        else:
+          gpdconfig = loadconfigfile(publish_file)
+          print "  Geoserver Publish Data filename (.gpd):", publish_file
 
         # In interactive mode, ask for some information (except globals and servicenames)
         if getconfigparam('coverage.title') == '':
@@ -236,41 +505,77 @@ def genrasterpublishfiles(files):
           coverage_description = getconfigparam('coverage.description')
           coverage_abstract = getconfigparam('coverage.abstract')
           coverage_keywords = getconfigparam('coverage.keywords')
-          layer_style = ""
+          layer_style = getconfigparam('layer.style') if 'layer.style' in datasetvalues.get(f, {}) else ""
+
+        # Raster information from the header (if it could not be read: keep existing values)
+        rastervalues = rasterheader.gpdvalues(rasterheaders.get(f))
+        if f in rasterheaders and rasterheaders[f] is None:
+          print "  WARNING: could not read the raster header"
+        for k in ('coverage.srs', 'coverage.bbox', 'coverage.grid', 'coverage.datatype', 'coverage.nodata'):
+          if k not in rastervalues:
+            rastervalues[k] = gpdconfig.get(k, '')
+        if rastervalues['coverage.grid'] != '':
+          print "  Raster:", rastervalues['coverage.grid'].replace(',', 'x'), rastervalues['coverage.datatype'], rastervalues['coverage.srs']
+        if f in converted:
+          print "  Converted file:", converted[f]
         
-        print "Generating Geoserver Publish Data: ", publish_file
-        addtogpd("coveragestore.workspace=" + coveragestore_workspace)
-        addtogpd("coveragestore.datatype=" + coveragestore_type)
-        addtogpd("coveragestore.filename=" + f )
-        addtogpd("coveragestore.name=" + coveragestore_name)
-        addtogpd("coveragestore.description=" + coveragestore_description)
-        addtogpd("coverage.coveragestore.name=" + coveragestore_name)
-        addtogpd("coverage.name=" + coverage_name)
-        addtogpd("coverage.title=" + coverage_title)
-        addtogpd("coverage.description=" + coverage_description)
-        addtogpd("coverage.abstract=" + coverage_abstract)
-        addtogpd("coverage.keywords=" + coverage_keywords.replace(' ',''))
-        addtogpd("layer.coverage.name=" + coverage_name)
-        addtogpd("layer.style=" + layer_style)
+        print "Generating Geoserver Publish Data: ", gpdlib.datasetname(f) if catalog else publish_file
+        gpdrecord = {
+          'coveragestore.workspace': coveragestore_workspace,
+          'coveragestore.datatype': coveragestore_type,
+          'coveragestore.filename': converted.get(f, f),
+          'coveragestore.name': coveragestore_name,
+          'coveragestore.description': coveragestore_description,
+          'coverage.coveragestore.name': coveragestore_name,
+          'coverage.name': coverage_name,
+          'coverage.title': coverage_title,
+          'coverage.description': coverage_description,
+          'coverage.abstract': coverage_abstract,
+          'coverage.keywords': coverage_keywords.replace(' ',''),
+          'layer.coverage.name': coverage_name,
+          'layer.style': layer_style,
+        }
+        gpdrecord.update(rastervalues)
+        # manifest values (batch) for other keys
+        gpdrecord.update(datasetvalues.get(f, {}))
 
         if DEBUG:
-          print "\n" + GPD_CONTENT
+          print gpdlib.formatgpd(gpdrecord)
+        elif catalog:
+          catalogdatasets.append((gpdlib.datasetname(f), gpdrecord))
         else:
-          print "Writing .gpd file"
-          gpd = open(publish_file, 'w')
-          gpd.write(GPD_CONTENT)
-          gpd.close()
+          writegpdfile(publish_file, gpdrecord)
+
+  if catalog and not DEBUG:
+    print "Writing", len(catalogdatasets), "datasets to catalog:", gpdlib.catalogpath(processdirectory)
+    gpdlib.savedatasets(catalogconn, catalogdatasets)
 
 # Show parameters
 def showgpdparam(files, param):
+  if catalog:
+    for dataset, gpdconfig in gpdlib.getdatasets(catalogconn, filefilter):
+      print dataset.ljust(60, ' '), gpdconfig.get(param, '')
+    return
   for f in MyFiles:
     filename = os.path.basename(f)
     publish_file = processdirectory + "/" + filename.split(".")[0] + ".gpd"
     gpdconfig = loadconfigfile(publish_file)
-    print publish_file.ljust(60, ' '), gpdconfig[param]
+    print publish_file.ljust(60, ' '), gpdconfig.get(param, '')
 
 # Set parameters
 def setgpdparam(files, param):
+  if catalog:
+    for dataset, gpdconfig in gpdlib.getdatasets(catalogconn, filefilter):
+      print "dataset: " + dataset
+      newvalue = raw_input(param + " [" + gpdconfig.get(param, '') +"]: ").strip()
+      if newvalue != "":
+        gpdconfig[param] = newvalue
+        if DEBUG:
+          print param + "=" + gpdconfig[param]
+        else:
+          gpdlib.savedatasets(catalogconn, [(dataset, gpdconfig)])
+      print "\n"
+    return
   for f in MyFiles:
     filename = os.path.basename(f)
     publish_file = processdirectory + "/" + filename.split(".")[0] + ".gpd"
@@ -280,44 +585,126 @@ def setgpdparam(files, param):
     if newvalue != "":
       gpdconfig[param] = newvalue
     if DEBUG:
-      for p in gpdconfig:
-        print p + "=" + gpdconfig[p]
+      print gpdlib.formatgpd(gpdconfig)
     else:
       print param + "=" + gpdconfig[param]
-      # Write out new file
-      print "Writing .gpd file"
-      gpd = open(publish_file, 'w')
-      for p in gpdconfig:
-        gpd.write(p + "=" + gpdconfig[p] + "\n")
-      gpd.close()
+      writegpdfile(publish_file, gpdconfig)
 
     print "\n"
 
 # Update parameters (bulk)
 def updategpdparam(files, param, value):
+  if catalog:
+    # one query for all datasets
+    if DEBUG:
+      for dataset, gpdconfig in gpdlib.getdatasets(catalogconn, filefilter):
+        print dataset + ": " + param + "=" + (gpdconfig.get(value[1:], '') if value.startswith(':') else value)
+    else:
+      n = gpdlib.updatedatasets(catalogconn, filefilter, param, value)
+      print "Updated", n, "datasets:", param + "=" + value
+    return
   for f in MyFiles:
     filename = os.path.basename(f)
     publish_file = processdirectory + "/" + filename.split(".")[0] + ".gpd"
     gpdconfig = loadconfigfile(publish_file)
     print "file: " + publish_file
-    if value[0] == ":":
+    if value.startswith(":"):
       value2 = gpdconfig[value[1:]]
     else:
       value2 = value
     gpdconfig[param] = value2
     if DEBUG:
-      for p in gpdconfig:
-        print p + "=" + gpdconfig[p]
+      print gpdlib.formatgpd(gpdconfig)
     else:
       print param + "=" + gpdconfig[param]
-      # Write out new file
-      print "Writing .gpd file"
-      gpd = open(publish_file, 'w')
-      for p in gpdconfig:
-        gpd.write(p + "=" + gpdconfig[p] + "\n")
-      gpd.close()
+      writegpdfile(publish_file, gpdconfig)
 
     print "\n"
+
+# Query the (indexed) tree, print the columns of the matching datasets
+def querygpdfiles(conditions):
+  index, read = gpdlib.updateindex(processdirectory)
+  pattern = filefilter if filefilter.endswith('.gpd') else filefilter + '.gpd'
+  rows = []
+  for path, gpdconfig in gpdlib.queryindex(index, pattern, conditions):
+    values = {'path': path, 'dataset': gpdlib.datasetname(path)}
+    rows.append([values[c] if c in values else gpdconfig.get(c, '') for c in columns])
+  if outputformat == 'csv':
+    writer = csv.writer(sys.stdout)
+    writer.writerow(columns)
+    writer.writerows(rows)
+  elif outputformat == 'json':
+    print json.dumps([collections.OrderedDict(zip(columns, r)) for r in rows], indent=2)
+  else:
+    widths = [max([len(c)] + [len(r[i]) for r in rows]) for i, c in enumerate(columns)]
+    print "  ".join([c.ljust(w) for c, w in zip(columns, widths)]).rstrip()
+    print "  ".join(["-" * w for w in widths])
+    for r in rows:
+      print "  ".join([v.ljust(w) for v, w in zip(r, widths)]).rstrip()
+    print len(rows), "of", len(index), ".gpd files (" + str(read) + " read, the others from the index)"
+
+# Directories and files of the manifest rows: [(directory, session config, files)]
+# (fills datasetvalues: the values per file)
+def manifestdirectories(rows):
+  directories = collections.OrderedDict()
+  # rows for a single file go last: their values overrule those of pattern rows
+  for row in sorted(rows, key=lambda r: not glob.has_magic(r.get('file') or '*')):
+    directory = os.path.normpath(os.path.join(processdirectory, row.get('directory', '')))
+    values = dict([(k, v) for k, v in row.items() if k not in ('directory', 'file') and v != ''])
+    files = sorted(glob.glob(os.path.join(directory, row.get('file') or filefilter)))
+    if len(files) == 0:
+      print "WARNING: no files in manifest row:", directory, row.get('file', '')
+    for f in files:
+      directories.setdefault(directory, [])
+      if f not in directories[directory]:
+        directories[directory].append(f)
+      datasetvalues.setdefault(f, {}).update(values)
+  result = []
+  for directory, files in directories.items():
+    # nearest config.session, up to the process dir
+    sessionfile, d = None, directory
+    while sessionfile is None:
+      if os.path.exists(os.path.join(d, 'config.session')):
+        sessionfile = os.path.join(d, 'config.session')
+      elif d == processdirectory or os.path.dirname(d) in ('', d):
+        break
+      d = os.path.dirname(d)
+    result.append((directory, sessionfile, files))
+  return result
+
+# Bulk edits: all edits in one pass over each .gpd file (in parallel) or the catalog
+# returns the number of .gpd files checked (catalog: the number of datasets edited)
+def editgpdfiles(files, edits):
+  if catalog:
+    changed = []
+    for dataset, gpdconfig in gpdlib.getdatasets(catalogconn, filefilter):
+      edited = gpdlib.applyedits(gpdconfig, dataset, edits)
+      if edited != gpdconfig:
+        changed.append((dataset, edited))
+        if dryrun or DEBUG:
+          print "\n".join(gpdlib.gpddiff(dataset, gpdlib.formatgpd(gpdconfig), edited))
+    if not (dryrun or DEBUG):
+      gpdlib.savedatasets(catalogconn, changed)
+    print "Edited", len(changed), "datasets in", gpdlib.catalogpath(processdirectory) + (" (dry run)" if dryrun or DEBUG else "")
+    return len(changed)
+  args = [(f, edits, dryrun or DEBUG) for f in files]
+  if editjobs > 1 and len(files) > 1 and sys.platform != 'win32':
+    pool = multiprocessing.Pool(min(editjobs, len(files)))
+    try:
+      results = pool.map_async(gpdlib.editgpd, args, 16).get(sys.maxint)
+    finally:
+      pool.terminate()
+      pool.join()
+  else:
+    results = [gpdlib.editgpd(a) for a in args]
+  n = 0
+  for gpdfile, diff, changed in results:
+    if changed:
+      n += 1
+      if dryrun or DEBUG:
+        print "\n".join(diff)
+  print "Edited", n, "of", len(files), ".gpd files in", processdirectory + (" (dry run)" if dryrun or DEBUG else "")
+  return len(files)
   
 # #####################################################################
 # #####################        MAIN                  ##################
@@ -325,16 +712,70 @@ def updategpdparam(files, param, value):
 
 # Ze script, pretty minimal :-)
 # Get all existing configurations
+if catalog or importgpd or exportgpd:
+  catalogconn = gpdlib.opencatalog(processdirectory)
+
+if query is not None:
+  try:
+    querygpdfiles(gpdlib.parseconditions(query))
+  except gpdlib.GpdEditError, e:
+    print "ERROR:", e
+    exit(1)
+  exit(0)
+if preflight:
+  scan = True
+  preflightgeotiffs()
+  exit(0)
+if importgpd:
+  print "Imported", gpdlib.importgpd(catalogconn, processdirectory, filefilter), "datasets into", gpdlib.catalogpath(processdirectory)
+  exit(0)
+if exportgpd:
+  exported, written = gpdlib.exportgpd(catalogconn, processdirectory, filefilter)
+  print "Exported", exported, "datasets to .gpd files in", processdirectory + ":", written, "written,", exported - written, "unchanged"
+  exit(0)
+
+# Batch: dataset values and the GLOBAL settings of a manifest
+datasetvalues = {}  # {file: {key: value}}
+currentfile = None
+manifestrows = []
+if batch:
+  interactive = False
+if manifest is not None:
+  manifestglobals, manifestrows = gpdlib.loadmanifest(manifest)
+  manifestglobals.update(globalvalues)
+  globalvalues = manifestglobals
+
 defaultconfig = loadconfigfile('config.default')
 sessionconfig = loadconfigfile(processdirectory + '/config.session')
+sessionconfig.update(globalvalues)
 gpdconfig = {} # empty at the moment
+if 'coveragestore.workspace' in globalvalues:
+  coveragestore_workspace = globalvalues['coveragestore.workspace']
+parammode = showparam != "" or setparam != "" or updateparam != "" or len(edits) > 0
 
+try:
+  edits = [gpdlib.parseedit(e) for e in edits]
+except gpdlib.GpdEditError, e:
+  print "ERROR:", e
+  exit(1)
 
 ##########################################################
 # Coveragestore base description
 # Ask user for descriptions (should be read from XML metadata file, if present)
 # Only if not in parameter specific mode
-if setparam == "" and showparam == "" and updateparam == "":
+if not parammode and batch:
+  # no questions: --global values, manifest, session and default config
+  coveragestore_description = getconfigparam('coveragestore.description')
+  coverage_abstract = getconfigparam('coverage.abstract')
+  coverage_description = getconfigparam('coverage.description')
+  if coverage_description == "":
+    coverage_description = coverage_abstract
+  coverage_keywords = getconfigparam('coverage.keywords').replace(' ', '').strip()
+  geoserver_host = getconfigparam('geoserver.host')
+  geoserver_instance = getconfigparam('geoserver.instance')
+  geoserver_user = getconfigparam('geoserver.user')
+  coveragefile_rootdir = getconfigparam('geoserver.coveragerootdir')
+elif not parammode:
   print "Enter GLOBAL/DEFAULT settings"
   print "Just hit <enter> to accept an existing default.\n"
   print "GLOBAL: Store and layer configuration values"
@@ -353,6 +794,8 @@ if setparam == "" and showparam == "" and updateparam == "":
   coveragefile_rootdir=getuserinput('  Geoserver coveragerootdir (empty, or with trailing slash)', '')
   coveragefile_rootdir=coveragefile_rootdir
 
+if not parammode:
+
   # Save global description settings for future sessions
   config_file=open(processdirectory + "/config.session", "w")
   config_file.write("coveragestore.description=" + coveragestore_description + "\n")
@@ -367,6 +810,7 @@ if setparam == "" and showparam == "" and updateparam == "":
 
   # Reload session config with updated values
   sessionconfig = loadconfigfile(processdirectory + '/config.session')
+  sessionconfig.update(globalvalues)
 
   #########################################################
   # Print global settings
@@ -379,7 +823,7 @@ if setparam == "" and showparam == "" and updateparam == "":
   print "Coverage keywords:          ", coverage_keywords
   print "Coverage description:       ", coverage_description
   print "Coverage abstract:          ", coverage_abstract
-  print "Geoserver workspace:        ", coveragestore_workspace
+  print "Geoserver workspace:        ", globals().get('coveragestore_workspace', '')
   print "Geoserver host:             ", geoserver_host
   print "Geoserver instance:         ", geoserver_instance
   print "Geoserver user:             ", geoserver_user
@@ -387,23 +831,59 @@ if setparam == "" and showparam == "" and updateparam == "":
   print "\n"
 
 # Start with ze file names
-if showparam != "" or setparam != "" or updateparam != "":
+if parammode and not catalog:
   filefilter = filefilter + ".gpd"
 if DEBUG:
   print filefilter
-MyFiles = glob.glob(processdirectory + "/" + filefilter)
-if DEBUG:
-  print "DEBUG: Files to process: "
-  for f in MyFiles:
-    print "  ", f
-
-# Zen, zjenerate the .gpd files
-if showparam != "":
-  showgpdparam(MyFiles, showparam)
-elif setparam != "":
-  setgpdparam(MyFiles, setparam)
-elif updateparam != "":
-  updategpdparam(MyFiles, updateparam, updatevalue)
+
+# Directories to process: (directory, session config, files)
+# manifest: the directories and files of the manifest rows
+# recursive: streamed from the tree walk, directory by directory
+if manifest is not None:
+  directories = manifestdirectories(manifestrows)
+elif recursive:
+  if parammode and catalog:
+    directories = gpdlib.walktree(processdirectory, gpdlib.CATALOGFILE)
+  else:
+    directories = gpdlib.walktree(processdirectory, filefilter)
 else:
-  genrasterpublishfiles(MyFiles)
+  MyFiles = []
+  if not (parammode and catalog):
+    MyFiles = glob.glob(processdirectory + "/" + filefilter)
+  directories = [(processdirectory, processdirectory + '/config.session', MyFiles)]
+
+rootworkspace = globals().get('coveragestore_workspace', '')
+editedfiles = 0
+for processdirectory, sessionfile, MyFiles in directories:
+  if recursive or manifest is not None:
+    print "Directory:", processdirectory
+    sessionconfig = loadconfigfile(sessionfile or '')
+    sessionconfig.update(globalvalues)
+    coveragestore_workspace = sessionconfig.get('coveragestore.workspace', rootworkspace)
+    if catalog:
+      catalogconn = gpdlib.opencatalog(processdirectory)
+    if parammode and catalog:
+      MyFiles = []
+  if DEBUG:
+    print "DEBUG: Files to process: "
+    for f in MyFiles:
+      print "  ", f
+
+  # Zen, zjenerate the .gpd files
+  if showparam != "":
+    showgpdparam(MyFiles, showparam)
+  elif setparam != "":
+    setgpdparam(MyFiles, setparam)
+  elif updateparam != "":
+    updategpdparam(MyFiles, updateparam, updatevalue)
+  elif len(edits) > 0:
+    editedfiles += editgpdfiles(MyFiles, edits)
+  else:
+    genrasterpublishfiles(MyFiles)
+
+if gpdwrites['written'] + gpdwrites['unchanged'] > 0:
+  print ".gpd files written:", gpdwrites['written'], " unchanged:", gpdwrites['unchanged']
+if len(edits) > 0 and not catalog and editedfiles == 0:
+  print "ERROR: no .gpd files found (" + filefilter + ") in", processdirectory
+  exit(1)
 
@@ -8,10 +8,78 @@ import os
 import glob
 import csv
 import re
+import fnmatch
+import multiprocessing
+import shapeheader
+import gpdlib
 
 
 if len(sys.argv) < 2:
 	print "Usage: generate-dankpublishdata.py filename.csv"
+	print "       generate-dankpublishdata.py --root=[dir] [--manifest=file] [--jobs=n]"
+	print "Batch: reads the metadata CSV of every dataset directory below root (in parallel) and writes"
+	print "one manifest (CSV or JSON, default: dank-manifest.csv in root) for"
+	print "generate-geoserverpublishdata.py --manifest, see gpdlib.readmetadata for the keys."
+	exit(0)
+
+#######################################################
+# Batch: all dataset directories below a root directory -> one manifest
+root = None
+manifest = None
+jobs = multiprocessing.cpu_count()
+for arg in sys.argv:
+	an = arg.split('=')[0]
+	if len(arg.split('=')) > 1:
+		av = arg.split('=')[1]
+	if an == '--root':
+		root = av.rstrip('/') or "."
+	if an == '--manifest':
+		manifest = av
+	if an == '--jobs':
+		jobs = max(1, int(av))
+
+# Manifest row for a metadata CSV: directory (relative to root), data file (the file with
+# the same name as the CSV, else bestandsnaam, else the .tif) and the metadata values
+def manifestrow(csvfile, values):
+	directory = os.path.dirname(csvfile)
+	base = os.path.splitext(os.path.basename(csvfile))[0]
+	datafile = values.get('dank.bestandsnaam') or base + '.tif'
+	for ext in ('.tif', '.tiff', '.asc', '.shp'):
+		if os.path.exists(os.path.join(directory, base + ext)):
+			datafile = base + ext
+			break
+	row = {'directory': os.path.relpath(directory, root).replace(os.sep, '/'), 'file': datafile}
+	row.update(values)
+	return row
+
+if root is not None:
+	if manifest is None:
+		manifest = os.path.join(root, 'dank-manifest.csv')
+	csvfiles = []
+	for directory, dirs, files in gpdlib.walk(root):
+		dirs.sort()
+		csvfiles.extend([os.path.join(directory, f) for f in sorted(files) if fnmatch.fnmatch(f.lower(), '*.csv')])
+	# not the manifests themselves
+	csvfiles = [f for f in csvfiles if os.path.abspath(f) != os.path.abspath(manifest) and os.path.basename(f) != 'dank-manifest.csv']
+	if jobs > 1 and len(csvfiles) > 1 and sys.platform != 'win32':
+		pool = multiprocessing.Pool(min(jobs, len(csvfiles)))
+		try:
+			results = pool.map_async(gpdlib.readmetadata, csvfiles, 16).get(sys.maxint)
+		finally:
+			pool.terminate()
+			pool.join()
+	else:
+		results = [gpdlib.readmetadata(f) for f in csvfiles]
+	rows = []
+	for csvfile, values in results:
+		if values is None:
+			print "ERROR: can not read", csvfile
+		elif 'coverage.title' not in values:
+			print "WARNING: no titel in", csvfile
+		else:
+			rows.append(manifestrow(csvfile, values))
+	gpdlib.savemanifest(manifest, rows)
+	print "Manifest:", manifest, "(" + str(len(rows)), "datasets,", len(set([r['directory'] for r in rows])), "directories)"
 	exit(0)
 
 
@@ -24,6 +92,18 @@ MyCsvFiles = glob.glob(processdirectory + "/" + cssfilter)
 MyShpFile = glob.glob(processdirectory + "/" + shpfilter)
 MysldFile = glob.glob(processdirectory + "/" + sldfilter)
 
+# Shapefile headers (geometry type, features, bbox, attributes)
+shapeheaders = {}
+for s in MyShpFile:
+	shapeheaders[s] = shapeheader.readheader(s)
+	if shapeheaders[s] is None:
+		print "Shapefile %s can not be read" % s
+		continue
+	print "Shapefile: %s (%s, %d features)" % (os.path.basename(s), shapeheaders[s]['geometry'], shapeheaders[s]['features'])
+	print "  bbox: %s" % ','.join([repr(v) for v in shapeheaders[s]['bbox']])
+	for name, fieldtype, length, decimals in shapeheaders[s].get('fields', []):
+		print "  attribute: %s (%s %d.%d)" % (name, fieldtype, length, decimals)
+
 for f in MyCsvFiles:
 	csvFilename = os.path.basename(f)
 
@@ -83,7 +163,7 @@ for f in MyCsvFiles:
 	print "f3 is: %s" % f3 # altr_a01gv_potnatbestui
 
 if len(f1) > 0:
-	exìt(0)
+	exit(0)
 #######################################################
 # DANK vars
 coveragestore_type = "GeoTIFF"
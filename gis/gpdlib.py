@@ -0,0 +1,440 @@
+# Geoserver Publish Data (.gpd) helpers, shared by generate-geoserverpublishdata.py
+# and publish2geoserver.py
+#
+# A .gpd file is a small key=value file per (raster) dataset. As an alternative
+# to thousands of loose .gpd files a tree can use one SQLite catalog file
+# (gpd.sqlite in the process directory): a row per dataset with a column per
+# known key. The dataset name is the .gpd file name without extension.
+
+import os
+import re
+import csv
+import glob
+import json
+import difflib
+import fnmatch
+import sqlite3
+try:
+  from scandir import walk  # faster directory walk (scandir package, Python < 3.5)
+except ImportError:
+  from os import walk
+
+# Known .gpd keys, in the order they are written
+GPDKEYS = [
+  'coveragestore.workspace',
+  'coveragestore.datatype',
+  'coveragestore.filename',
+  'coveragestore.name',
+  'coveragestore.description',
+  'coverage.coveragestore.name',
+  'coverage.name',
+  'coverage.title',
+  'coverage.description',
+  'coverage.abstract',
+  'coverage.keywords',
+  'coverage.srs',
+  'coverage.bbox',
+  'coverage.grid',
+  'coverage.datatype',
+  'coverage.nodata',
+  'layer.coverage.name',
+  'layer.style',
+]
+
+CATALOGFILE = 'gpd.sqlite'
+INDEXFILE = 'gpd.index'
+
+class GpdEditError(Exception):
+  pass
+
+#########################################################
+# Files
+# Replace path by tmpfile (rename: atomic on POSIX, readers never see a missing or half
+# written file); Windows (Python 2) can not rename onto an existing file: removed first
+def replacefile(tmpfile, path):
+  if os.name == 'nt' and os.path.exists(path):
+    os.remove(path)
+  os.rename(tmpfile, path)
+
+# Write a file atomically: temp file (path + .tmp) + replacefile
+def writefile(path, content):
+  tmpfile = path + '.tmp'
+  f = open(tmpfile, 'wb')
+  try:
+    f.write(content)
+  finally:
+    f.close()
+  replacefile(tmpfile, path)
+
+#########################################################
+# .gpd files
+# Config/.gpd file loader (key=value lines), {} if the file does not exist
+def loadgpd(gpdfile):
+  if not os.path.exists(gpdfile):
+    return {}
+  gpdconfig = {}
+  gpd_file = open(gpdfile, 'r')
+  for l in gpd_file:
+    if l.find("=") > 0:
+      gpdconfig[l.split('=')[0]] = l.split('=')[1].strip()
+  gpd_file.close()
+  return gpdconfig
+
+# .gpd file content of a record: known keys in GPDKEYS order, other keys sorted
+def formatgpd(record):
+  return "".join([k + "=" + record[k] + "\n" for k in GPDKEYS + sorted([k for k in record if k not in GPDKEYS]) if k in record])
+
+# Write a .gpd file atomically (writefile), only when its content changes,
+# so unchanged files keep their mtime (rsync, publish manifest).
+# Returns True when the file was written, False when it was unchanged.
+def writegpd(gpdfile, record):
+  content = formatgpd(record)
+  if os.path.exists(gpdfile):
+    current = open(gpdfile, 'rb')
+    unchanged = current.read() == content
+    current.close()
+    if unchanged:
+      return False
+  writefile(gpdfile, content)
+  return True
+
+# Dataset name of a .gpd (or raster) file: file name without extension(s)
+def datasetname(f):
+  return os.path.basename(f).split(".")[0]
+
+#########################################################
+# Bulk edits
+# An edit is an assignment with optional conditions:
+#   key=value [if condition [and condition ...]]
+#   key+=value                append to the current value
+# value: text, {key} is replaced by the value of another key ({dataset}: the dataset name),
+#   :key copies another key
+# condition: key==value, key!=value, key~pattern, key!~pattern (shell pattern, e.g. *o3_*)
+def parseedit(expression):
+  parts = expression.split(' if ', 1)
+  m = re.match(r'^\s*([\w.]+)\s*(\+?=)(.*)$', parts[0])
+  if not m:
+    raise GpdEditError("invalid edit: " + expression)
+  conditions = []
+  if len(parts) > 1:
+    conditions = parseconditions(parts[1])
+  return (m.group(1), m.group(2), m.group(3).strip(), conditions)
+
+# Conditions: condition [and condition ...] (also used by queries)
+def parseconditions(expression):
+  conditions = []
+  for c in expression.split(' and '):
+    if c.strip() == '':
+      continue
+    mc = re.match(r'^\s*([\w.]+)\s*(==|!=|!~|~)(.*)$', c)
+    if not mc:
+      raise GpdEditError("invalid condition: " + c)
+    conditions.append((mc.group(1), mc.group(2), mc.group(3).strip()))
+  return conditions
+
+def matchcondition(record, condition):
+  key, op, value = condition
+  current = record.get(key, '')
+  if op == '==':
+    return current == value
+  elif op == '!=':
+    return current != value
+  elif op == '~':
+    return fnmatch.fnmatchcase(current, value)
+  else:
+    return not fnmatch.fnmatchcase(current, value)
+
+def editvalue(record, dataset, value):
+  if value.startswith(':'):
+    return record.get(value[1:], '')
+  return re.sub(r'\{([\w.]+)\}', lambda m: dataset if m.group(1) == 'dataset' else record.get(m.group(1), ''), value)
+
+# Apply parsed edits (in order) to a copy of a record
+def applyedits(record, dataset, edits):
+  record = dict(record)
+  for key, op, value, conditions in edits:
+    if all([matchcondition(record, c) for c in conditions]):
+      value = editvalue(record, dataset, value)
+      if op == '+=':
+        record[key] = record.get(key, '') + value
+      else:
+        record[key] = value
+  return record
+
+# Unified diff of old .gpd content and an edited record
+def gpddiff(name, content, record):
+  return list(difflib.unified_diff(content.splitlines(), formatgpd(record).splitlines(), name, name + ' (edited)', lineterm=''))
+
+# Edit one .gpd file, args: (gpdfile, edits, dryrun); returns (gpdfile, diff, changed)
+# (one argument: used with multiprocessing pools)
+def editgpd(args):
+  gpdfile, edits, dryrun = args
+  record = loadgpd(gpdfile)
+  edited = applyedits(record, datasetname(gpdfile), edits)
+  if edited == record:
+    return gpdfile, [], False
+  gpd = open(gpdfile, 'rb')
+  diff = gpddiff(gpdfile, gpd.read(), edited)
+  gpd.close()
+  if not dryrun:
+    writegpd(gpdfile, edited)
+  return gpdfile, diff, True
+
+#########################################################
+# Tree walking (--recursive)
+# Walks a tree lazily (top-down, sorted), yields per directory with matching files:
+#   (directory, session config file, [files])
+# The session config (config.session) of a directory applies to its subdirectories too,
+# unless they have their own.
+def walktree(root, pattern):
+  sessions = {}
+  for directory, dirs, files in walk(root):
+    dirs.sort()
+    if 'config.session' in files:
+      sessions[directory] = os.path.join(directory, 'config.session')
+    else:
+      sessions[directory] = sessions.get(os.path.dirname(directory))
+    matches = sorted(fnmatch.filter(files, pattern))
+    if len(matches) > 0:
+      yield directory, sessions[directory], [os.path.join(directory, f) for f in matches]
+
+#########################################################
+# Manifests (batch generation)
+# A manifest (CSV or JSON, by extension) lists the datasets to generate:
+#   directory   directory relative to the process dir (empty: the process dir)
+#   file        raster file (or shell pattern) in that directory (empty: all files)
+#   <key>       .gpd values for these datasets (empty: no value)
+# JSON: a list of rows, or {"global": {key: value}, "datasets": [rows]}
+# Returns (global values, rows)
+def loadmanifest(manifestfile):
+  globalvalues, rows = {}, []
+  f = open(manifestfile, 'rb')
+  try:
+    if manifestfile.lower().endswith('.json'):
+      data = json.load(f)
+      if isinstance(data, dict):
+        globalvalues, data = data.get('global', {}), data.get('datasets', [])
+      rows = data
+    else:
+      rows = list(csv.DictReader(f))
+  finally:
+    f.close()
+  # JSON strings are unicode, .gpd values utf-8 strings
+  def encode(values):
+    return dict([(k.encode('utf-8') if isinstance(k, unicode) else k,
+      v.encode('utf-8') if isinstance(v, unicode) else str(v)) for k, v in values.items() if v is not None])
+  return encode(globalvalues), [encode(r) for r in rows]
+
+# Write a manifest (CSV or JSON, by extension): directory, file, then the .gpd keys (known
+# keys first, in .gpd order); JSON with global values: {"global": ..., "datasets": [rows]}
+def savemanifest(manifestfile, rows, globalvalues={}):
+  keys = set([k for r in rows for k in r.keys()]) - set(['directory', 'file'])
+  columns = ['directory', 'file'] + [k for k in GPDKEYS if k in keys] + sorted(keys - set(GPDKEYS))
+  f = open(manifestfile + '.tmp', 'wb')
+  try:
+    if manifestfile.lower().endswith('.json'):
+      data = [dict([(k, r[k].decode('utf-8')) for k in columns if k in r]) for r in rows]
+      if len(globalvalues) > 0:
+        data = {'global': globalvalues, 'datasets': data}
+      json.dump(data, f, indent=1, sort_keys=True)
+    else:
+      writer = csv.DictWriter(f, columns, restval='', lineterminator='\n')
+      writer.writerow(dict(zip(columns, columns)))
+      writer.writerows(rows)
+  finally:
+    f.close()
+  replacefile(manifestfile + '.tmp', manifestfile)
+
+#########################################################
+# DANK metadata
+# Every DANK dataset comes with a metadata CSV: "key;value" lines, ISO-8859-1 or UTF-8.
+# The values become manifest (.gpd) values: the keys below, other keys as dank.<key>.
+DANKKEYS = {
+  'titel': 'coverage.title',
+  'samenvatting': 'coverage.abstract',
+  'thema': 'coverage.keywords',
+}
+
+# Lines of a text file as UTF-8, decoded per line (UTF-8, else ISO-8859-1)
+def utf8lines(path):
+  f = open(path, 'rb')
+  try:
+    for line in f:
+      try:
+        line.decode('utf-8')
+      except UnicodeDecodeError:
+        line = line.decode('iso-8859-1').encode('utf-8')
+      yield line
+  finally:
+    f.close()
+
+# Read a metadata CSV (in one pass), returns (csv file, {key: value}); values None when
+# the file can not be read
+def readmetadata(csvfile):
+  values = {}
+  try:
+    for row in csv.reader(utf8lines(csvfile), delimiter=';'):
+      if len(row) < 2:
+        continue
+      key = row[0].strip().lower()
+      if key.startswith('\xef\xbb\xbf'):
+        key = key[3:]
+      if key != '':
+        # the value is the rest of the line (abstracts can contain ;)
+        values[DANKKEYS.get(key, 'dank.' + key)] = ';'.join(row[1:]).strip()
+  except (IOError, csv.Error):
+    return csvfile, None
+  return csvfile, values
+
+#########################################################
+# Index of a publish tree (queries)
+# All .gpd files below a directory, cached in gpd.index (JSON, data only: the tree is shared,
+# so no pickle) in that directory:
+#   {relative path: (mtime, size, record)}
+# Only new and changed files (mtime, size) are read again. Paths and values are byte strings,
+# stored as latin-1 (every byte one character), so any encoding survives the round trip.
+def loadindex(root):
+  def decode(value):
+    return value.encode('latin-1')
+  try:
+    f = open(os.path.join(root, INDEXFILE), 'rb')
+    try:
+      data = json.load(f)
+    finally:
+      f.close()
+    return dict([(decode(path), (mtime, size, dict([(decode(k), decode(v)) for k, v in record.items()])))
+      for path, (mtime, size, record) in data.items()])
+  except (IOError, ValueError, TypeError, AttributeError):
+    return {}  # missing, unreadable or an old (pickle) index: rebuilt
+
+def saveindex(root, index):
+  indexfile = os.path.join(root, INDEXFILE)
+  f = open(indexfile + '.tmp', 'wb')
+  try:
+    json.dump(index, f, encoding='latin-1', separators=(',', ':'))
+  finally:
+    f.close()
+  replacefile(indexfile + '.tmp', indexfile)
+
+# Refresh (and save) the index of a tree, returns (index, number of files read)
+def updateindex(root):
+  index = loadindex(root)
+  current = {}
+  read = 0
+  for directory, dirs, files in walk(root):
+    # relative directory (os.path.relpath is slow for large trees)
+    reldir = directory[len(root):].lstrip(os.sep)
+    for f in fnmatch.filter(files, '*.gpd'):
+      path = os.path.join(directory, f)
+      st = os.stat(path)
+      key = os.path.join(reldir, f)
+      entry = index.get(key)
+      if entry is not None and entry[0] == st.st_mtime and entry[1] == st.st_size:
+        current[key] = entry
+      else:
+        current[key] = (st.st_mtime, st.st_size, loadgpd(path))
+        read += 1
+  if read > 0 or len(current) != len(index):
+    saveindex(root, current)
+  return current, read
+
+# Datasets of the index matching a file name pattern and conditions: [(relative path, record)]
+def queryindex(index, pattern="*.gpd", conditions=[]):
+  match = re.compile(fnmatch.translate(os.path.normcase(pattern))).match
+  result = []
+  for path in sorted(index):
+    record = index[path][2]
+    if match(os.path.normcase(os.path.basename(path))):
+      for c in conditions:
+        if not matchcondition(record, c):
+          break
+      else:
+        result.append((path, record))
+  return result
+
+#########################################################
+# SQLite catalog
+def column(key):
+  return '"' + key.replace('.', '_') + '"'
+
+def catalogpath(directory):
+  return os.path.join(directory, CATALOGFILE)
+
+# Open (and create when needed) the catalog of a directory
+def opencatalog(directory):
+  conn = sqlite3.connect(catalogpath(directory))
+  conn.text_factory = str
+  conn.execute("CREATE TABLE IF NOT EXISTS datasets (dataset TEXT PRIMARY KEY, "
+    + ", ".join([column(k) + " TEXT" for k in GPDKEYS]) + ", extra TEXT)")
+  # catalogs of older versions: add the columns of new keys
+  columns = [row[1] for row in conn.execute("PRAGMA table_info(datasets)")]
+  for k in GPDKEYS:
+    if column(k).strip('"') not in columns:
+      conn.execute("ALTER TABLE datasets ADD COLUMN " + column(k) + " TEXT")
+  conn.execute("CREATE INDEX IF NOT EXISTS datasets_workspace ON datasets (" + column('coveragestore.workspace') + ")")
+  conn.execute("CREATE INDEX IF NOT EXISTS datasets_coverage ON datasets (" + column('coverage.name') + ")")
+  conn.commit()
+  return conn
+
+def rowtorecord(row):
+  record = {}
+  for k, v in zip(GPDKEYS, row[1:-1]):
+    if v is not None:
+      record[k] = v
+  if row[-1]:
+    record.update(json.loads(row[-1]))
+  return record
+
+# Get datasets matching a file filter (shell pattern, e.g. *o3_*): [(dataset, record)]
+def getdatasets(conn, pattern="*"):
+  rows = conn.execute("SELECT dataset, " + ", ".join([column(k) for k in GPDKEYS]) + ", extra FROM datasets"
+    + " WHERE dataset GLOB ? ORDER BY dataset", (pattern,))
+  return [(row[0], rowtorecord(row)) for row in rows]
+
+def getdataset(conn, dataset):
+  row = conn.execute("SELECT dataset, " + ", ".join([column(k) for k in GPDKEYS]) + ", extra FROM datasets"
+    + " WHERE dataset = ?", (dataset,)).fetchone()
+  if row is None:
+    return {}
+  return rowtorecord(row)
+
+# Insert or replace datasets [(dataset, record)], in one transaction
+def savedatasets(conn, datasets):
+  rows = []
+  for dataset, record in datasets:
+    extra = dict([(k, v) for k, v in record.items() if k not in GPDKEYS])
+    rows.append([dataset] + [record.get(k) for k in GPDKEYS] + [json.dumps(extra, sort_keys=True) if extra else None])
+  with conn:
+    conn.executemany("INSERT OR REPLACE INTO datasets (dataset, " + ", ".join([column(k) for k in GPDKEYS])
+      + ", extra) VALUES (" + ", ".join(["?"] * (len(GPDKEYS) + 2)) + ")", rows)
+  return len(rows)
+
+# Bulk update of one key for all datasets matching the pattern; value ':otherkey'
+# copies the value of another key. Returns the number of updated datasets.
+def updatedatasets(conn, pattern, key, value):
+  if key not in GPDKEYS:
+    # unknown keys live in the extra (JSON) column
+    datasets = getdatasets(conn, pattern)
+    for dataset, record in datasets:
+      record[key] = record.get(value[1:], '') if value.startswith(':') else value
+    return savedatasets(conn, datasets)
+  if value.startswith(':') and value[1:] in GPDKEYS:
+    sql, args = "UPDATE datasets SET " + column(key) + " = " + column(value[1:]) + " WHERE dataset GLOB ?", (pattern,)
+  else:
+    sql, args = "UPDATE datasets SET " + column(key) + " = ? WHERE dataset GLOB ?", (value, pattern)
+  with conn:
+    return conn.execute(sql, args).rowcount
+
+# Import .gpd files (all files matching the pattern) into the catalog
+def importgpd(conn, directory, pattern="*"):
+  files = glob.glob(os.path.join(directory, pattern + ".gpd"))
+  return savedatasets(conn, [(datasetname(f), loadgpd(f)) for f in files])
+
+# Export catalog datasets to .gpd files in the directory, returns (exported, written)
+def exportgpd(conn, directory, pattern="*"):
+  datasets = getdatasets(conn, pattern)
+  written = 0
+  for dataset, record in datasets:
+    if writegpd(os.path.join(directory, dataset + ".gpd"), record):
+      written += 1
+  return len(datasets), written
@@ -10,4 +10,6 @@ if [ $# != 2 ]; then
   exit 1
 fi
 
-sed -i s/^layer\.style=$/layer\.style=${STYLE}/ ${WORKDIR}/*.gpd
+# set the style of all layers without a style (bulk edit, only changed .gpd files are written)
+python $(dirname $0)/generate-geoserverpublishdata.py --process-dir=${WORKDIR} --edit="layer.style=${STYLE} if layer.style=="
+
@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+
+# Mock Geoserver: a stand-in for the Geoserver REST API, as used by publish2geoserver.py
+# - keeps an in-memory catalog (coveragestores, coverages, layers per workspace)
+# - answers like Geoserver does: 201 on create, 200 on update, 404 for unknown
+#   objects, 500 when creating an object that already exists
+# - configurable latency and error rate, to measure and test publishing throughput
+# - a basic Importer API (/rest/imports): directory imports of raster files, read from the
+#   local file system (the location of the import is a local directory here)
+#
+# Extra (non Geoserver) endpoints:
+#   GET  /mock/stats         request counts (JSON)
+#   POST /mock/reset         empty the catalog and the counters
+#   POST /mock/reset-stats   reset only the counters
+
+import sys
+import os
+import re
+import time
+import json
+import random
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+# help tekst
+if len(sys.argv) > 1 and sys.argv[1] in ('-h', '--help'):
+  print """Usage: mock-geoserver.py <options>
+Runs a mock Geoserver REST API on localhost, e.g. for publish2geoserver.py:
+  geoserver.host=localhost:8090
+  geoserver.instance=/geoserver
+
+Options (any order):
+--port=[port]                 port to listen on (default: 8090)
+--latency=[ms]                response time per request in milliseconds (default: 0)
+--jitter=[ms]                 random extra response time, 0..jitter milliseconds (default: 0)
+--error-rate=[fraction]       fraction of requests answered with a 503 error (default: 0)
+--quiet                       do not log the requests
+"""
+  exit(0)
+
+#########################################################
+# Initialization (vars, commandline)
+port=8090
+latency=0.0
+jitter=0.0
+errorrate=0.0
+quiet=False
+
+for arg in sys.argv:
+  # get commandline options (and optionally values)
+  an = arg.split('=')[0]
+  if len(arg.split('=')) > 1:
+    av = arg.split('=')[1]
+
+  # process commandline options
+  if an == '--port':
+    port=int(av)
+  if an == '--latency':
+    latency=float(av) / 1000
+  if an == '--jitter':
+    jitter=float(av) / 1000
+  if an == '--error-rate':
+    errorrate=float(av)
+  if an == '--quiet':
+    quiet=True
+
+# ##########################
+# Catalog
+# workspace -> {'coveragestore': {name: xml}, 'coverage': {name: xml}, 'layer': {name: xml}, 'style': {name: sld}}
+# (global styles: workspace '')
+catalog = {}
+stats = {}
+lock = threading.Lock()
+request = threading.local()  # query parameters of the current request
+
+def getworkspace(workspace):
+  if workspace not in catalog:
+    catalog[workspace] = {'coveragestore': {}, 'coverage': {}, 'layer': {}, 'style': {}}
+  return catalog[workspace]
+
+def count(key):
+  stats[key] = stats.get(key, 0) + 1
+
+def getname(xml):
+  m = re.search('<name>(.*?)</name>', xml)
+  if m:
+    return m.group(1)
+  return None
+
+def listxml(roottag, tag, names):
+  xml = "<" + roottag + ">\n"
+  for n in sorted(names):
+    xml = xml + "  <" + tag + ">\n    <name>" + n + "</name>\n  </" + tag + ">\n"
+  return xml + "</" + roottag + ">\n"
+
+# ##########################
+# REST handlers, (method, url pattern) -> function(groups, body) -> (status, body[, content type])
+# the url pattern is matched against the path after /rest
+def liststores(ws, body):
+  return 200, listxml('coverageStores', 'coverageStore', getworkspace(ws)['coveragestore'])
+
+def addstore(ws, body):
+  name = getname(body)
+  stores = getworkspace(ws)['coveragestore']
+  if name is None:
+    return 400, 'No name'
+  if name in stores:
+    return 500, "Store '" + name + "' already exists in workspace '" + ws + "'"
+  stores[name] = body
+  return 201, name
+
+def getstore(ws, name, body):
+  stores = getworkspace(ws)['coveragestore']
+  if name not in stores:
+    return 404, "No such coverage store: " + ws + "," + name
+  return 200, stores[name]
+
+def updatestore(ws, name, body):
+  stores = getworkspace(ws)['coveragestore']
+  if name not in stores:
+    return 404, "No such coverage store: " + ws + "," + name
+  stores[name] = body
+  return 200, ''
+
+def listcoverages(ws, body):
+  return 200, listxml('coverages', 'coverage', getworkspace(ws)['coverage'])
+
+def liststorecoverages(ws, store, body):
+  w = getworkspace(ws)
+  if store not in w['coveragestore']:
+    return 404, "No such coverage store: " + ws + "," + store
+  names = [n for n in w['coverage'] if re.search('<store class="coverageStore">\s*<name>' + re.escape(store) + '</name>', w['coverage'][n])]
+  return 200, listxml('coverages', 'coverage', names)
+
+def addcoverage(ws, store, body):
+  w = getworkspace(ws)
+  name = getname(body)
+  if store not in w['coveragestore']:
+    return 404, "No such coverage store: " + ws + "," + store
+  if name is None:
+    return 400, 'No name'
+  if name in w['coverage']:
+    return 500, "Resource named '" + name + "' already exists in store: '" + store + "'"
+  w['coverage'][name] = body
+  # Geoserver creates the layer with the coverage
+  w['layer'][name] = "<layer>\n  <name>" + name + "</name>\n</layer>"
+  return 201, name
+
+def getcoverage(ws, store, name, body):
+  w = getworkspace(ws)
+  if name not in w['coverage']:
+    return 404, "No such coverage: " + ws + "," + store + "," + name
+  return 200, w['coverage'][name]
+
+def updatecoverage(ws, store, name, body):
+  w = getworkspace(ws)
+  if name not in w['coverage']:
+    return 404, "No such coverage: " + ws + "," + store + "," + name
+  w['coverage'][name] = body
+  return 200, ''
+
+def listlayers(body):
+  names = []
+  for ws in catalog:
+    names.extend([ws + ':' + n for n in catalog[ws]['layer']])
+  return 200, listxml('layers', 'layer', names)
+
+def getlayer(ws, name, body):
+  w = getworkspace(ws)
+  if name not in w['layer']:
+    return 404, "No such layer: " + ws + ":" + name
+  return 200, w['layer'][name]
+
+def updatelayer(ws, name, body):
+  w = getworkspace(ws)
+  if name not in w['layer']:
+    return 404, "No such layer: " + ws + ":" + name
+  w['layer'][name] = body
+  return 200, ''
+
+# Full reload and store resets: only counted (/mock/stats: reload, reset)
+def reload(body):
+  count('reload')
+  return 200, ''
+
+def resetstore(ws, name, body):
+  if name not in getworkspace(ws)['coveragestore']:
+    return 404, "No such coverage store: " + ws + "," + name
+  count('reset')
+  return 200, ''
+
+# Styles: the SLD is posted with ?name=... (or the name in the SLD)
+def liststyles(ws, body):
+  return 200, listxml('styles', 'style', getworkspace(ws or '')['style'])
+
+def addstyle(ws, body):
+  name = request.query.get('name', [None])[0]
+  if name is None:
+    m = re.search('<(?:\\w+:)?Name>(.*?)</(?:\\w+:)?Name>', body)
+    name = m.group(1) if m else None
+  styles = getworkspace(ws or '')['style']
+  if name is None:
+    return 400, 'No name'
+  if name in styles:
+    return 403, "Style " + name + " already exists"
+  styles[name] = body
+  return 201, name
+
+def updatestyle(ws, name, body):
+  styles = getworkspace(ws or '')['style']
+  if name not in styles:
+    return 404, "No such style: " + name
+  styles[name] = body
+  return 200, ''
+
+# ##########################
+# Importer: id -> {'id', 'state', 'workspace', 'location', 'tasks': [task]}
+# a task: {'id', 'state', 'updateMode', 'data': {'type', 'format', 'file'},
+#          'target': {'coverageStore': {'name', 'type'}}, 'layer': {'name', 'title', 'abstract', 'style'}}
+imports = {}
+RASTERFORMATS = {'.tif': 'GeoTIFF', '.tiff': 'GeoTIFF', '.asc': 'ArcGrid', '.txt': 'ArcGrid'}
+
+def importjson(i):
+  return json.dumps({'import': {'id': i['id'], 'state': i['state'], 'href': '/rest/imports/' + str(i['id'])
+    , 'targetWorkspace': {'workspace': {'name': i['workspace']}}, 'tasks': i['tasks']}}, indent=2), 'application/json'
+
+def addimport(body):
+  try:
+    spec = json.loads(body or '{}').get('import', {})
+  except ValueError:
+    return 400, 'Invalid JSON'
+  workspace = spec.get('targetWorkspace', {}).get('workspace', {}).get('name')
+  location = spec.get('data', {}).get('location', '')
+  if location.startswith('file:'):
+    location = location[5:]
+  i = {'id': len(imports) + 1, 'state': 'PENDING', 'workspace': workspace, 'location': location, 'tasks': []}
+  if os.path.isdir(location):
+    for f in sorted(os.listdir(location)):
+      name, ext = os.path.splitext(f)
+      if ext.lower() in RASTERFORMATS:
+        i['tasks'].append({'id': len(i['tasks']), 'state': 'READY', 'updateMode': 'CREATE'
+          , 'data': {'type': 'file', 'format': RASTERFORMATS[ext.lower()], 'file': f}
+          , 'target': {'coverageStore': {'name': name, 'type': RASTERFORMATS[ext.lower()]}}
+          , 'layer': {'name': name, 'title': name, 'abstract': '', 'style': {'name': 'raster'}}})
+  imports[i['id']] = i
+  data, contenttype = importjson(i)
+  return 201, data, contenttype
+
+def getimport(importid, body):
+  if int(importid) not in imports:
+    return 404, 'No such import: ' + importid
+  data, contenttype = importjson(imports[int(importid)])
+  return 200, data, contenttype
+
+def gettasks(importid, body):
+  if int(importid) not in imports:
+    return 404, 'No such import: ' + importid
+  return 200, json.dumps({'tasks': imports[int(importid)]['tasks']}, indent=2), 'application/json'
+
+def gettask(importid, taskid):
+  i = imports.get(int(importid))
+  if i is None:
+    return None
+  for t in i['tasks']:
+    if t['id'] == int(taskid):
+      return t
+  return None
+
+def updatetask(importid, taskid, body):
+  t = gettask(importid, taskid)
+  if t is None:
+    return 404, 'No such task: ' + importid + '/' + taskid
+  try:
+    update = json.loads(body or '{}').get('task', {})
+  except ValueError:
+    return 400, 'Invalid JSON'
+  for k in ('updateMode', 'target', 'layer'):
+    if k in update:
+      if isinstance(update[k], dict):
+        t[k].update(update[k])
+      else:
+        t[k] = update[k]
+  return 204, ''
+
+def deletetask(importid, taskid, body):
+  t = gettask(importid, taskid)
+  if t is None:
+    return 404, 'No such task: ' + importid + '/' + taskid
+  imports[int(importid)]['tasks'].remove(t)
+  return 204, ''
+
+# Run an import: every task creates a coverage store, coverage and layer (synchronously,
+# the state is COMPLETE when the request returns, also with ?async=true)
+def runimport(importid, body):
+  i = imports.get(int(importid))
+  if i is None:
+    return 404, 'No such import: ' + importid
+  ws = i['workspace']
+  for t in i['tasks']:
+    store = t['target']['coverageStore']['name']
+    layer = t['layer']
+    status, message = addstore(ws, "<coverageStore>\n  <name>" + store + "</name>\n  <type>" + t['data']['format']
+      + "</type>\n  <url>file:" + os.path.join(i['location'], t['data']['file']) + "</url>\n</coverageStore>")
+    if status == 201:
+      status, message = addcoverage(ws, store, "<coverage>\n  <name>" + layer['name'] + "</name>\n  <title>"
+        + layer.get('title', '') + "</title>\n  <abstract>" + layer.get('abstract', '') + "</abstract>\n"
+        + "  <store class=\"coverageStore\">\n    <name>" + store + "</name>\n  </store>\n</coverage>")
+    if status == 201:
+      getworkspace(ws)['layer'][layer['name']] = "<layer>\n  <name>" + layer['name'] + "</name>\n  <defaultStyle>\n    <name>" \
+        + layer.get('style', {}).get('name', '') + "</name>\n  </defaultStyle>\n</layer>"
+      t['state'] = 'COMPLETE'
+    else:
+      t['state'] = 'ERROR'
+      t['errorMessage'] = message
+  i['state'] = 'COMPLETE'
+  return 204, ''
+
+routes = [
+  ('GET', 'workspaces/([^/]+)/coveragestores', liststores),
+  ('POST', 'workspaces/([^/]+)/coveragestores', addstore),
+  ('GET', 'workspaces/([^/]+)/coveragestores/([^/]+)', getstore),
+  ('PUT', 'workspaces/([^/]+)/coveragestores/([^/]+)', updatestore),
+  ('GET', 'workspaces/([^/]+)/coverages', listcoverages),
+  ('GET', 'workspaces/([^/]+)/coveragestores/([^/]+)/coverages', liststorecoverages),
+  ('POST', 'workspaces/([^/]+)/coveragestores/([^/]+)/coverages', addcoverage),
+  ('GET', 'workspaces/([^/]+)/coveragestores/([^/]+)/coverages/([^/]+)', getcoverage),
+  ('PUT', 'workspaces/([^/]+)/coveragestores/([^/]+)/coverages/([^/]+)', updatecoverage),
+  ('GET', 'layers', listlayers),
+  ('GET', 'layers/([^/:]+):([^/]+)', getlayer),
+  ('PUT', 'layers/([^/:]+):([^/]+)', updatelayer),
+  ('POST', 'workspaces/([^/]+)/coveragestores/([^/]+)/reset', resetstore),
+  ('POST', 'reload', reload),
+  ('GET', '()styles', liststyles),
+  ('POST', '()styles', addstyle),
+  ('PUT', '()styles/([^/]+)', updatestyle),
+  ('GET', 'workspaces/([^/]+)/styles', liststyles),
+  ('POST', 'workspaces/([^/]+)/styles', addstyle),
+  ('PUT', 'workspaces/([^/]+)/styles/([^/]+)', updatestyle),
+  ('POST', 'imports', addimport),
+  ('GET', 'imports/([0-9]+)', getimport),
+  ('POST', 'imports/([0-9]+)', runimport),
+  ('GET', 'imports/([0-9]+)/tasks', gettasks),
+  ('PUT', 'imports/([0-9]+)/tasks/([0-9]+)', updatetask),
+  ('DELETE', 'imports/([0-9]+)/tasks/([0-9]+)', deletetask),
+]
+
+# ##########################
+# HTTP server (HTTP/1.1, keep-alive)
+class MockGeoserverHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # buffered responses, sent in one go (no 40ms Nagle/delayed ACK stalls)
+  wbufsize = -1
+  disable_nagle_algorithm = True
+
+  def respond(self, status, body, contenttype='application/xml'):
+    self.send_response(status)
+    self.send_header('Content-Type', contenttype)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def handle_request(self):
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    path = self.path.split('?')[0]
+    request.query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+
+    if path == '/mock/stats':
+      with lock:
+        return self.respond(200, json.dumps(stats, sort_keys=True), 'application/json')
+    if path == '/mock/reset':
+      with lock:
+        catalog.clear()
+        imports.clear()
+        stats.clear()
+      return self.respond(200, '')
+    if path == '/mock/reset-stats':
+      with lock:
+        stats.clear()
+      return self.respond(200, '')
+
+    if latency > 0 or jitter > 0:
+      time.sleep(latency + random.random() * jitter)
+
+    with lock:
+      count('requests')
+      count(self.command)
+    if not self.headers.get('Authorization', '').startswith('Basic '):
+      return self.respond(401, 'Unauthorized')
+    if errorrate > 0 and random.random() < errorrate:
+      with lock:
+        count('errors')
+      return self.respond(503, 'Service Unavailable (mock)')
+
+    m = re.match('^.*?/rest/(.*?)(\.xml|\.json)?$', path)
+    if m:
+      for method, pattern, handler in routes:
+        r = re.match('^' + pattern + '$', m.group(1))
+        if method == self.command and r:
+          with lock:
+            # (status, body) or (status, body, content type)
+            result = handler(*(r.groups() + (body,)))
+          return self.respond(*result)
+    self.respond(404, 'Not found: ' + self.command + ' ' + path)
+
+  do_GET = handle_request
+  do_POST = handle_request
+  do_PUT = handle_request
+  do_DELETE = handle_request
+
+  def log_message(self, format, *args):
+    if not quiet:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class MockGeoserver(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+  request_queue_size = 128
+
+# #####################################################################
+# Ze script (MAIN)
+server = MockGeoserver(('localhost', port), MockGeoserverHandler)
+print "Mock Geoserver listening on: localhost:" + str(port)
+print "Latency (ms):       ", latency * 1000, "+ 0 ..", jitter * 1000
+print "Error rate:         ", errorrate
+sys.stdout.flush()
+try:
+  server.serve_forever()
+except KeyboardInterrupt:
+  pass
@@ -23,10 +23,22 @@ DEBUG=False
 
 import sys
 import os
+import re
 import glob
+import json
 import urllib
-import urllib2
+import urlparse
+import httplib
+import socket
+import time
+import random
 import base64
+import hashlib
+import threading
+import collections
+import xml.etree.ElementTree as ElementTree
+from multiprocessing.pool import ThreadPool
+import gpdlib
 
 # help tekst
 if len(sys.argv) == 1:
@@ -37,10 +49,38 @@ Geoserver objects is also possible.
 Options (any order):
 --process-dir=[dir]           directory to process (as subdirectory of current directory)
 --file-filter=[pattern]       default: * (.gpd will always be appended)
+--recursive                   process all subdirectories of the process dir too (one Geoserver: the
+                              host settings are read from the config.session in the process dir)
+--catalog                     publish the datasets from the SQLite catalog (gpd.sqlite, see
+                              generate-geoserverpublishdata.py) instead of the .gpd files
 --pub-stores                  publish the (raster) stores
 --pub-coverages               publish the coverages (a basic layers will be created automatically)
 --set-layeroptions            set the layer options
 --update                      update existing Geoserver objects (stores, coverages, layers)
+--sync                        compare with the Geoserver catalog first: only create missing objects,
+                              existing objects are left alone (with --update: updated)
+--force                       send all objects, also the ones unchanged since the last run (manifest)
+--jobs=[n]                    maximum number of parallel requests to Geoserver (default: 1)
+--retries=[n]                 retries for requests failing with a timeout or 502/503/504 (default: 3),
+                              a POST only when the object does not exist, see remark 5
+--timeout=[s]                 request timeout in seconds (default: 60)
+--trace[=file]                write a timing trace of all requests (JSON lines), default file:
+                              publish-trace.jsonl in the process directory
+--plan[=file]                 do not send anything, write the requests to a plan file (JSON lines)
+                              instead, default file: publish-plan.jsonl in the process directory; see remark 7
+--execute-plan=[file]         send the requests of a plan file (with --jobs in parallel), see remark 7
+--styles                      upload the SLD files (*.sld) in the process dir (--recursive: the tree) as
+                              styles first, identical SLD files share one style, see remark 9
+--style-workspace=[ws]        workspace for the styles (default: global styles)
+--reset-stores                reset the existing stores that were updated (their cached readers), once per
+                              store at the end of the run, see remark 10
+--reload                      reload the whole Geoserver catalog once at the end of the run (only when
+                              something was changed), see remark 10
+--importer                    publish new datasets with the Geoserver Importer extension (/rest/imports):
+                              one import job per directory, see remark 8
+--import-wait=[s]             maximum time in seconds to wait for an import job (default: 3600)
+--resume                      continue an interrupted run: skip the requests that completed in the last run
+                              (publish.journal in the process dir), see remark 11
 --no-proxy                    ignores proxy settings from the environment (http_proxy or internet
                               settings under Windows/Mac)
 --debug                       if set: debugging mode, no request will be made to Geoserver,
@@ -51,7 +91,45 @@ Remarks:
    they will be referenced from within Geoserver, where they must be accessible at the location
    as specified in the .gpd file.
 2) --set-layeroptions always performs an update (layers are auto-created by Geoserver).
+   With --sync only the layers of new coverages are set (all existing layers with --update).
 3) Providing an empty password automatically enters debugging mode.
+4) The configuration sent for every object is recorded (as a hash) in publish.manifest in the
+   process directory; objects with the same configuration as in the last successful request
+   are skipped, unless --force is given.
+5) With --jobs the number of requests in flight adapts to Geoserver: it grows slowly while requests
+   succeed and is halved on errors, timeouts or when responses get much slower. Failed requests
+   are retried after a random (jittered), growing wait. A POST may have been carried out by
+   Geoserver before it failed: it is sent again only when a GET shows that the object does not
+   exist (an existing object counts as created); POSTs without such a check (importer jobs,
+   resets, reload) are not retried.
+6) At the end a latency summary (p50/p95/p99) and throughput is printed per operation type.
+7) A plan holds a line per request: {"id", "key", "method", "url", "body", "hash", "after"}, "after"
+   lists the objects (keys) that must be published first (store -> coverage -> layer). A plan can be
+   made without a password (offline, like debugging mode), reviewed, and executed later from another
+   host. --execute-plan sends requests as soon as the objects they depend on are published; when
+   that fails the dependent requests are skipped. The host is taken from the urls in the plan, the
+   user from the config.session of --process-dir (if given, the manifest there is updated too).
+8) With --importer (the Importer extension must be installed) the raster files of a directory are
+   imported in one job: stores, coverages and layers are created by Geoserver. Per dataset the
+   store name, coverage/layer name, title, abstract and style come from the .gpd file; files in
+   the directory without a .gpd file are removed from the job. The job is polled until it is
+   done (at most --import-wait seconds, the datasets still running are logged as timed out),
+   the log shows the result per dataset. Only new datasets (with --sync: existing stores
+   are left out); geoserver.coveragerootdir must be an absolute path on the Geoserver host.
+9) --styles hashes the SLD files: every distinct SLD is uploaded once, as a style named after the
+   (alphabetically) first SLD file with that content; new and changed styles are uploaded in
+   parallel (--jobs), unchanged ones (manifest) are skipped. styles.map in the process dir maps every
+   SLD file (relative path) to its style; layer.style values naming an SLD file (without .sld)
+   are set to the shared style. Also for the vector flow (compute-shape.sh).
+10) Objects published through the REST API need no reload. When data files were replaced
+   in place, --reset-stores resets only the stores of the run that were updated (PUT, stores
+   or coverages); a full reload (--reload, slow on a large catalog) is done at most once per
+   run, after all datasets. With --execute-plan the stores updated by the plan are reset.
+11) Every completed request (object, configuration hash) is appended to publish.journal in the
+   process dir and synced to disk at once, so the journal survives a crash. A run without
+   --resume starts a new journal; with --resume (same options) the journaled requests are
+   skipped (also with --force or --update), the run continues where it stopped. Imports
+   (--importer) are journaled per dataset, only when its task completed.
 """
   exit(0)
 
@@ -61,8 +139,26 @@ pubstores=False
 pubcoverages=False
 setlayeroptions=False
 update=False
+sync=False
+force=False
+catalog=False
+recursive=False
 filefilter="*"
 noproxy=False
+jobs=1
+retries=3
+timeout=60
+tracefile=""
+planfile=""
+executeplanfile=""
+processdirectory=None
+importer=False
+importwait=3600.0
+styles=False
+styleworkspace=""
+resetstores=False
+reloadcatalog=False
+resume=False
 reqlog=[]
 
 for arg in sys.argv:
@@ -85,8 +181,42 @@ for arg in sys.argv:
     filefilter=av
   if an == '--update':
     update=True
+  if an == '--sync':
+    sync=True
+  if an == '--force':
+    force=True
+  if an == '--catalog':
+    catalog=True
+  if an == '--recursive':
+    recursive=True
   if an == '--no-proxy':
     noproxy=True
+  if an == '--jobs':
+    jobs=max(1, int(av))
+  if an == '--retries':
+    retries=max(0, int(av))
+  if an == '--timeout':
+    timeout=float(av)
+  if an == '--trace':
+    tracefile=av if arg.find('=') > 0 else "publish-trace.jsonl"
+  if an == '--plan':
+    planfile=av if arg.find('=') > 0 else "publish-plan.jsonl"
+  if an == '--execute-plan':
+    executeplanfile=av
+  if an == '--importer':
+    importer=True
+  if an == '--import-wait':
+    importwait=float(av)
+  if an == '--styles':
+    styles=True
+  if an == '--style-workspace':
+    styleworkspace=av
+  if an == '--reset-stores':
+    resetstores=True
+  if an == '--reload':
+    reloadcatalog=True
+  if an == '--resume':
+    resume=True
   if an == '--debug':
     DEBUG=True
 
@@ -110,7 +240,58 @@ def coveragestorexml(covstoreworkspace, covstorename, description, covstoretype,
   , gridfile
   , covstoreworkspace)
 
-def coveragexml(covstorename, covname, covtitle, covdescription, keywords, abstract):
+# Native CRS, bounding box and grid of a coverage (from the raster header scan of
+# generate-geoserverpublishdata.py), saves Geoserver reading the raster file.
+# raster: .gpd values coverage.srs, coverage.bbox, coverage.grid, coverage.nodata
+def coveragerasterxml(raster):
+  xml = ''
+  srs = raster.get('coverage.srs', '')
+  bbox = raster.get('coverage.bbox', '')
+  grid = raster.get('coverage.grid', '')
+  if srs != '':
+    xml = xml + str.format("  <srs>{0}</srs>\n  <projectionPolicy>FORCE_DECLARED</projectionPolicy>\n", srs)
+  # bbox and grid need a crs (an empty <crs/> can not be parsed): without a srs (e.g. an
+  # ArcGrid without .prj) Geoserver reads them from the file, as before
+  if bbox != '' and srs != '':
+    minx, miny, maxx, maxy = bbox.split(',')
+    xml = xml + str.format("  <nativeBoundingBox>\n\
+    <minx>{0}</minx>\n\
+    <maxx>{2}</maxx>\n\
+    <miny>{1}</miny>\n\
+    <maxy>{3}</maxy>\n\
+    <crs>{4}</crs>\n\
+  </nativeBoundingBox>\n", minx, miny, maxx, maxy, srs)
+  if grid != '' and bbox != '' and srs != '':
+    width, height = grid.split(',')
+    xml = xml + str.format("  <grid dimension=\"2\">\n\
+    <range>\n\
+      <low>0 0</low>\n\
+      <high>{0} {1}</high>\n\
+    </range>\n\
+    <transform>\n\
+      <scaleX>{2!r}</scaleX>\n\
+      <scaleY>{3!r}</scaleY>\n\
+      <shearX>0.0</shearX>\n\
+      <shearY>0.0</shearY>\n\
+      <translateX>{4}</translateX>\n\
+      <translateY>{5}</translateY>\n\
+    </transform>\n\
+    <crs>{6}</crs>\n\
+  </grid>\n", width, height
+    , (float(maxx) - float(minx)) / int(width), -(float(maxy) - float(miny)) / int(height)
+    , minx, maxy, srs)
+  if raster.get('coverage.nodata', '') != '':
+    xml = xml + str.format("  <dimensions>\n\
+    <coverageDimension>\n\
+      <name>GRAY_INDEX</name>\n\
+      <nullValues>\n\
+        <double>{0}</double>\n\
+      </nullValues>\n\
+    </coverageDimension>\n\
+  </dimensions>\n", raster['coverage.nodata'])
+  return xml
+
+def coveragexml(covstorename, covname, covtitle, covdescription, keywords, abstract, raster={}):
   keywordxml = ''
   for k in keywords.split(","):
     keywordxml = keywordxml + str.format("    <string>{0}</string>\n", k)
@@ -126,6 +307,7 @@ def coveragexml(covstorename, covname, covtitle, covdescription, keywords, abstr
     <string>WCS</string>\n\
     {3}\n\
   </keywords>\n\
+{6}\
   <enabled>true</enabled>\n\
   <store class=\"coverageStore\">\n\
     <name>{4}</name>\n\
@@ -136,14 +318,16 @@ def coveragexml(covstorename, covname, covtitle, covdescription, keywords, abstr
   , covdescription
   , keywordxml
   , covstorename
-  , abstract)
+  , abstract
+  , coveragerasterxml(raster))
 
-def coveragelayerxml(covname, defaultstyle):
+def coveragelayerxml(covname, defaultstyle, styleworkspace=''):
   return str.format("<layer>\n\
   <name>{0}</name>\n\
   <type>RASTER</type>\n\
   <defaultStyle>\n\
     <name>{1}</name>\n\
+{2}\
   </defaultStyle>\n\
   <resource class=\"coverage\">\n\
     <name>{0}</name>\n\
@@ -151,10 +335,11 @@ def coveragelayerxml(covname, defaultstyle):
   <enabled>true</enabled>\n\
 </layer>"
   , covname
-  , defaultstyle)
+  , defaultstyle
+  , str.format("    <workspace>{0}</workspace>\n", styleworkspace) if styleworkspace != '' else '')
   
 # Set up the Add Coverage Store request
-def addcoveragestore(covstoreworkspace, covstorename, description, covstoretype, gridfile):
+def addcoveragestore(covstoreworkspace, covstorename, description, covstoretype, gridfile, update=update):
   xml = coveragestorexml(covstoreworkspace, covstorename, description, covstoretype, gridfile)
   reqtype = ''
   if update:
@@ -164,12 +349,10 @@ def addcoveragestore(covstoreworkspace, covstorename, description, covstoretype,
     reqtype = 'POST'
     apiurl = "/rest/workspaces/" + covstoreworkspace + "/coveragestores.xml"
   url = "http://" + geoserver_host + geoserver_instance + apiurl
-  result = str(makerequest(url, xml, reqtype))
-  print "Result: " + result
-  reqlog.append('coveragestore ' + covstorename + ' ' + result)
+  return sendobject('coveragestore', covstoreworkspace, covstorename, url, xml, reqtype)
 
-def addcoverage(covstoreworkspace, covstorename, covname, covtitle, covdescription, keywords, abstract):
-  xml = coveragexml(covstorename, covname, covtitle, covdescription, keywords, abstract)
+def addcoverage(covstoreworkspace, covstorename, covname, covtitle, covdescription, keywords, abstract, update=update, raster={}):
+  xml = coveragexml(covstorename, covname, covtitle, covdescription, keywords, abstract, raster)
   reqtype = ''
   if update:
     reqtype = 'PUT'
@@ -178,122 +361,869 @@ def addcoverage(covstoreworkspace, covstorename, covname, covtitle, covdescripti
     reqtype = 'POST'
     apiurl = "/rest/workspaces/" + covstoreworkspace + "/coveragestores/" + covstorename + "/coverages.xml"
   url = "http://" + geoserver_host + geoserver_instance + apiurl
-  result = str(makerequest(url, xml, reqtype))
-  print "Result: " + result
-  reqlog.append('coverage ' + covname + ' ' + result)
+  return sendobject('coverage', covstoreworkspace, covname, url, xml, reqtype
+    , ['coveragestore:' + covstoreworkspace + ':' + covstorename])
   
-def setcoveragelayeroptions(covstoreworkspace, covname, defaultstyle):
-  xml = coveragelayerxml(covname, defaultstyle)
+def setcoveragelayeroptions(covstoreworkspace, covname, defaultstyle, directory=''):
+  # a style from --styles: the (shared) style of the SLD file
+  layerstyleworkspace = ''
+  if stylename(defaultstyle, directory) is not None:
+    defaultstyle, layerstyleworkspace = stylename(defaultstyle, directory), styleworkspace
+  xml = coveragelayerxml(covname, defaultstyle, layerstyleworkspace)
   apiurl = "/rest/layers/" + covstoreworkspace + ":" + covname + ".xml"
   url = "http://" + geoserver_host + geoserver_instance + apiurl
-  result = str(makerequest(url, xml, 'PUT'))
+  return sendobject('layer', covstoreworkspace, covname, url, xml, 'PUT'
+    , ['coverage:' + covstoreworkspace + ':' + covname, stylekey(defaultstyle)])
+
+# Send the configuration of a Geoserver object, unless the manifest shows that
+# the same configuration was sent successfully before (--force: send anyway).
+# In sync mode missing objects (POST) are always created.
+# after: the objects (keys) this one depends on (--plan)
+# Returns (log entry, done): done is False when the request failed
+def sendobject(kind, workspace, name, url, xml, reqtype, after=[], contenttype=None):
+  key = kind + ':' + workspace + ':' + name
+  xmlhash = hashlib.sha1(xml).hexdigest()
+  if not force and manifest.get(key) == xmlhash and not (sync and reqtype == 'POST'):
+    print "Unchanged: " + key
+    return kind + ' ' + name + ' unchanged', True
+  if plan is not None:
+    planrequest(key, reqtype, url, xml, xmlhash, after, contenttype)
+    return kind + ' ' + name + ' planned', True
+  if journaled.get(key) == xmlhash:
+    print "Journaled: " + key
+    return kind + ' ' + name + ' done (journal)', True
+  result = makerequest(url, xml, reqtype, contenttype, objecturl(url, name) if reqtype == 'POST' else None)
+  done = isinstance(result, int) and 200 <= result < 300
+  if done:
+    manifest[key] = xmlhash
+    recordchange(key, reqtype, after)
+    journalrequest(key, reqtype, xmlhash, after, result)
+  result = str(result)
   print "Result: " + result
-  reqlog.append('layer ' + covname + ' ' + result)
+  return kind + ' ' + name + ' ' + result, done
+
+# Catalog refreshes (--reset-stores, --reload), done once at the end of the run:
+# stores whose existing configuration was updated (PUT of the store or a coverage) are
+# reset, a full reload is only done when something was changed at all.
+refreshlock = threading.Lock()
+updatedstores = set()  # store keys (coveragestore:workspace:name)
+changes = [0]          # successful requests that changed the catalog
+def recordchange(key, reqtype, after):
+  with refreshlock:
+    changes[0] += 1
+    if reqtype == 'PUT' and key.startswith('coveragestore:'):
+      updatedstores.add(key)
+    elif reqtype == 'PUT' and key.startswith('coverage:'):
+      updatedstores.update([a for a in after if a.startswith('coveragestore:')])
+
+def resetstore(key):
+  kind, workspace, name = key.split(':')
+  if 'reset:' + workspace + ':' + name in journaled:
+    return 'reset ' + name + ' done (journal)'
+  url = "http://" + geoserver_host + geoserver_instance + "/rest/workspaces/" + workspace + "/coveragestores/" + name + "/reset"
+  result = makerequest(url, '', 'POST')
+  print "Result: " + str(result)
+  if isinstance(result, int) and 200 <= result < 300:
+    journalrequest('reset:' + workspace + ':' + name, 'POST', '', [], result)
+  return 'reset ' + name + ' ' + str(result)
+
+def refreshcatalog():
+  if resetstores and len(updatedstores) > 0:
+    print "Resetting", len(updatedstores), "stores"
+    if pool is not None:
+      reqlog.extend(pool.map_async(resetstore, sorted(updatedstores)).get(sys.maxint))
+    else:
+      reqlog.extend([resetstore(k) for k in sorted(updatedstores)])
+  if reloadcatalog and changes[0] > 0 and 'reload' not in journaled:
+    print "Reloading the catalog"
+    result = makerequest("http://" + geoserver_host + geoserver_instance + "/rest/reload", '', 'POST')
+    print "Result: " + str(result)
+    if isinstance(result, int) and 200 <= result < 300:
+      journalrequest('reload', 'POST', '', [], result)
+    reqlog.append('reload ' + str(result))
+
+# Journal (publish.journal in the process dir): every completed request is appended as a
+# JSON line {"key", "method", "hash", "after", "status"} and synced to disk before the run goes
+# on. --resume reads it back: journaled requests (same key and hash) are not sent again, their
+# changes count for the manifest and the catalog refreshes of the resumed run.
+journal = None
+journallock = threading.Lock()
+journaled = {}  # key -> hash
+def loadjournal(journalfile):
+  if not os.path.exists(journalfile):
+    return
+  journal_file = open(journalfile, 'r')
+  for l in journal_file:
+    try:
+      e = json.loads(l)
+    except ValueError:
+      break  # a line cut off by the crash
+    key, method, xmlhash = e['key'].encode('utf-8'), e['method'].encode('utf-8'), e['hash'].encode('utf-8')
+    journaled[key] = xmlhash
+    if key.split(':')[0] not in ('reset', 'reload', 'import'):
+      manifest[key] = xmlhash
+    if key.split(':')[0] not in ('reset', 'reload'):
+      recordchange(key, method, [a.encode('utf-8') for a in e['after']])
+  journal_file.close()
+
+def journalrequest(key, reqtype, xmlhash, after, status):
+  if journal is None:
+    return
+  line = json.dumps(collections.OrderedDict([('key', key), ('method', reqtype), ('hash', xmlhash)
+    , ('after', after), ('status', status)]))
+  with journallock:
+    journal.write(line + "\n")
+    journal.flush()
+    os.fsync(journal.fileno())
+
+# Plan (--plan): the requests are written to a JSON lines file instead of being sent
+plan = None
+planlock = threading.Lock()
+plancount = [0]
+def planrequest(key, reqtype, url, xml, xmlhash, after, contenttype=None):
+  entry = collections.OrderedDict([('id', 0), ('key', key), ('method', reqtype)
+    , ('url', url), ('body', xml), ('hash', xmlhash), ('after', after)])
+  if contenttype is not None:
+    entry['contenttype'] = contenttype
+  with planlock:
+    plancount[0] += 1
+    entry['id'] = plancount[0]
+    plan.write(json.dumps(entry) + "\n")
+  print "Planned: " + reqtype + " " + url
+  if DEBUG:
+    print "Config XML: \n" + xml
+
+def loadplan(planfile):
+  plan_file = open(planfile, 'r')
+  entries = [json.loads(l) for l in plan_file if l.strip() != '']
+  plan_file.close()
+  # JSON strings are unicode, requests are sent as (utf-8) strings
+  for e in entries:
+    for k in ('key', 'method', 'url', 'body', 'hash'):
+      e[k] = e[k].encode('utf-8')
+    e['after'] = [a.encode('utf-8') for a in e['after']]
+    if 'contenttype' in e:
+      e['contenttype'] = e['contenttype'].encode('utf-8')
+  return entries
+
+# Execute a plan (--execute-plan): every request is sent as soon as the requests for the
+# objects it depends on succeeded (with --jobs in parallel); if one of those failed, it
+# is skipped (and so are the requests depending on it). Successful requests update the
+# manifest. Returns the log entries in plan order, per kind (stores, coverages, layers).
+def executeplan(entries):
+  keys = set([e['key'] for e in entries])
+  waiting = {}    # id -> number of requests it still waits for
+  dependents = {} # key -> [entries]
+  results = {}
+  condition = threading.Condition()
+  for e in entries:
+    after = [k for k in e['after'] if k in keys]
+    waiting[e['id']] = len(after)
+    for k in after:
+      dependents.setdefault(k, []).append(e)
+
+  def runentry(e):
+    print "Plan entry:", e['id']
+    if journaled.get(e['key']) == e['hash']:
+      return e, 'done (journal)', True
+    result = makerequest(e['url'], e['body'], e['method'], e.get('contenttype')
+      , objecturl(e['url'], e['key'].split(':')[-1]) if e['method'] == 'POST' and e['key'].split(':')[0] in ('coveragestore', 'coverage', 'style') else None)
+    print "Result: " + str(result)
+    ok = isinstance(result, int) and 200 <= result < 300
+    if ok:
+      journalrequest(e['key'], e['method'], e['hash'], e['after'], result)
+    return e, result, ok
+
+  def submit(e):
+    if pool is not None:
+      pool.apply_async(runentry, (e,), callback=done)
+    else:
+      done(runentry(e))
+
+  def done(args):
+    e, result, ok = args
+    ready = []
+    skipped = []
+    with condition:
+      if e['id'] in results:
+        return
+      results[e['id']] = e['key'].split(':')[0] + ' ' + e['key'].split(':')[-1] + ' ' + str(result)
+      if ok:
+        manifest[e['key']] = e['hash']
+        recordchange(e['key'], e['method'], e['after'])
+      for d in dependents.get(e['key'], []):
+        if not ok:
+          skipped.append(d)
+        else:
+          waiting[d['id']] -= 1
+          if waiting[d['id']] == 0:
+            ready.append(d)
+      condition.notify_all()
+    for d in skipped:
+      done((d, 'skipped, ' + e['key'] + ' failed', False))
+    for d in ready:
+      submit(d)
+
+  for e in entries:
+    if waiting[e['id']] == 0:
+      submit(e)
+  with condition:
+    while len(results) < len(entries):
+      condition.wait(1)  # a timeout keeps Ctrl-C working
+
+  order = {'style': 0, 'coveragestore': 1, 'coverage': 2, 'layer': 3}
+  return [results[e['id']] for e in sorted(entries, key=lambda e: (order.get(e['key'].split(':')[0], 3), e['id']))]
+
+# Published-state manifest: object (kind:workspace:name) = hash of the configuration
+def loadmanifest(manifestfile):
+  manifest = {}
+  if os.path.exists(manifestfile):
+    manifest_file = open(manifestfile, 'r')
+    for l in manifest_file:
+      if l.find("=") > 0:
+        manifest[l.split('=')[0]] = l.split('=')[1].strip()
+    manifest_file.close()
+  return manifest
+
+# Write the manifest through a temporary file, a crash never leaves half a manifest
+def savemanifest(manifestfile, manifest):
+  gpdlib.writefile(manifestfile, "".join([k + "=" + manifest[k] + "\n" for k in sorted(manifest)]))
   
-# Make the HTTP request (POST, PUT, DELETE, GET)
-def makerequest(url, xml, reqtype):
-  respons = -1
-  print "API URL   : ", url
+# Geoserver REST session
+# Keeps a keep-alive connection to the Geoserver host (or the http proxy) per
+# thread, so requests do not pay for a new TCP connection each time. The auth
+# header and proxy configuration are set up once for the whole run.
+class GeoserverSession:
+  def __init__(self, host, user, password, noproxy, timeout):
+    self.host = host
+    self.timeout = timeout
+    self.headers = {
+      'Authorization': 'Basic ' + base64.b64encode('%s:%s' % (user, password)),
+      'Content-Type': 'application/xml',
+      'Connection': 'keep-alive'}
+    self.proxy = None
+    if not noproxy:
+      proxy = urllib.getproxies().get('http')
+      if proxy and not urllib.proxy_bypass(host.split(':')[0]):
+        self.proxy = urlparse.urlparse(proxy).netloc
+    self.local = threading.local()
+
+  def connection(self):
+    conn = getattr(self.local, 'conn', None)
+    if conn is None:
+      conn = httplib.HTTPConnection(self.proxy or self.host, timeout=self.timeout)
+      self.local.conn = conn
+    return conn
+
+  def close(self):
+    conn = getattr(self.local, 'conn', None)
+    if conn is not None:
+      conn.close()
+      self.local.conn = None
+
+  # Returns (status, reason, body); a stale keep-alive connection (closed by
+  # the server between requests) is reopened and the request is sent again,
+  # a non-idempotent request (POST) only when it could not be sent at all.
+  def request(self, reqtype, url, body=None, contenttype=None):
+    if self.proxy is None:
+      url = urlparse.urlparse(url)
+      url = urlparse.urlunparse(('', '') + url[2:])
+    headers = self.headers
+    if contenttype is not None:
+      headers = dict(headers, **{'Content-Type': contenttype})
+    for attempt in (1, 2):
+      conn = self.connection()
+      sent = False
+      try:
+        conn.request(reqtype, url, body, headers)
+        sent = True
+        resp = conn.getresponse()
+        data = resp.read()
+        if resp.getheader('connection', '').lower() == 'close':
+          self.close()
+        return resp.status, resp.reason, data
+      except socket.timeout:
+        self.close()
+        raise
+      except (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error):
+        self.close()
+        if attempt == 2 or (sent and reqtype not in IDEMPOTENT):
+          raise
+
+# Adaptive request budget (AIMD, like TCP congestion control): the number of
+# requests in flight grows by one for every 'budget' successful requests (up to
+# --jobs) and is halved when Geoserver is overloaded: errors, timeouts or a
+# response time of more than 'slowfactor' times the fastest response seen.
+# One cut per response time, parallel failures of the same moment count once.
+class RequestBudget:
+  slowfactor = 5
+  def __init__(self, maximum):
+    self.maximum = maximum
+    self.budget = 1.0
+    self.lowest = 1.0
+    self.inflight = 0
+    self.fastest = None
+    self.lastcut = 0
+    self.condition = threading.Condition()
+
+  def acquire(self):
+    with self.condition:
+      while self.inflight >= int(self.budget):
+        self.condition.wait(1)  # a timeout keeps Ctrl-C working
+      self.inflight += 1
+
+  def release(self, ok, seconds):
+    with self.condition:
+      self.inflight -= 1
+      if ok and (self.fastest is None or seconds < self.fastest):
+        self.fastest = seconds
+      # responses of less than 50ms are never slow (noise on fast connections)
+      slow = ok and seconds > max(self.slowfactor * self.fastest, 0.05)
+      now = time.time()
+      if ok and not slow:
+        self.budget = min(self.maximum, self.budget + 1.0 / self.budget)
+      elif now - self.lastcut > seconds:
+        previous = int(self.budget)
+        self.budget = max(1.0, self.budget / 2)
+        self.lowest = min(self.lowest, self.budget)
+        self.lastcut = now
+        if int(self.budget) < previous:
+          print str.format("Geoserver overloaded, parallel requests: {0}", int(self.budget))
+      self.condition.notify_all()
+
+# Request timing: every request (also retries) is recorded per operation type
+# (coveragestore, coverage, layer, catalog) and written to the --trace file.
+def urltemplate(url):
+  t = urlparse.urlparse(url).path
+  t = re.sub('/workspaces/[^/.]+', '/workspaces/{workspace}', t)
+  t = re.sub('/coveragestores/[^/.]+', '/coveragestores/{store}', t)
+  t = re.sub('/coverages/[^/.]+', '/coverages/{coverage}', t)
+  t = re.sub('/layers/[^/.]+', '/layers/{layer}', t)
+  t = re.sub('/styles/[^/.]+', '/styles/{style}', t)
+  t = re.sub('/imports/[0-9]+', '/imports/{import}', t)
+  t = re.sub('/tasks/[0-9]+', '/tasks/{task}', t)
+  return t
+
+def operationtype(reqtype, template):
+  if template.find('/imports') >= 0:
+    return 'import'
+  if template.endswith('/reset') or template.endswith('/reload'):
+    return template.split('/')[-1]
+  if reqtype == 'GET':
+    return 'catalog'
+  # the last collection in the url: .../coveragestores/{store}/coverages.xml -> coverage
+  ops = re.findall('/(coveragestores|coverages|layers|styles)\\b', template)
+  if len(ops) == 0:
+    return 'other'
+  return ops[-1][:-1]
+
+timings = {}
+tracelock = threading.Lock()
+trace = None
+def recordrequest(reqtype, url, body, start, seconds, status, attempt):
+  template = urltemplate(url)
+  op = operationtype(reqtype, template)
+  with tracelock:
+    if op not in timings:
+      timings[op] = {'durations': [], 'first': start, 'last': start + seconds}
+    timings[op]['durations'].append(seconds)
+    timings[op]['first'] = min(timings[op]['first'], start)
+    timings[op]['last'] = max(timings[op]['last'], start + seconds)
+    if trace is not None:
+      trace.write(json.dumps({'op': op, 'method': reqtype, 'url': template, 'bytes': len(body or '')
+        , 'start': round(start, 6), 'seconds': round(seconds, 6), 'status': status, 'attempt': attempt}) + "\n")
+
+def percentile(values, p):
+  return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def printtimings():
+  print str.format("{0:<14} {1:>8} {2:>9} {3:>9} {4:>9} {5:>9} {6:>9}"
+    , 'operation', 'requests', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'req/s')
+  for op in sorted(timings):
+    durations = sorted(timings[op]['durations'])
+    elapsed = max(timings[op]['last'] - timings[op]['first'], 0.000001)
+    print str.format("{0:<14} {1:>8} {2:>9.1f} {3:>9.1f} {4:>9.1f} {5:>9.1f} {6:>9.1f}"
+      , op, len(durations), percentile(durations, 50) * 1000, percentile(durations, 95) * 1000
+      , percentile(durations, 99) * 1000, durations[-1] * 1000, len(durations) / elapsed)
+
+# Send a request within the request budget; timeouts and 502/503/504 (Geoserver or
+# the proxy overloaded) are retried after a jittered exponential backoff.
+# 500 is not retried, Geoserver uses it for errors like 'already exists'.
+# A POST may have been applied before it failed: it is only sent again when existsurl
+# (the object it creates) is not found; an object that exists counts as created.
+backoffbase = 0.5
+backoffmax = 30.0
+def sendrequest(reqtype, url, body=None, contenttype=None, existsurl=None):
+  for attempt in range(retries + 1):
+    if attempt > 0 and reqtype not in IDEMPOTENT:
+      exists = objectexists(existsurl)
+      if exists:
+        print "Exists after a failed " + reqtype + ", not sent again: " + existsurl
+        return 201, 'Created', ''
+      if exists is None:
+        break
+    budget.acquire()
+    start = time.time()
+    error = None
+    try:
+      status, reason, data = session.request(reqtype, url, body, contenttype)
+    except (httplib.HTTPException, socket.error), e:
+      error = e
+    seconds = time.time() - start
+    recordrequest(reqtype, url, body, start, seconds, str(error) if error else status, attempt + 1)
+    overloaded = error is not None or status in (502, 503, 504)
+    budget.release(not overloaded, seconds)
+    if not overloaded or attempt == retries or (reqtype not in IDEMPOTENT and existsurl is None):
+      break
+    wait = random.uniform(0, min(backoffmax, backoffbase * 2 ** attempt))
+    print str.format("Retry {0}/{1} in {2:.1f}s: {3} {4} ({5})", attempt + 1, retries, wait, reqtype, url
+      , error or status)
+    time.sleep(wait)
+  if error is not None:
+    raise error
+  return status, reason, data
+
+IDEMPOTENT = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+# Does the object at url exist (GET)? None when that can not be told (no url, errors)
+def objectexists(url):
+  if url is None:
+    return None
+  try:
+    status = sendrequest('GET', url)[0]
+  except (httplib.HTTPException, socket.error):
+    return None
+  return True if status == 200 else False if status == 404 else None
+
+# The url of the object a POST creates: .../coveragestores.xml -> .../coveragestores/<name>.xml,
+# .../styles?name=<name> -> .../styles/<name>.xml
+def objecturl(url, name):
+  url = url.split('?')[0]
+  if url.endswith('.xml'):
+    url = url[:-4]
+  return url + '/' + urllib.quote(name) + '.xml'
+
+# Make the HTTP request (POST, PUT, DELETE, GET); existsurl: see sendrequest
+# Returns the status when the request succeeded, else the error (text)
+def makerequest(url, xml, reqtype, contenttype=None, existsurl=None):
+  return statusrequest(url, xml, reqtype, contenttype, existsurl)[1]
+
+# As makerequest, returns (HTTP status or None, result)
+def statusrequest(url, xml, reqtype, contenttype=None, existsurl=None):
+  status, respons = None, -1
+  # single print per request, keeps the output readable with --jobs
   if DEBUG:
-    print "Req Type  : ", reqtype
-    print "Config XML: \n", xml
+    print "API URL   : " + url + "\nReq Type  : " + reqtype + "\nConfig XML: \n" + xml
   else:
-    base64string = base64.encodestring('%s:%s' % (geoserver_user, geoserver_password)).replace('\n', '')
-    req = urllib2.Request(url)
-    req.get_method = lambda: reqtype
-    req.add_header("Authorization", "Basic %s" % base64string)
-    req.add_header('Content-Type', 'application/xml')
-    req.add_data(xml)
+    print "API URL   : " + url
     try:
-      if noproxy:
-        uo = urllib2.build_opener(urllib2.ProxyHandler({})) 
-        urllib2.install_opener(uo)
-      resp = urllib2.urlopen(req)
-      respons = resp.code
-    except urllib2.URLError, e:
-      respons = str(e)
-  return respons
-	
-# Publish stores based on Geoserver Publish Data (.gpd)
-def publishstores2geoserver(files):
-  for f in MyFiles:
-    # Read ze file and set variables
-    print "Processing:", f
-    gpdconfig = {}
-    gpdconfig_file=open(f, 'r')
-    for l in gpdconfig_file:
-      if l.find("=") > 0:
-       gpdconfig[l.split('=')[0]] = l.split('=')[1].strip()
-    gpdconfig_file.close()
-
-    if DEBUG:
-      # Show the contents
-      for c in gpdconfig:
-        print c, ':', gpdconfig[c]
-        
-    # Add the coveragestore, should be possible using all known values
-    addcoveragestore(gpdconfig['coveragestore.workspace']
-      , gpdconfig['coveragestore.name']
-      , gpdconfig['coveragestore.description']
-      , gpdconfig['coveragestore.datatype']
-      , coveragefile_rootdir + gpdconfig['coveragestore.filename']
-      )
-
-    print "\n"
-
-# Publish coverages based on Geoserver Publish Data (.gpd)
-def publishcoverages2geoserver(files):
-  for f in MyFiles:
-    # Read ze file and set variables
+      status, reason, data = sendrequest(reqtype, url, xml, contenttype, existsurl)
+      if status >= 400:
+        respons = str.format("HTTP Error {0}: {1}", status, reason)
+      else:
+        respons = status
+    except (httplib.HTTPException, socket.error), e:
+      respons = str.format("<urlopen error {0}>", e)
+  return status, respons
+
+# Get a Geoserver REST resource (GET), returns the response body or None
+def getresource(url):
+  print "API URL   : " + url
+  if DEBUG:
+    return None
+  try:
+    status, reason, data = sendrequest('GET', url)
+  except (httplib.HTTPException, socket.error), e:
+    print str.format("WARNING: <urlopen error {0}>", e)
+    return None
+  if status != 200:
+    print str.format("WARNING: HTTP Error {0}: {1}", status, reason)
+    return None
+  return data
+
+# Get the names from a Geoserver REST list (e.g. <coverageStores><coverageStore><name>)
+def getnames(url, tag):
+  data = getresource(url)
+  if data is None:
+    return None
+  names = set()
+  for e in ElementTree.fromstring(data).findall(tag):
+    names.add(e.findtext('name'))
+  return names
+
+# Catalog of a workspace (--sync): the names of the existing coveragestores,
+# coverages and layers, fetched with three list requests per workspace.
+# None if the catalog could not be read (debug mode: an empty catalog).
+catalogs = {}
+cataloglock = threading.Lock()
+def getcatalog(workspace):
+  with cataloglock:
+    if workspace not in catalogs:
+      print "Reading catalog of workspace:", workspace
+      baseurl = "http://" + geoserver_host + geoserver_instance + "/rest"
+      catalog = {
+        'coveragestore': getnames(baseurl + "/workspaces/" + workspace + "/coveragestores.xml", 'coverageStore'),
+        'coverage': getnames(baseurl + "/workspaces/" + workspace + "/coverages.xml", 'coverage'),
+        'layer': getnames(baseurl + "/layers.xml", 'layer')}
+      if DEBUG:
+        catalog = {'coveragestore': set(), 'coverage': set(), 'layer': set()}
+      elif None in catalog.values():
+        print "WARNING: could not read the catalog of workspace " + workspace + ", datasets will be skipped"
+        catalog = None
+      else:
+        # layer names may be prefixed with the workspace
+        catalog['layer'] = set([l.split(':')[-1] for l in catalog['layer'] if l.find(':') < 0 or l.startswith(workspace + ':')])
+      catalogs[workspace] = catalog
+    return catalogs[workspace]
+
+# Read a Geoserver Publish Data (.gpd) file into a dataset record
+# (--catalog: f is (directory/dataset, record) from the catalog)
+def readgpd(f):
+  if catalog:
+    f, gpdconfig = f
     print "Processing:", f
-    gpdconfig = {}
-    gpdconfig_file=open(f, 'r')
-    for l in gpdconfig_file:
-      if l.find("=") > 0:
-       gpdconfig[l.split('=')[0]] = l.split('=')[1].strip()
-    gpdconfig_file.close()
-
-    if DEBUG:
-      # Show the contents
-      for c in gpdconfig:
-        print c, ':', gpdconfig[c]
-
-    # Add the coverage, should be possible using all known values
-    addcoverage(gpdconfig['coveragestore.workspace']
-      , gpdconfig['coverage.coveragestore.name']
-      , gpdconfig['coverage.name']
-      , gpdconfig['coverage.title']
-      , gpdconfig['coverage.description']
-      , gpdconfig['coverage.keywords']
-      , gpdconfig['coverage.abstract']
-      )
-
-    print "\n"
-
-# Publish coverages based on Geoserver Publish Data (.gpd)
-def setcoveragelayeroptions2geoserver(files):
-  for f in MyFiles:
-    # Read ze file and set variables
+  else:
     print "Processing:", f
-    gpdconfig = {}
-    gpdconfig_file=open(f, 'r')
-    for l in gpdconfig_file:
-      if l.find("=") > 0:
-       gpdconfig[l.split('=')[0]] = l.split('=')[1].strip()
-    gpdconfig_file.close()
+    gpdconfig = gpdlib.loadgpd(f)
+
+  if DEBUG:
+    # Show the contents
+    for c in gpdconfig:
+      print c, ':', gpdconfig[c]
+  # the directory of the dataset (relative to the process dir) for its layer.style (--styles)
+  gpdconfig['gpd.directory'] = os.path.relpath(os.path.dirname(f) or '.', processdirectory)
+  return gpdconfig
 
-    if DEBUG:
-      # Show the contents
-      for c in gpdconfig:
-        print c, ':', gpdconfig[c]
+# Publish one dataset: store -> coverage -> layer, each step only after the
+# previous one is done; when a step fails the later steps are skipped.
+# Returns the log entries (None for skipped steps).
+# In sync mode the catalog decides per object: create (POST) when missing,
+# update (PUT) when existing and --update is set, otherwise nothing.
+def publishdataset(gpdconfig):
+  results = [None, None, None]
+  workspace = gpdconfig['coveragestore.workspace']
+  storename = gpdconfig['coveragestore.name']
+  covname = gpdconfig['coverage.name']
+  layername = gpdconfig['layer.coverage.name']
+  covcreated = False
+  failed = None  # the step that failed: 'store' or 'coverage'
+  if sync:
+    catalog = getcatalog(workspace)
+    if catalog is None:
+      return ['coveragestore ' + storename + ' skipped (no catalog)', None, None]
 
-    # Add the coverage, should be possible using all known values
-    if len(gpdconfig['layer.style'].strip()) > 0:
-      setcoveragelayeroptions(gpdconfig['coveragestore.workspace'], gpdconfig['layer.coverage.name'], gpdconfig['layer.style'])
+  if pubstores:
+    if sync and storename in catalog['coveragestore'] and not update:
+      results[0] = 'coveragestore ' + storename + ' exists'
     else:
-      print "WARNING: no style information, skipping"
+      # Add the coveragestore, should be possible using all known values
+      results[0], done = addcoveragestore(workspace
+        , storename
+        , gpdconfig['coveragestore.description']
+        , gpdconfig['coveragestore.datatype']
+        , coveragefile_rootdir + gpdconfig['coveragestore.filename']
+        , storename in catalog['coveragestore'] if sync else update
+        )
+      if not done:
+        failed = 'store'
 
-    print "\n"
+  if pubcoverages:
+    if failed is not None:
+      results[1] = 'coverage ' + covname + ' skipped (' + failed + ' failed)'
+    elif sync and covname in catalog['coverage'] and not update:
+      results[1] = 'coverage ' + covname + ' exists'
+    else:
+      # Add the coverage, should be possible using all known values
+      covcreated = not (covname in catalog['coverage'] if sync else update)
+      results[1], done = addcoverage(workspace
+        , gpdconfig['coverage.coveragestore.name']
+        , covname
+        , gpdconfig['coverage.title']
+        , gpdconfig['coverage.description']
+        , gpdconfig['coverage.keywords']
+        , gpdconfig['coverage.abstract']
+        , not covcreated
+        , gpdconfig
+        )
+      if not done:
+        failed = 'coverage'
+
+  if setlayeroptions:
+    # Set the layer options (style)
+    if failed is not None:
+      results[2] = 'layer ' + layername + ' skipped (' + failed + ' failed)'
+    elif len(gpdconfig['layer.style'].strip()) == 0:
+      print "WARNING: no style information for " + layername + ", skipping"
+    elif sync and not covcreated and layername not in catalog['layer']:
+      results[2] = 'layer ' + layername + ' missing, skipped'
+    elif sync and not covcreated and not update:
+      results[2] = 'layer ' + layername + ' exists'
+    else:
+      results[2] = setcoveragelayeroptions(workspace, layername, gpdconfig['layer.style'], gpdconfig.get('gpd.directory', ''))[0]
+  return results
+
+# Styles (--styles): every distinct SLD (by content hash) becomes one style, files with
+# identical content share it. The manifest keeps the hash per style (style:<workspace>:<name>).
+stylenames = {}  # SLD file (path relative to the process dir, '/', without .sld) -> style name
+def stylekey(name):
+  return 'style:' + (styleworkspace or '*') + ':' + name
+
+def slddigest(content):
+  return hashlib.sha1(content.replace('\r\n', '\n').strip()).hexdigest()
+
+def findslds():
+  if recursive:
+    return [f for d, session, files in gpdlib.walktree(processdirectory, '*.sld') for f in files]
+  return sorted(glob.glob(processdirectory + '/*.sld'))
+
+# The style for a layer.style value naming an SLD file (without .sld): the SLD file in the
+# directory of the dataset or else the nearest parent directory (up to the process dir), else
+# the style of the SLD files with that name elsewhere in the tree when they share one style;
+# None when layer.style is not an SLD file of --styles
+def stylename(style, directory):
+  directory = directory.replace(os.sep, '/').strip('/')
+  if directory == '.':
+    directory = ''
+  while True:
+    key = (directory + '/' if directory != '' else '') + style
+    if key in stylenames:
+      return stylenames[key]
+    if directory == '':
+      break
+    directory = directory.rpartition('/')[0]
+  names = set([v for k, v in stylenames.items() if k.rpartition('/')[2] == style])
+  return names.pop() if len(names) == 1 else None
+
+# Decide the style per SLD file, returns ({relative path: style name}, [uploads]);
+# an upload: (style name, POST/PUT, SLD content, hash)
+# - content already published (manifest): the existing style, nothing to upload
+# - otherwise a style named after the first SLD file: created (POST), or updated (PUT) when
+#   that style exists with content no longer used by any SLD file; when its old content is still
+#   in use the hash is added to the name
+def planstyles(files):
+  groups = {}
+  for f in files:
+    sld = open(f, 'rb')
+    content = sld.read()
+    sld.close()
+    path = os.path.relpath(f, processdirectory)
+    groups.setdefault(slddigest(content), []).append((os.path.basename(path), path, content))
+  prefix = stylekey('')
+  published = dict([(k[len(prefix):], v) for k, v in manifest.items() if k.startswith(prefix)])
+  bydigest = {}
+  for name, digest in sorted(published.items()):
+    bydigest.setdefault(digest, name)
+  taken = set([bydigest[d] for d in groups if d in bydigest])
+  stylemap = {}
+  uploads = []
+  for digest in sorted(groups, key=lambda d: min(groups[d])):
+    slds = sorted(groups[digest])
+    if digest in bydigest:
+      name = bydigest[digest]
+      if force:
+        uploads.append((name, 'PUT', slds[0][2], digest))
+    else:
+      name = os.path.splitext(slds[0][0])[0]
+      if name in taken:
+        name = name + '_' + digest[:8]
+      uploads.append((name, 'PUT' if name in published else 'POST', slds[0][2], digest))
+      taken.add(name)
+    for filename, path, content in slds:
+      stylemap[path] = name
+  return stylemap, uploads
+
+# Upload one style (the SLD); a POST for a style that already exists in Geoserver
+# (not in the manifest, e.g. made by hand) is sent again as an update (PUT)
+def uploadstyle(upload):
+  name, reqtype, content, digest = upload
+  baseurl = "http://" + geoserver_host + geoserver_instance + "/rest" \
+    + ("/workspaces/" + styleworkspace if styleworkspace != '' else '') + "/styles"
+  # SLD 1.1 is Symbology Encoding
+  contenttype = 'application/vnd.ogc.se+xml' if re.search('version="1\\.1', content) else 'application/vnd.ogc.sld+xml'
+  if plan is not None:
+    url = baseurl + "?name=" + urllib.quote(name) if reqtype == 'POST' else baseurl + "/" + name
+    planrequest(stylekey(name), reqtype, url, content, digest, [], contenttype)
+    return 'style ' + name + ' planned'
+  if journaled.get(stylekey(name)) == digest:
+    return 'style ' + name + ' done (journal)'
+  if reqtype == 'POST':
+    status, result = statusrequest(baseurl + "?name=" + urllib.quote(name), content, 'POST', contenttype, objecturl(baseurl, name))
+    if status in (403, 500):
+      reqtype = 'PUT'
+  if reqtype == 'PUT':
+    result = makerequest(baseurl + "/" + name, content, 'PUT', contenttype)
+  if isinstance(result, int) and 200 <= result < 300:
+    manifest[stylekey(name)] = digest
+    recordchange(stylekey(name), reqtype, [])
+    journalrequest(stylekey(name), reqtype, digest, [], result)
+  print "Result: " + str(result)
+  return 'style ' + name + ' ' + str(result)
+
+# Upload the styles (--styles), in parallel with --jobs; writes styles.map
+def syncstyles():
+  files = findslds()
+  stylemap, uploads = planstyles(files)
+  print "Styles:", len(files), "SLD files,", len(set(stylemap.values())), "styles,", len(uploads), "to upload"
+  if pool is not None:
+    results = pool.map_async(uploadstyle, uploads).get(sys.maxint)
+  else:
+    results = [uploadstyle(u) for u in uploads]
+  reqlog.extend(results)
+  for path in stylemap:
+    stylenames[os.path.splitext(path)[0].replace(os.sep, '/')] = stylemap[path]
+  if not DEBUG:
+    gpdlib.writegpd(processdirectory + '/styles.map', stylemap)
+
+# Importer (--importer): a request to /rest/imports with a JSON body, returns the
+# (JSON) response, {} for an empty response, None on errors (or in debug mode)
+def importerrequest(reqtype, path, body=None):
+  url = "http://" + geoserver_host + geoserver_instance + "/rest/imports" + path
+  print "API URL   : " + url
+  if DEBUG:
+    if body is not None:
+      print "Req Type  : " + reqtype + "\nJSON      : \n" + json.dumps(body, indent=2)
+    return None
+  try:
+    status, reason, data = sendrequest(reqtype, url, json.dumps(body) if body is not None else None, 'application/json')
+  except (httplib.HTTPException, socket.error), e:
+    print str.format("WARNING: <urlopen error {0}>", e)
+    return None
+  if status >= 400:
+    print str.format("WARNING: HTTP Error {0}: {1} {2}", status, reason, data[:200])
+    return None
+  if data.strip() == '':
+    return {}
+  return json.loads(data)
+
+# Import the datasets of one directory (one workspace) as one import job:
+# create the job (Geoserver makes a task per raster file), adjust the tasks to the
+# .gpd data (store and layer names, title, abstract, style), remove tasks of files
+# without a dataset, run the job and poll until it is done.
+# Returns the log entries as (dataset, log entry), one per dataset.
+# Every dataset whose task completed is journaled on its own: --resume imports only the
+# datasets that failed (or were not imported yet).
+def importkey(workspace, gpdconfig):
+  return 'import:' + workspace + ':' + gpdconfig['coverage.name']
+
+def importhash(gpdconfig):
+  return hashlib.sha1(gpdconfig['coveragestore.filename'] + ':' + gpdconfig['coveragestore.name']).hexdigest()
+
+def importdirectory(workspace, directory, datasets):
+  location = coveragefile_rootdir + directory
+  log = [(gpdconfig, 'import ' + gpdconfig['coverage.name'] + ' done (journal)') for gpdconfig in datasets
+    if journaled.get(importkey(workspace, gpdconfig)) == importhash(gpdconfig)]
+  datasets = [gpdconfig for gpdconfig in datasets if journaled.get(importkey(workspace, gpdconfig)) != importhash(gpdconfig)]
+  if len(datasets) == 0:
+    return log
+  print "Import:", workspace, location, "(" + str(len(datasets)) + " datasets)"
+  job = importerrequest('POST', '', {'import': {'targetWorkspace': {'workspace': {'name': workspace}}
+    , 'data': {'type': 'directory', 'location': location}}})
+  if job is None:
+    return log + [(gpdconfig, 'import ' + gpdconfig['coverage.name'] + (' not sent (debug)' if DEBUG else ' failed')) for gpdconfig in datasets]
+  importid = str(job['import']['id'])
+  tasks = importerrequest('GET', '/' + importid + '/tasks?expand=all')
+  if tasks is None:
+    return log + [(gpdconfig, 'import ' + gpdconfig['coverage.name'] + ' failed') for gpdconfig in datasets]
+
+  byfile = dict([(os.path.basename(gpdconfig['coveragestore.filename']), gpdconfig) for gpdconfig in datasets])
+  taskdatasets = {}
+  for task in tasks['tasks']:
+    taskid = str(task['id'])
+    gpdconfig = byfile.get(os.path.basename(task.get('data', {}).get('file', '')))
+    if gpdconfig is None:
+      importerrequest('DELETE', '/' + importid + '/tasks/' + taskid)
+      continue
+    taskdatasets[taskid] = gpdconfig
+    layer = {'name': gpdconfig['coverage.name'], 'title': gpdconfig['coverage.title'], 'abstract': gpdconfig['coverage.abstract']}
+    if gpdconfig['layer.style'].strip() != '':
+      style = stylename(gpdconfig['layer.style'], gpdconfig.get('gpd.directory', ''))
+      layer['style'] = {'name': style or gpdconfig['layer.style']}
+      if style is not None and styleworkspace != '':
+        layer['style']['workspace'] = styleworkspace
+    importerrequest('PUT', '/' + importid + '/tasks/' + taskid, {'task': {'updateMode': 'CREATE'
+      , 'target': {'coverageStore': {'name': gpdconfig['coveragestore.name']}}, 'layer': layer}})
+
+  importerrequest('POST', '/' + importid + '?async=true')
+  # poll: 0.5s, growing to 5s between requests, until the job is done or --import-wait has passed
+  wait = 0.5
+  deadline = time.time() + importwait
+  timedout = False
+  while True:
+    job = importerrequest('GET', '/' + importid)
+    if job is None or job['import']['state'] not in ('PENDING', 'READY', 'RUNNING', 'INIT'):
+      break
+    if time.time() >= deadline:
+      timedout = True
+      print "WARNING: import", importid, "not done after", importwait, "seconds:", job['import']['state']
+      break
+    time.sleep(max(0, min(wait, deadline - time.time())))
+    wait = min(5.0, wait * 1.5)
+  tasks = importerrequest('GET', '/' + importid + '/tasks?expand=all')
+
+  states = dict([(str(t['id']), t) for t in (tasks or {}).get('tasks', [])])
+  for taskid, gpdconfig in sorted(taskdatasets.items(), key=lambda t: t[1]['coverage.name']):
+    task = states.get(taskid, {})
+    if task.get('state') == 'COMPLETE':
+      recordchange(importkey(workspace, gpdconfig), 'POST', [])
+      journalrequest(importkey(workspace, gpdconfig), 'POST', importhash(gpdconfig), [], 'COMPLETE')
+    log.append((gpdconfig, 'import ' + gpdconfig['coverage.name'] + ' ' + task.get('state', 'unknown')
+      + (': ' + task['errorMessage'] if 'errorMessage' in task else '')
+      + (' (timed out)' if timedout and task.get('state') != 'COMPLETE' else '')))
+  for filename, gpdconfig in sorted(byfile.items()):
+    if gpdconfig not in taskdatasets.values():
+      log.append((gpdconfig, 'import ' + gpdconfig['coverage.name'] + ' no task (file not found by Geoserver)'))
+  return log
+
+# Import all datasets (--importer), an import job per workspace and directory;
+# with --jobs the jobs run in parallel. The log is in file order (as for a serial run),
+# whichever job finishes first and whatever was journaled.
+def import2geoserver(files):
+  directories = {}
+  order = {}    # id(dataset) -> number (file order)
+  entries = []  # (number, log entry)
+  for number, gpdconfig in enumerate(readgpd(f) for f in files):
+    workspace = gpdconfig['coveragestore.workspace']
+    if sync:
+      catalog = getcatalog(workspace)
+      if catalog is None or gpdconfig['coveragestore.name'] in catalog['coveragestore']:
+        entries.append((number, 'import ' + gpdconfig['coverage.name'] + (' skipped (no catalog)' if catalog is None else ' exists')))
+        continue
+    order[id(gpdconfig)] = number
+    directory = os.path.dirname(gpdconfig['coveragestore.filename'])
+    directories.setdefault((workspace, directory), []).append(gpdconfig)
+  jobs = [(workspace, directory, datasets) for (workspace, directory), datasets in sorted(directories.items())]
+  if pool is not None:
+    results = pool.map_async(lambda j: importdirectory(*j), jobs).get(sys.maxint)
+  else:
+    results = [importdirectory(*j) for j in jobs]
+  for log in results:
+    entries.extend([(order[id(gpdconfig)], entry) for gpdconfig, entry in log])
+  reqlog.extend([entry for number, entry in sorted(entries)])
+
+# Publish all datasets in one pass over the .gpd files; every file is read once.
+# With --jobs > 1 the datasets are published in parallel (each one still
+# store -> coverage -> layer), the files are read while publishing goes on.
+# The pool lives for the whole run, so its threads keep their session connections.
+# The log is ordered as for a serial run: stores, coverages, layers, each in
+# file order.
+# files may be a generator (--recursive: datasets are streamed from the tree walk).
+def publish2geoserver(files):
+  datasets = (readgpd(f) for f in files)
+  if pool is not None:
+    # imap + next(timeout): keeps Ctrl-C working while waiting
+    it = pool.imap(publishdataset, datasets)
+    results = []
+    while True:
+      try:
+        results.append(it.next(sys.maxint))
+      except StopIteration:
+        break
+  else:
+    results = [publishdataset(d) for d in datasets]
+  for step in range(3):
+    for r in results:
+      if r[step] is not None:
+        reqlog.append(r[step])
 
 # #####################################################################
 # #####################################################################
@@ -302,22 +1232,61 @@ def setcoveragelayeroptions2geoserver(files):
 
 # Geoserverinstance
 # Read host config file (global)
-config_file = open(processdirectory + '/config.session', "r")
 hostconfig = {}
-for l in config_file:
-  if l.find("=") > 0:
-    hostconfig[l.split('=')[0]] = l.split('=')[1].strip()
-config_file.close()
+if processdirectory is not None:
+  config_file = open(processdirectory + '/config.session', "r")
+  for l in config_file:
+    if l.find("=") > 0:
+      hostconfig[l.split('=')[0]] = l.split('=')[1].strip()
+  config_file.close()
+
+# Executing a plan: the host from the plan, the user from the session config (or asked)
+if executeplanfile != "":
+  entries = loadplan(executeplanfile)
+  if len(entries) > 0:
+    hostconfig['geoserver.host'] = urlparse.urlparse(entries[0]['url']).netloc
+  if 'geoserver.user' not in hostconfig:
+    hostconfig['geoserver.user'] = raw_input("Geoserver user: ").strip()
 
 geoserver_host=hostconfig['geoserver.host']
-geoserver_instance=hostconfig['geoserver.instance']
+geoserver_instance=hostconfig.get('geoserver.instance', '')
 geoserver_user=hostconfig['geoserver.user']
 geoserver_password=raw_input(str.format("Geoserver password for {0} (empty=>debugging mode):", geoserver_user))
-coveragefile_rootdir=(hostconfig['geoserver.coveragerootdir'])
+coveragefile_rootdir=hostconfig.get('geoserver.coveragerootdir', '')
 
 if geoserver_password == "":
   DEBUG = True
 
+# trace and plan files: by default in the process directory
+if tracefile != "" and not DEBUG:
+  if tracefile.find('/') < 0 and processdirectory is not None:
+    tracefile = processdirectory + '/' + tracefile
+  trace = open(tracefile, 'w')
+if planfile != "":
+  if planfile.find('/') < 0 and processdirectory is not None:
+    planfile = processdirectory + '/' + planfile
+  plan = open(planfile, 'w')
+
+manifestfile = None
+manifest = {}
+if processdirectory is not None:
+  manifestfile = processdirectory + '/publish.manifest'
+  manifest = loadmanifest(manifestfile)
+  # the journal of this run (--resume: of the interrupted run, continued)
+  if not DEBUG and plan is None:
+    if resume:
+      loadjournal(processdirectory + '/publish.journal')
+      print "Resuming:", len(journaled), "requests done in the last run"
+    journal = open(processdirectory + '/publish.journal', 'a' if resume else 'w')
+elif resume:
+  print "ERROR: --resume needs --process-dir (the journal is kept there)"
+  exit(1)
+session = GeoserverSession(geoserver_host, geoserver_user, geoserver_password, noproxy, timeout)
+budget = RequestBudget(jobs)
+pool = None
+if jobs > 1:
+  pool = ThreadPool(jobs)
+
 # Print global settings
 print "Debugging mode:       ", DEBUG
 print "Process directory:    ", processdirectory
@@ -329,27 +1298,75 @@ if DEBUG:
   print "Geoserver password:   ", geoserver_password
 
 
-# Get all files to process
-MyFiles = glob.glob(processdirectory + "/" + filefilter + ".gpd")
-if DEBUG:
+# Datasets from the catalogs of the directories: (directory/dataset, record)
+def catalogsources(directories):
+  for d in directories:
+    datasets = gpdlib.getdatasets(gpdlib.opencatalog(d), filefilter)
+    print "Catalog:", gpdlib.catalogpath(d), "(" + str(len(datasets)) + " datasets)"
+    for dataset, record in datasets:
+      yield (d + "/" + dataset, record)
+
+# Get all files (or catalog datasets) to process
+# recursive: a generator, the tree is walked while publishing
+if executeplanfile != "":
+  MyFiles = []
+elif recursive:
+  if catalog:
+    MyFiles = catalogsources(d for d, session, files in gpdlib.walktree(processdirectory, gpdlib.CATALOGFILE))
+  else:
+    MyFiles = (f for d, session, files in gpdlib.walktree(processdirectory, filefilter + ".gpd") for f in files)
+elif catalog:
+  MyFiles = list(catalogsources([processdirectory]))
+else:
+  MyFiles = glob.glob(processdirectory + "/" + filefilter + ".gpd")
+if DEBUG and not recursive:
   print "DEBUG: Files to process: "
   for f in MyFiles:
-    print "  ", f
-
-if pubstores:
-  print "Publishing stores"
-  publishstores2geoserver(MyFiles)
+    print "  ", f[0] if catalog else f
 
-if pubcoverages:
-  print "Publishing coverages"
-  publishcoverages2geoserver(MyFiles)
+if executeplanfile != "" or styles or importer or pubstores or pubcoverages or setlayeroptions:
+  try:
+    if styles and executeplanfile == "":
+      print "Publishing styles"
+      syncstyles()
+    if executeplanfile != "":
+      print "Executing plan:", executeplanfile, "(" + str(len(entries)) + " requests)"
+      reqlog.extend(executeplan(entries))
+    elif importer:
+      print "Importing datasets"
+      import2geoserver(MyFiles)
+    elif pubstores or pubcoverages or setlayeroptions:
+      print "Publishing datasets"
+      publish2geoserver(MyFiles)
+    if plan is None:
+      refreshcatalog()
+  finally:
+    if pool is not None:
+      pool.terminate()
+      pool.join()
+    if not DEBUG and manifestfile is not None:
+      savemanifest(manifestfile, manifest)
+    if trace is not None:
+      trace.close()
+    if plan is not None:
+      plan.close()
+    if journal is not None:
+      journal.close()
 
-if setlayeroptions:
-  print "Setting layer options"
-  setcoveragelayeroptions2geoserver(MyFiles)
+if jobs > 1 and not DEBUG:
+  print str.format("Parallel requests: {0} at the end, lowest {1} (maximum {2})", int(budget.budget), int(budget.lowest), jobs)
 
 print "Log:"
 for e in reqlog:
   print e
 
+if len(timings) > 0:
+  print "\nRequest timing:"
+  printtimings()
+  if trace is not None:
+    print "Trace file:", tracefile
+
+if plan is not None:
+  print "\nPlan file:", planfile, "(" + str(plancount[0]) + " requests)"
+
 print "\nDone."
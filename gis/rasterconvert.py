@@ -0,0 +1,306 @@
+# Raster conversions before publishing, used by generate-geoserverpublishdata.py
+# One file per call, so the conversions can run in a process pool:
+# - optimizegeotiff: GeoTIFF -> cloud optimized GeoTIFF <name>.cog.tif (tiled, compressed,
+#   internal overviews), with the GDAL command line tools (gdal_translate, gdaladdo)
+# - arcgrid2geotiff: ArcGrid (.asc/.txt) -> tiled binary GeoTIFF <name>.grid.tif (Float32, Deflate,
+#   internal overviews, nodata and georeferencing of the grid), with NumPy; the text is parsed in
+#   blocks, so memory use depends on the width of the grid, not on its size
+# The converted file is written next to the source (via a temporary file) and reused as
+# long as it is newer than the source.
+
+import os
+import re
+import zlib
+import struct
+import subprocess
+import rasterheader
+import gpdlib
+
+try:
+  import numpy
+except ImportError:
+  numpy = None  # no ArcGrid conversion
+
+COGSUFFIX = '.cog.tif'
+GRIDSUFFIX = '.grid.tif'
+BLOCKSIZE = 512
+COMPRESSION = 'DEFLATE'
+# ArcGrid conversion: text parsed per read, zlib level of the tiles (level 1 is 3-4 times as
+# fast as the default level 6, for float grids the tiles are a few percent larger)
+PARSEBYTES = 4 * 1024 * 1024
+ZLEVEL = 1
+
+# The converted file of a source file: <name>.cog.tif (GeoTIFF), <name>.grid.tif (ArcGrid)
+def convertedfile(path):
+  if os.path.splitext(path.lower())[1] in ('.asc', '.txt'):
+    return os.path.splitext(path)[0] + GRIDSUFFIX
+  return os.path.splitext(path)[0] + COGSUFFIX
+
+def isconvertedfile(path):
+  return path.lower().endswith(COGSUFFIX) or path.lower().endswith(GRIDSUFFIX)
+
+# A converted file newer than the source is reused
+def uptodate(path):
+  output = convertedfile(path)
+  return os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(path)
+
+def run(command):
+  try:
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  except OSError, e:
+    return -1, command[0] + ": " + str(e)
+  output = p.communicate()[0]
+  return p.returncode, output.strip()
+
+# GDAL version as (major, minor), None when the GDAL tools are not installed
+def gdalversion():
+  code, output = run(['gdal_translate', '--version'])
+  m = re.search('GDAL ([0-9]+)\.([0-9]+)', output)
+  if code != 0 or m is None:
+    return None
+  return int(m.group(1)), int(m.group(2))
+
+# Overview levels (2, 4, 8, ...) until the smallest overview fits in a block
+def overviewfactors(width, height):
+  factors, f = [], 2
+  while max(width, height) > BLOCKSIZE * f / 2:
+    factors.append(f)
+    f = f * 2
+  return factors
+
+# Convert a GeoTIFF to a cloud optimized GeoTIFF; args: (path, GDAL version)
+# GDAL 3.1+ has a COG driver, older versions: a tiled GeoTIFF plus gdaladdo (internal overviews).
+# Overviews use nearest neighbour resampling (keeps class values and nodata intact).
+# Returns (path, optimized file or None, message)
+def optimizegeotiff(args):
+  path, version = args
+  output = convertedfile(path)
+  if uptodate(path):
+    return path, output, 'up to date'
+  header = rasterheader.readheader(path)
+  if header is None:
+    return path, None, 'can not read the header'
+  tmpfile = output + '.tmp'
+  if version >= (3, 1):
+    commands = [['gdal_translate', '-q', '-of', 'COG', '-co', 'COMPRESS=' + COMPRESSION
+      , '-co', 'BLOCKSIZE=' + str(BLOCKSIZE), '-co', 'OVERVIEWS=AUTO', '-co', 'RESAMPLING=NEAREST'
+      , path, tmpfile]]
+  else:
+    commands = [['gdal_translate', '-q', '-of', 'GTiff', '-co', 'TILED=YES', '-co', 'COMPRESS=' + COMPRESSION
+      , '-co', 'BLOCKXSIZE=' + str(BLOCKSIZE), '-co', 'BLOCKYSIZE=' + str(BLOCKSIZE), path, tmpfile]]
+    factors = overviewfactors(header['width'], header['height'])
+    if len(factors) > 0:
+      commands.append(['gdaladdo', '-q', '-r', 'nearest', '--config', 'COMPRESS_OVERVIEW', COMPRESSION, tmpfile]
+        + [str(f) for f in factors])
+  for command in commands:
+    code, message = run(command)
+    if code != 0:
+      if os.path.exists(tmpfile):
+        os.remove(tmpfile)
+      return path, None, message or command[0] + ' failed'
+  gpdlib.replacefile(tmpfile, output)
+  converted = rasterheader.readheader(output)
+  if converted is None:
+    return path, output, 'converted (header not readable)'
+  issues = rasterheader.cogissues(converted)
+  return path, output, 'converted' + (' (still ' + ', '.join(issues) + ')' if len(issues) > 0 else '')
+
+#########################################################
+# ArcGrid -> tiled GeoTIFF (NumPy)
+# The values of an ArcGrid in blocks of (at most) n rows: float32 arrays (rows x width).
+# The text after the header is read PARSEBYTES at a time, cut after the last separator
+# (a number is never split) and parsed at once (numpy.fromstring); values left over from
+# a read wait for the next one.
+def arcgridrows(path, width, n):
+  f = open(path, 'rb')
+  try:
+    # header lines start with a keyword (ncols, xllcorner, NODATA_value, ...)
+    start = 0
+    line = f.readline()
+    while line != '' and re.match('^\s*[A-Za-z_]', line):
+      start = f.tell()
+      line = f.readline()
+    f.seek(start)
+    blocksize = width * n
+    pending, pendingsize, rest = [], 0, ''
+    while True:
+      text = f.read(PARSEBYTES)
+      if text != '':
+        text = rest + text
+        cut = max(text.rfind(' '), text.rfind('\n'), text.rfind('\t')) + 1
+        text, rest = text[:cut], text[cut:]
+      else:
+        text, rest = rest, ''
+      values = numpy.fromstring(text, dtype=numpy.float32, sep=' ')
+      if len(values) > 0:
+        pending.append(values)
+        pendingsize += len(values)
+      while pendingsize >= blocksize or (text == '' and pendingsize > 0):
+        values = numpy.concatenate(pending) if len(pending) > 1 else pending[0]
+        size = min(blocksize, pendingsize) // width * width
+        if size == 0:
+          raise rasterheader.RasterHeaderError("incomplete last row")
+        yield values[:size].reshape(size // width, width)
+        pending = [values[size:].copy()] if len(values) > size else []
+        pendingsize = len(values) - size
+      if text == '':
+        break
+  finally:
+    f.close()
+
+# TIFF field types
+SHORT, LONG, DOUBLE, ASCII, LONG8 = 3, 4, 12, 2, 16
+FIELDFORMATS = {SHORT: 'H', LONG: 'I', DOUBLE: 'd', LONG8: 'Q'}
+
+# An image file directory at offset: [(tag, field type, values)] -> bytes (values that do not
+# fit in an entry follow the directory); nextoffset: offset of the next directory (0: last)
+def ifdbytes(entries, offset, nextoffset, bigtiff):
+  entryformat, countformat, inline = ('<HHQ', '<Q', 8) if bigtiff else ('<HHI', '<H', 4)
+  pointer = countformat.replace('H', 'I')
+  valueoffset = offset + struct.calcsize(countformat) + len(entries) * (struct.calcsize(entryformat) + inline) \
+    + struct.calcsize(pointer)
+  directory, values = struct.pack(countformat, len(entries)), ''
+  for tag, fieldtype, v in sorted(entries):
+    if fieldtype == ASCII:
+      data = v + '\0'
+    else:
+      data = struct.pack('<%d%s' % (len(v), FIELDFORMATS[fieldtype]), *v)
+    count = len(data) // struct.calcsize(FIELDFORMATS.get(fieldtype, 'c'))
+    if len(data) <= inline:
+      directory += struct.pack(entryformat, tag, fieldtype, count) + data.ljust(inline, '\0')
+    else:
+      directory += struct.pack(entryformat, tag, fieldtype, count) + struct.pack(pointer, valueoffset + len(values))
+      values += data + '\0' * (len(data) % 2)
+  return directory + struct.pack(pointer, nextoffset) + values
+
+# Tiles of one image (full resolution or an overview), written while the rows come in
+class TiledImage(object):
+  def __init__(self, width, height, factor, fill):
+    self.width, self.height, self.factor, self.fill = width, height, factor, fill
+    self.tilesacross = (width + BLOCKSIZE - 1) // BLOCKSIZE
+    self.rows, self.rowcount = [], 0
+    self.offsets, self.bytecounts = [], []
+
+  # rows of the full resolution grid, starting at row start; an overview takes every factor'th
+  # row and column (nearest neighbour: class values and nodata stay intact), as a copy: a view
+  # would keep all the full resolution rows in memory until a row of overview tiles is complete
+  def add(self, f, rows, start):
+    if self.factor > 1:
+      rows = rows[(-start) % self.factor::self.factor, ::self.factor].copy()
+    if len(rows) > 0:
+      self.rows.append(rows)
+      self.rowcount += len(rows)
+    while self.rowcount >= BLOCKSIZE:
+      self.writetiles(f)
+
+  def finish(self, f):
+    while self.rowcount > 0:
+      self.writetiles(f)
+
+  # one row of tiles; the tiles at the right and bottom edge are padded with nodata
+  def writetiles(self, f):
+    rows = numpy.concatenate(self.rows) if len(self.rows) > 1 else self.rows[0]
+    band = numpy.empty((BLOCKSIZE, self.tilesacross * BLOCKSIZE), dtype='<f4')
+    band.fill(self.fill)
+    n = min(BLOCKSIZE, len(rows))
+    band[:n, :self.width] = rows[:n]
+    for i in range(self.tilesacross):
+      data = zlib.compress(band[:, i * BLOCKSIZE:(i + 1) * BLOCKSIZE].tobytes(), ZLEVEL)
+      self.offsets.append(f.tell())
+      self.bytecounts.append(len(data))
+      f.write(data)
+    self.rows = [rows[n:]] if len(rows) > n else []
+    self.rowcount -= n
+
+  def tags(self, bigtiff):
+    return [(rasterheader.TAG_SUBFILETYPE, LONG, (0 if self.factor == 1 else 1,)),
+      (rasterheader.TAG_WIDTH, LONG, (self.width,)), (rasterheader.TAG_HEIGHT, LONG, (self.height,)),
+      (rasterheader.TAG_BITSPERSAMPLE, SHORT, (32,)), (rasterheader.TAG_COMPRESSION, SHORT, (8,)),
+      (262, SHORT, (1,)), (rasterheader.TAG_SAMPLESPERPIXEL, SHORT, (1,)), (284, SHORT, (1,)),
+      (rasterheader.TAG_TILEWIDTH, SHORT, (BLOCKSIZE,)), (rasterheader.TAG_TILELENGTH, SHORT, (BLOCKSIZE,)),
+      (324, LONG8 if bigtiff else LONG, tuple(self.offsets)), (325, LONG, tuple(self.bytecounts)),
+      (rasterheader.TAG_SAMPLEFORMAT, SHORT, (3,))]
+
+# GeoTIFF tags: pixel scale, tiepoint (upper left corner), GeoKeys (EPSG code from the header,
+# projected or geographic by the .prj file), nodata
+def geotags(path, header):
+  minx, miny, maxx, maxy = header['bbox']
+  tags = [(rasterheader.TAG_PIXELSCALE, DOUBLE, ((maxx - minx) / header['width'], (maxy - miny) / header['height'], 0.0)),
+    (rasterheader.TAG_TIEPOINT, DOUBLE, (0.0, 0.0, 0.0, minx, maxy, 0.0))]
+  keys = [(rasterheader.GEOKEY_RASTERTYPE, 1)]  # PixelIsArea
+  if 'srs' in header:
+    code = int(header['srs'].split(':')[1])
+    wkt = open(os.path.splitext(path)[0] + '.prj').read().lstrip().upper()
+    if wkt.startswith('GEOGCS'):
+      keys += [(1024, 2), (rasterheader.GEOKEY_GEOGRAPHICTYPE, code)]
+    else:
+      keys += [(1024, 1), (rasterheader.GEOKEY_PROJECTEDTYPE, code)]
+  directory = [1, 1, 0, len(keys)]
+  for key, value in sorted(keys):
+    directory += [key, 0, 1, value]
+  tags.append((rasterheader.TAG_GEOKEYS, SHORT, tuple(directory)))
+  if 'nodata' in header:
+    tags.append((rasterheader.TAG_GDALNODATA, ASCII, header['nodata']))
+  return tags
+
+# Convert an ArcGrid to a tiled GeoTIFF (Float32, BLOCKSIZE tiles, Deflate, internal overviews)
+# The rows are read BLOCKSIZE at a time, the tiles (and overview tiles) written as soon as a row
+# of tiles is complete; the image directories follow the tiles at the end of the file.
+# Returns (path, converted file or None, message)
+def arcgrid2geotiff(path):
+  output = convertedfile(path)
+  if uptodate(path):
+    return path, output, 'up to date'
+  if numpy is None:
+    return path, None, 'NumPy not installed'
+  header = rasterheader.readheader(path)
+  if header is None or header['format'] != 'ArcGrid':
+    return path, None, 'can not read the ArcGrid header'
+  width, height = header['width'], header['height']
+  fill = float(header.get('nodata', 0))
+  images = [TiledImage(width, height, 1, fill)] + [TiledImage((width + f - 1) // f, (height + f - 1) // f, f, fill)
+    for f in overviewfactors(width, height)]
+  # BigTIFF when the (uncompressed) tiles might not fit in 4GB
+  bigtiff = sum([i.tilesacross * ((i.height + BLOCKSIZE - 1) // BLOCKSIZE) for i in images]) * BLOCKSIZE * BLOCKSIZE * 4 > 0xffff0000
+  tmpfile = output + '.tmp'
+  f = open(tmpfile, 'wb')
+  try:
+    f.write(struct.pack('<2sHHHQ', 'II', 43, 8, 0, 0) if bigtiff else struct.pack('<2sHI', 'II', 42, 0))
+    start = 0
+    for rows in arcgridrows(path, width, BLOCKSIZE):
+      if start + len(rows) > height:
+        raise rasterheader.RasterHeaderError("more values than ncols x nrows")
+      for image in images:
+        image.add(f, rows, start)
+      start += len(rows)
+    if start < height:
+      raise rasterheader.RasterHeaderError(str.format("{0} of {1} rows (invalid value?)", start, height))
+    for image in images:
+      image.finish(f)
+    # image directories: the full resolution image (with the GeoTIFF tags) first, then the overviews
+    f.seek(0, 2)
+    offset = f.tell() + f.tell() % 2
+    f.write('\0' * (f.tell() % 2))
+    f.seek(8 if bigtiff else 4)
+    f.write(struct.pack('<Q' if bigtiff else '<I', offset))
+    f.seek(offset)
+    for n, image in enumerate(images):
+      tags = image.tags(bigtiff) + (geotags(path, header) if n == 0 else [])
+      size = (len(ifdbytes(tags, offset, 0, bigtiff)) + 1) & ~1
+      nextoffset = offset + size if n < len(images) - 1 else 0
+      f.write(ifdbytes(tags, offset, nextoffset, bigtiff).ljust(size, '\0'))
+      offset = nextoffset
+  except (rasterheader.RasterHeaderError, IOError, ValueError), e:
+    f.close()
+    os.remove(tmpfile)
+    return path, None, str(e)
+  f.close()
+  gpdlib.replacefile(tmpfile, output)
+  return path, output, str.format("converted ({0}x{1}, {2} overviews, {3:.1f} MB)", width, height
+    , len(images) - 1, os.path.getsize(output) / 1048576.0)
+
+# Convert a raster by its type (one process pool for all conversions); args: (path, GDAL version)
+def convert(args):
+  if os.path.splitext(args[0].lower())[1] in ('.asc', '.txt'):
+    return arcgrid2geotiff(args[0])
+  return optimizegeotiff(args)
@@ -0,0 +1,264 @@
+# Raster header reader (GeoTIFF, ArcGrid), used by generate-geoserverpublishdata.py
+# Reads only the header of a raster file (memory-mapped, no pixel data), returns
+# the information Geoserver needs for a coverage:
+#   width, height, bbox (minx, miny, maxx, maxy), srs (EPSG:xxxx), datatype, nodata
+# plus the GeoTIFF layout (tiles/strips, compression, overviews).
+# No GDAL needed.
+
+import os
+import re
+import mmap
+import struct
+
+# GeoTIFF tags
+TAG_WIDTH = 256
+TAG_HEIGHT = 257
+TAG_BITSPERSAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_STRIPOFFSETS = 273
+TAG_SAMPLESPERPIXEL = 277
+TAG_STRIPBYTECOUNTS = 279
+TAG_TILEWIDTH = 322
+TAG_TILELENGTH = 323
+TAG_TILEOFFSETS = 324
+TAG_TILEBYTECOUNTS = 325
+TAG_SUBFILETYPE = 254
+TAG_SAMPLEFORMAT = 339
+TAG_PIXELSCALE = 33550
+TAG_TIEPOINT = 33922
+TAG_TRANSFORMATION = 34264
+TAG_GEOKEYS = 34735
+TAG_GDALNODATA = 42113
+
+# GeoKeys
+GEOKEY_RASTERTYPE = 1025
+GEOKEY_GEOGRAPHICTYPE = 2048
+GEOKEY_PROJECTEDTYPE = 3072
+
+COMPRESSION = {1: 'None', 5: 'LZW', 7: 'JPEG', 8: 'Deflate', 32773: 'PackBits', 32946: 'Deflate', 34887: 'LERC', 50000: 'ZSTD', 50001: 'WebP'}
+
+# TIFF field types: (struct format, size)
+FIELDTYPES = {1: ('B', 1), 2: ('c', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 6: ('b', 1), 7: ('B', 1),
+  8: ('h', 2), 9: ('i', 4), 10: ('ii', 8), 11: ('f', 4), 12: ('d', 8), 16: ('Q', 8), 17: ('q', 8), 18: ('Q', 8)}
+
+# Tags with an entry per strip/tile (large arrays): only their count is read
+COUNTTAGS = (TAG_STRIPOFFSETS, TAG_STRIPBYTECOUNTS, TAG_TILEOFFSETS, TAG_TILEBYTECOUNTS)
+
+class RasterHeaderError(Exception):
+  pass
+
+# Open a file memory-mapped (read only); pages are only read when accessed
+def mapfile(path):
+  f = open(path, 'rb')
+  try:
+    if os.fstat(f.fileno()).st_size == 0:
+      raise RasterHeaderError("empty file: " + path)
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  finally:
+    f.close()
+
+#########################################################
+# GeoTIFF
+# One IFD entry: (tag, values); (count,) for COUNTTAGS, None for unknown field types
+def readtag(m, bo, bigtiff, entry):
+  if bigtiff:
+    tag, fieldtype, count = struct.unpack_from(bo + 'HHQ', m, entry)
+    valueoffset, inlinesize = entry + 12, 8
+  else:
+    tag, fieldtype, count = struct.unpack_from(bo + 'HHI', m, entry)
+    valueoffset, inlinesize = entry + 8, 4
+  if fieldtype not in FIELDTYPES:
+    return tag, None
+  if tag in COUNTTAGS:
+    return tag, (count,)
+  fmt, size = FIELDTYPES[fieldtype]
+  if size * count > inlinesize:
+    valueoffset = struct.unpack_from(bo + ('Q' if bigtiff else 'I'), m, valueoffset)[0]
+  if fieldtype == 2:
+    return tag, m[valueoffset:valueoffset + count].rstrip('\0')
+  values = struct.unpack_from(bo + '%d%s' % (count * len(fmt), fmt[0]), m, valueoffset)
+  if fieldtype in (5, 10):
+    values = tuple([float(values[i]) / values[i + 1] for i in range(0, len(values), 2)])
+  return tag, values
+
+# All image file directories (IFDs) of a (Big)TIFF: [{tag: values}]
+def readifds(m):
+  if m[0:2] == 'II':
+    bo = '<'
+  elif m[0:2] == 'MM':
+    bo = '>'
+  else:
+    raise RasterHeaderError("not a TIFF file")
+  version = struct.unpack_from(bo + 'H', m, 2)[0]
+  if version == 42:
+    bigtiff = False
+    offset = struct.unpack_from(bo + 'I', m, 4)[0]
+  elif version == 43:
+    bigtiff = True
+    offset = struct.unpack_from(bo + 'Q', m, 8)[0]
+  else:
+    raise RasterHeaderError("not a TIFF file")
+  ifds = []
+  while offset != 0 and len(ifds) < 100:
+    if bigtiff:
+      n = struct.unpack_from(bo + 'Q', m, offset)[0]
+      entries, entrysize = offset + 8, 20
+    else:
+      n = struct.unpack_from(bo + 'H', m, offset)[0]
+      entries, entrysize = offset + 2, 12
+    ifd = {}
+    for i in range(n):
+      tag, values = readtag(m, bo, bigtiff, entries + i * entrysize)
+      ifd[tag] = values
+    ifds.append(ifd)
+    offset = struct.unpack_from(bo + ('Q' if bigtiff else 'I'), m, entries + n * entrysize)[0]
+  return ifds
+
+def tiffdatatype(ifd):
+  bits = ifd.get(TAG_BITSPERSAMPLE, (1,))[0]
+  sampleformat = ifd.get(TAG_SAMPLEFORMAT, (1,))[0]
+  if sampleformat == 3:
+    return 'Float' + str(bits)
+  if bits == 8 and sampleformat == 1:
+    return 'Byte'
+  return ('Int' if sampleformat == 2 else 'UInt') + str(bits)
+
+def geokeys(ifd):
+  keys = {}
+  directory = ifd.get(TAG_GEOKEYS)
+  if directory:
+    for i in range(4, 4 + directory[3] * 4, 4):
+      keyid, location, count, value = directory[i:i + 4]
+      if location == 0:
+        keys[keyid] = value
+  return keys
+
+def readgeotiff(path):
+  m = mapfile(path)
+  try:
+    ifds = readifds(m)
+  except struct.error:
+    raise RasterHeaderError("truncated TIFF file: " + path)
+  finally:
+    m.close()
+  ifd = ifds[0]
+  header = {
+    'format': 'GeoTIFF',
+    'width': ifd[TAG_WIDTH][0],
+    'height': ifd[TAG_HEIGHT][0],
+    'bands': ifd.get(TAG_SAMPLESPERPIXEL, (1,))[0],
+    'datatype': tiffdatatype(ifd),
+    'compression': COMPRESSION.get(ifd.get(TAG_COMPRESSION, (1,))[0], str(ifd.get(TAG_COMPRESSION, (1,))[0])),
+    'tiled': TAG_TILEWIDTH in ifd,
+    # reduced resolution images (SubfileType bit 0) are (internal) overviews
+    'overviews': len([i for i in ifds[1:] if i.get(TAG_SUBFILETYPE, (0,))[0] & 1]),
+  }
+  if header['tiled']:
+    header['blocksize'] = (ifd[TAG_TILEWIDTH][0], ifd[TAG_TILELENGTH][0])
+  if TAG_GDALNODATA in ifd:
+    header['nodata'] = ifd[TAG_GDALNODATA].strip()
+
+  keys = geokeys(ifd)
+  if GEOKEY_PROJECTEDTYPE in keys and keys[GEOKEY_PROJECTEDTYPE] != 32767:
+    header['srs'] = 'EPSG:' + str(keys[GEOKEY_PROJECTEDTYPE])
+  elif GEOKEY_GEOGRAPHICTYPE in keys and keys[GEOKEY_GEOGRAPHICTYPE] != 32767:
+    header['srs'] = 'EPSG:' + str(keys[GEOKEY_GEOGRAPHICTYPE])
+
+  # georeferencing: tiepoint + pixel scale, or a transformation matrix (no rotation)
+  if TAG_TIEPOINT in ifd and TAG_PIXELSCALE in ifd:
+    i, j, k, x, y, z = ifd[TAG_TIEPOINT][:6]
+    sx, sy = ifd[TAG_PIXELSCALE][:2]
+    minx, maxy = x - i * sx, y + j * sy
+  elif TAG_TRANSFORMATION in ifd:
+    t = ifd[TAG_TRANSFORMATION]
+    sx, sy, minx, maxy = t[0], -t[5], t[3], t[7]
+  else:
+    return header
+  if keys.get(GEOKEY_RASTERTYPE) == 2:
+    # PixelIsPoint: the tiepoint is the center of the pixel
+    minx, maxy = minx - sx / 2, maxy + sy / 2
+  header['bbox'] = (minx, maxy - header['height'] * sy, minx + header['width'] * sx, maxy)
+  return header
+
+#########################################################
+# ArcGrid (ESRI ASCII grid)
+def readarcgrid(path):
+  m = mapfile(path)
+  try:
+    # the header is at most 6 short lines
+    lines = m[0:1024].splitlines()[:7]
+  finally:
+    m.close()
+  values = {}
+  for l in lines:
+    parts = l.split()
+    if len(parts) != 2 or not re.match('^[A-Za-z_]+$', parts[0]):
+      break
+    values[parts[0].lower()] = parts[1]
+  try:
+    width, height = int(values['ncols']), int(values['nrows'])
+    sx = sy = float(values.get('cellsize', values.get('dx', 0)))
+    sy = float(values.get('dy', sy))
+    if 'xllcenter' in values:
+      minx, miny = float(values['xllcenter']) - sx / 2, float(values['yllcenter']) - sy / 2
+    else:
+      minx, miny = float(values['xllcorner']), float(values['yllcorner'])
+  except (KeyError, ValueError):
+    raise RasterHeaderError("no ArcGrid header: " + path)
+  header = {
+    'format': 'ArcGrid',
+    'width': width,
+    'height': height,
+    'bands': 1,
+    'bbox': (minx, miny, minx + width * sx, miny + height * sy),
+  }
+  if 'nodata_value' in values:
+    header['nodata'] = values['nodata_value']
+  # projection from an .prj sidecar file (only when it names an EPSG code)
+  prj = os.path.splitext(path)[0] + '.prj'
+  if os.path.exists(prj):
+    codes = re.findall('AUTHORITY\["EPSG",\s*"?(\d+)"?\]', open(prj).read())
+    if len(codes) > 0:
+      header['srs'] = 'EPSG:' + codes[-1]
+  return header
+
+# Read the header of a raster file (by extension); None when it cannot be read
+def readheader(path):
+  ext = os.path.splitext(path.lower())[1]
+  try:
+    if ext in ('.tif', '.tiff'):
+      return readgeotiff(path)
+    elif ext in ('.asc', '.txt'):
+      return readarcgrid(path)
+  except (RasterHeaderError, IOError, OSError, KeyError, IndexError, ValueError):
+    pass
+  return None
+
+# What keeps a GeoTIFF from being cloud optimized (Geoserver reads only the tiles and the
+# overview level a request needs): [] when tiled, compressed and, when larger than
+# OVERVIEWSIZE pixels, with internal overviews
+OVERVIEWSIZE = 1024
+def cogissues(header):
+  issues = []
+  if not header.get('tiled'):
+    issues.append('stripped')
+  if header.get('compression', 'None') == 'None':
+    issues.append('uncompressed')
+  if header.get('overviews', 0) == 0 and max(header['width'], header['height']) > OVERVIEWSIZE:
+    issues.append('no overviews')
+  return issues
+
+# Header values as .gpd values (coverage.srs, coverage.bbox, ...)
+def gpdvalues(header):
+  if header is None:
+    return {}
+  values = {
+    'coverage.grid': str(header['width']) + ',' + str(header['height']),
+    'coverage.datatype': header.get('datatype', ''),
+    'coverage.nodata': header.get('nodata', ''),
+    'coverage.srs': header.get('srs', ''),
+    'coverage.bbox': '',
+  }
+  if 'bbox' in header:
+    values['coverage.bbox'] = ','.join([repr(v) for v in header['bbox']])
+  return values
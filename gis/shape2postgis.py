@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+# Load shapefiles into PostGIS (the vector flow of compute-shape.sh)
+# - Scans a directory (tree) for shapefiles
+# - For each shapefile, in one transaction:
+#     (re)creates the table (<schema>.<name>) and streams the features into it with COPY
+#     creates a spatial index, the view (<view schema>.vw_<name>) and grants read access
+# - Loads run in parallel (--jobs), sharing a pool of database connections (one per job)
+#
+# The features are read with shapeheader.py (no ogr2ogr/psql processes needed). The geometry
+# column is typed (geometry(<type>, <srid>)), so PostGIS registers it in geometry_columns itself
+# (no populate_geometry_columns() needed).
+
+import sys
+import os
+import re
+import time
+import struct
+import binascii
+import fnmatch
+import threading
+from multiprocessing.pool import ThreadPool
+import shapeheader
+try:
+  import psycopg2
+  import psycopg2.pool
+except ImportError:
+  psycopg2 = None
+
+# help tekst
+if len(sys.argv) == 1:
+  print """Usage: shape2postgis.py <options>
+Loads shapefiles into PostGIS: table, spatial index, view and grant per shapefile.
+
+Options (any order):
+--process-dir=[dir]           directory to process (default: current directory)
+--file-filter=[pattern]       default: * (.shp will always be appended)
+--recursive                   process all subdirectories of the process dir too
+--db-host=[host]              database host (default: localhost)
+--db-port=[port]              database port (default: 5432)
+--db-name=[name]              database name (default: dank_test)
+--db-user=[user]              database user (default: dank)
+--table=[name]                table name (one shapefile only; default: from the file name, see remark 1)
+--schema=[schema]             schema for the tables (default: dank)
+--view-schema=[schema]        schema for the views vw_<name> (default: dank_pub, empty: no views)
+--grant=[role]                role that gets read access to the views (default: dank_pub_ro, empty: none)
+--srs=[EPSG:n]                srs of the data (default: from the .prj file, else EPSG:28992)
+--jobs=[n]                    number of shapefiles loaded in parallel (default: 1)
+--debug                       if set: debugging mode, no database connection, the SQL statements and
+                              the first rows of every COPY are shown
+
+Remarks:
+1) The table name is the shapefile name without the last date part (_20141113) in lowercase, as
+   compute-shape.sh derives the layer name (which passes its name with --table). Table and column
+   names are laundered (lowercase, other characters than a-z, 0-9 and _ become _), also --table.
+   Existing tables (and their views) are replaced.
+2) The password is taken from PGPASSWORD, else it is asked. Providing an empty password
+   automatically enters debugging mode.
+3) Polylines and polygons are loaded as MultiLineString/MultiPolygon, points as Point/MultiPoint
+   (2D, Z and M values are dropped); Null shapefiles get a plain geometry column, MultiPatch
+   shapefiles are not loaded. A shapefile that fails to load leaves nothing behind
+   (the transaction is rolled back), the other shapefiles are loaded.
+"""
+  exit(0)
+
+#########################################################
+# Initialization (vars, commandline)
+processdirectory="."
+filefilter="*"
+recursive=False
+dbhost="localhost"
+dbport=5432
+dbname="dank_test"
+dbuser="dank"
+singletable=""
+schema="dank"
+viewschema="dank_pub"
+grantrole="dank_pub_ro"
+srs=""
+jobs=1
+DEBUG=False
+
+for arg in sys.argv:
+  # get commandline options (and optionally values)
+  an = arg.split('=')[0]
+  if len(arg.split('=')) > 1:
+    av = arg.split('=')[1]
+  else:
+    av = ""
+
+  # process commandline options
+  if an == '--process-dir':
+    processdirectory=av.rstrip('/') or "."
+  if an == '--file-filter':
+    filefilter=av
+  if an == '--recursive':
+    recursive=True
+  if an == '--db-host':
+    dbhost=av
+  if an == '--db-port':
+    dbport=int(av)
+  if an == '--db-name':
+    dbname=av
+  if an == '--db-user':
+    dbuser=av
+  if an == '--table':
+    singletable=av
+  if an == '--schema':
+    schema=av
+  if an == '--view-schema':
+    viewschema=av
+  if an == '--grant':
+    grantrole=av
+  if an == '--srs':
+    srs=av
+  if an == '--jobs':
+    jobs=max(1, int(av))
+  if an == '--debug':
+    DEBUG=True
+
+# ##########################
+# Functions
+def quoteident(name):
+  return '"' + name.replace('"', '""') + '"'
+
+# Lowercase, other characters than a-z, 0-9 and _ replaced by _ (as ogr2ogr launders names)
+def launder(name):
+  return re.sub('[^a-z0-9_]', '_', name.lower())
+
+# Table name: --table, else the shapefile name without the last _<digits> part (the rule of
+# compute-shape.sh: LAYER_NAME), laundered
+def tablename(path):
+  if singletable != "":
+    return launder(singletable)
+  return launder(re.sub('^(.*)_[0-9]+', r'\1', os.path.splitext(os.path.basename(path))[0], 1))
+
+def columnname(name):
+  return launder(name)
+
+# PostgreSQL column type for a dBASE field
+def columntype(fieldtype, length, decimals):
+  if fieldtype == 'N' and decimals == 0:
+    return 'integer' if length < 10 else 'bigint' if length < 19 else str.format('numeric({0},0)', length)
+  if fieldtype == 'N':
+    return str.format('numeric({0},{1})', length, decimals)
+  if fieldtype == 'F':
+    return 'double precision'
+  if fieldtype == 'L':
+    return 'boolean'
+  if fieldtype == 'D':
+    return 'date'
+  return str.format('varchar({0})', length)
+
+# PostGIS geometry type for a shapefile geometry type (shapeheader.readfeatures); None for
+# the types that can not be loaded (MultiPatch)
+def geometrytype(geometry):
+  if geometry == 'Null':
+    return 'Geometry'  # no shapes at all: a plain geometry column (all values null)
+  base = re.sub('[ZM]$', '', geometry)
+  if base in ('LineString', 'Polygon'):
+    return 'Multi' + base
+  if base in ('Point', 'MultiPoint'):
+    return base
+  return None
+
+#########################################################
+# Geometries as hex EWKB (COPY accepts it as text for geometry columns)
+WKBTYPES = {'Point': 1, 'LineString': 2, 'Polygon': 3, 'MultiPoint': 4, 'MultiLineString': 5, 'MultiPolygon': 6}
+
+def wkbcoordinates(coordinates):
+  return struct.pack('<I%dd' % (2 * len(coordinates)), len(coordinates), *[v for c in coordinates for v in c])
+
+def wkb(geometrytype, coordinates):
+  if geometrytype == 'Point':
+    return struct.pack('<BI2d', 1, 1, *coordinates)
+  if geometrytype == 'MultiPoint':
+    return struct.pack('<BII', 1, 4, len(coordinates)) + ''.join([wkb('Point', c) for c in coordinates])
+  if geometrytype == 'MultiLineString':
+    return struct.pack('<BII', 1, 5, len(coordinates)) + ''.join([struct.pack('<BI', 1, 2) + wkbcoordinates(l) for l in coordinates])
+  if geometrytype == 'MultiPolygon':
+    return struct.pack('<BII', 1, 6, len(coordinates)) + ''.join([struct.pack('<BII', 1, 3, len(p))
+      + ''.join([wkbcoordinates(r) for r in p]) for p in coordinates])
+
+def ewkb(geometry, srid):
+  geometrytype, coordinates = geometry
+  data = wkb(geometrytype, coordinates)
+  # byte order + type with the SRID flag + srid, then the WKB without its header
+  return binascii.hexlify(struct.pack('<BII', 1, WKBTYPES[geometrytype] | 0x20000000, srid) + data[5:])
+
+#########################################################
+# COPY (text format)
+def copyvalue(value, fieldtype):
+  if value is None:
+    return '\\N'
+  if value is True or value is False:
+    return 't' if value else 'f'
+  if fieldtype == 'D':
+    if not re.match('^[0-9]{8}$', value):
+      return '\\N'
+    return value[0:4] + '-' + value[4:6] + '-' + value[6:8]
+  if fieldtype in 'NF':
+    try:
+      float(value)
+    except ValueError:
+      return '\\N'
+    return value
+  if isinstance(value, unicode):
+    value = value.encode('utf-8')
+  return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def copyrows(path, fields, srid):
+  fieldtypes = [f[1] for f in fields]
+  for geometry, values in shapeheader.readfeatures(path):
+    row = [copyvalue(values[i], fieldtypes[i]) for i in range(len(values))]
+    row.append('\\N' if geometry is None else ewkb(geometry, srid))
+    yield '\t'.join(row) + '\n'
+
+# File-like object over the COPY rows (psycopg2 copy_expert reads it in blocks), the rows
+# are generated while the data is sent
+class CopyStream(object):
+  def __init__(self, rows):
+    self.rows = rows
+    self.buffer = ''
+    self.count = 0
+
+  def read(self, size=-1):
+    while size < 0 or len(self.buffer) < size:
+      try:
+        self.buffer += next(self.rows)
+        self.count += 1
+      except StopIteration:
+        break
+    if size < 0:
+      size = len(self.buffer)
+    data, self.buffer = self.buffer[:size], self.buffer[size:]
+    return data
+
+#########################################################
+# Datasets
+# Everything needed to load a shapefile: {path, table, srid, shapetype, geometrytype, columns, fields}
+def dataset(path):
+  header = shapeheader.readheader(path)
+  if header is None:
+    return None
+  fields = header.get('fields', [])
+  datasetsrs = srs or header.get('srs', '') or 'EPSG:28992'
+  return {
+    'path': path,
+    'table': tablename(path),
+    'srid': int(datasetsrs.split(':')[-1]),
+    'shapetype': header['geometry'],
+    'geometrytype': geometrytype(header['geometry']),
+    'columns': [columnname(f[0]) for f in fields],
+    'fields': fields,
+  }
+
+def createstatements(ds):
+  table = quoteident(schema) + '.' + quoteident(ds['table'])
+  columns = ['ogc_fid serial primary key']
+  columns.extend([quoteident(c) + ' ' + columntype(f[1], f[2], f[3]) for c, f in zip(ds['columns'], ds['fields'])])
+  columns.append(str.format('geom geometry({0}, {1})', ds['geometrytype'], ds['srid']))
+  statements = []
+  if viewschema != '':
+    statements.append('drop view if exists ' + viewname(ds))
+  statements.append('drop table if exists ' + table)
+  statements.append('create table ' + table + ' (' + ', '.join(columns) + ')')
+  return statements
+
+def copystatement(ds):
+  return str.format('copy {0}.{1} ({2}) from stdin', quoteident(schema), quoteident(ds['table'])
+    , ', '.join([quoteident(c) for c in ds['columns']] + ['geom']))
+
+def viewname(ds):
+  return quoteident(viewschema) + '.' + quoteident('vw_' + ds['table'])
+
+def finishstatements(ds):
+  table = quoteident(schema) + '.' + quoteident(ds['table'])
+  statements = ['create index ' + quoteident(ds['table'] + '_geom_idx') + ' on ' + table + ' using gist (geom)']
+  if viewschema != '':
+    statements.append('create view ' + viewname(ds) + ' as select * from ' + table)
+    if grantrole != '':
+      statements.append('grant select on table ' + viewname(ds) + ' to ' + quoteident(grantrole))
+  statements.append('analyze ' + table)
+  return statements
+
+# Load one shapefile, in one transaction; returns (path, table, rows, seconds, error)
+def loaddataset(path):
+  start = time.time()
+  ds = dataset(path)
+  if ds is None:
+    return path, '', 0, 0, "can not read shapefile"
+  if ds['geometrytype'] is None:
+    return path, ds['table'], 0, 0, "unsupported geometry type " + ds['shapetype']
+  if DEBUG:
+    lines = [statement + ';' for statement in createstatements(ds)]
+    lines.append(copystatement(ds) + ';')
+    count = 0
+    try:
+      for row in copyrows(path, ds['fields'], ds['srid']):
+        if count < 3:
+          lines.append(row.rstrip('\n'))
+        count += 1
+    except (shapeheader.ShapeHeaderError, struct.error), e:
+      return path, ds['table'], 0, time.time() - start, str(e).strip()
+    lines.append('\\.')
+    lines.extend([statement + ';' for statement in finishstatements(ds)])
+    debuglock.acquire()
+    print "-- " + path + "\n" + "\n".join(lines)
+    debuglock.release()
+    return path, ds['table'], count, time.time() - start, None
+  stream = CopyStream(copyrows(path, ds['fields'], ds['srid']))
+  connection = connections.getconn()
+  try:
+    cursor = connection.cursor()
+    for statement in createstatements(ds):
+      cursor.execute(statement)
+    cursor.copy_expert(copystatement(ds), stream)
+    for statement in finishstatements(ds):
+      cursor.execute(statement)
+    connection.commit()
+    return path, ds['table'], stream.count, time.time() - start, None
+  except (psycopg2.Error, shapeheader.ShapeHeaderError, struct.error), e:
+    connection.rollback()
+    return path, ds['table'], 0, time.time() - start, str(e).strip()
+  finally:
+    connections.putconn(connection)
+
+def findshapefiles():
+  if not recursive:
+    return sorted([os.path.join(processdirectory, f) for f in os.listdir(processdirectory)
+      if fnmatch.fnmatch(f.lower(), (filefilter + '.shp').lower())])
+  return [f for f in shapeheader.findshapefiles([processdirectory])
+    if fnmatch.fnmatch(os.path.basename(f).lower(), (filefilter + '.shp').lower())]
+
+# #####################################################################
+# Ze script (MAIN)
+if not DEBUG:
+  password = os.environ.get('PGPASSWORD')
+  if password is None:
+    password = raw_input(str.format("Database password for {0} (empty=>debugging mode):", dbuser))
+  if password == "":
+    DEBUG=True
+if not DEBUG and psycopg2 is None:
+  print "ERROR: psycopg2 is not installed (needed to connect to PostGIS, --debug works without it)"
+  exit(1)
+
+files = findshapefiles()
+if singletable != "" and len(files) != 1:
+  print "ERROR: --table needs exactly one shapefile,", len(files), "found"
+  exit(1)
+print "Shapefiles:          ", len(files)
+print "Database:            ", str.format("{0}@{1}:{2}/{3}", dbuser, dbhost, dbport, dbname)
+print "Tables / views:      ", schema, "/", viewschema or "-"
+print "Parallel loads:      ", jobs
+if DEBUG:
+  print "DEBUGGING MODE (no database connection)"
+print
+
+debuglock = threading.Lock()
+if not DEBUG:
+  connections = psycopg2.pool.ThreadedConnectionPool(1, jobs, host=dbhost, port=dbport, dbname=dbname
+    , user=dbuser, password=password)
+pool = ThreadPool(jobs)
+start = time.time()
+loaded, failed, rows = 0, 0, 0
+try:
+  for path, table, count, seconds, error in pool.imap_unordered(loaddataset, files):
+    if error is None:
+      loaded += 1
+      rows += count
+      print str.format("{0} -> {1}.{2}: {3} features ({4:.2f}s)", path, schema, table, count, seconds)
+    else:
+      failed += 1
+      print str.format("ERROR: {0} -> {1}.{2}: {3}", path, schema, table, error)
+finally:
+  pool.close()
+  pool.join()
+  if not DEBUG:
+    connections.closeall()
+
+seconds = time.time() - start
+print
+print str.format("Loaded {0} shapefiles ({1} features) in {2:.2f}s, {3} failed", loaded, rows, seconds, failed)
+exit(1 if failed > 0 else 0)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+# Shapefile header reader (.shp/.shx/.dbf/.prj), used by compute-shape.sh and the vector tools
+# Reads only the headers (memory-mapped, no features), returns:
+#   geometry type, feature count, bbox (minx, miny, maxx, maxy), srs (EPSG:xxxx),
+#   attribute schema [(name, type, length, decimals)] and encoding
+# readfeatures streams the features (geometry, attribute values) for loaders (shape2postgis.py).
+# No GDAL/ogrinfo needed.
+#
+# Commandline: shapeheader.py [--geometry] file.shp|directory ...
+#   prints a line per shapefile (directories: all shapefiles in the tree),
+#   --geometry: only the geometry type (e.g. for compute-shape.sh)
+
+import sys
+import os
+import re
+import mmap
+import struct
+import fnmatch
+
+# Shape types (ESRI Shapefile Technical Description)
+SHAPETYPES = {0: 'Null', 1: 'Point', 3: 'LineString', 5: 'Polygon', 8: 'MultiPoint',
+  11: 'PointZ', 13: 'LineStringZ', 15: 'PolygonZ', 18: 'MultiPointZ',
+  21: 'PointM', 23: 'LineStringM', 25: 'PolygonM', 28: 'MultiPointM', 31: 'MultiPatch'}
+
+# dBASE language driver ids -> Python codecs (used when there is no .cpg file)
+LANGUAGEDRIVERS = {0x01: 'cp437', 0x02: 'cp850', 0x03: 'cp1252', 0x57: 'cp1252', 0x58: 'cp1252', 0x59: 'cp1252'}
+
+class ShapeHeaderError(Exception):
+  pass
+
+# Open a file memory-mapped (read only); pages are only read when accessed
+def mapfile(path):
+  f = open(path, 'rb')
+  try:
+    if os.fstat(f.fileno()).st_size == 0:
+      raise ShapeHeaderError("empty file: " + path)
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  finally:
+    f.close()
+
+# A sidecar file (.shx, .dbf, ...) in any case (shapefiles from Windows: .SHX, .DBF)
+def sidecar(path, ext):
+  base = os.path.splitext(path)[0]
+  for e in (ext, ext.upper()):
+    if os.path.exists(base + e):
+      return base + e
+  return None
+
+#########################################################
+# .shp / .shx
+def readshp(path):
+  m = mapfile(path)
+  try:
+    if len(m) < 100:
+      raise ShapeHeaderError("truncated shapefile: " + path)
+    filecode = struct.unpack_from('>i', m, 0)[0]
+    if filecode != 9994:
+      raise ShapeHeaderError("not a shapefile: " + path)
+    shapetype = struct.unpack_from('<i', m, 32)[0]
+    bbox = struct.unpack_from('<4d', m, 36)
+    header = {
+      'shapetype': shapetype,
+      'geometry': SHAPETYPES.get(shapetype, 'Unknown'),
+      'bbox': bbox,
+    }
+  finally:
+    m.close()
+  shx = sidecar(path, '.shx')
+  if shx is not None:
+    # the index has a fixed size record (8 bytes) per feature
+    header['features'] = (os.path.getsize(shx) - 100) // 8
+  return header
+
+# Number of features without an index: walk the record headers (record number, content length in 16-bit words)
+def countrecords(path):
+  m = mapfile(path)
+  try:
+    features, offset = 0, 100
+    while offset + 8 <= len(m):
+      offset += 8 + struct.unpack_from('>i', m, offset + 4)[0] * 2
+      features += 1
+  finally:
+    m.close()
+  return features
+
+#########################################################
+# .dbf (dBASE III)
+# Returns (record count, [(name, type, length, decimals)], encoding)
+def readdbf(path):
+  m = mapfile(path)
+  try:
+    if len(m) < 32:
+      raise ShapeHeaderError("truncated dbf file: " + path)
+    records, headerlength = struct.unpack_from('<IH', m, 4)
+    languagedriver = ord(m[29])
+    fields = []
+    offset = 32
+    while offset + 32 <= headerlength and m[offset] != '\r':
+      name, fieldtype, length, decimals = struct.unpack_from('<11sc4xBB', m, offset)
+      fields.append((name.split('\0')[0], fieldtype, length, decimals))
+      offset += 32
+  finally:
+    m.close()
+  encoding = LANGUAGEDRIVERS.get(languagedriver)
+  cpg = sidecar(path, '.cpg')
+  if cpg is not None:
+    encoding = open(cpg).read().strip() or encoding
+  return records, fields, encoding
+
+# EPSG code from a .prj (WKT) file, when it names one
+def readprj(path):
+  prj = sidecar(path, '.prj')
+  if prj is None:
+    return None
+  wkt = open(prj).read()
+  codes = re.findall('AUTHORITY\["EPSG",\s*"?(\d+)"?\]', wkt)
+  if len(codes) > 0:
+    return 'EPSG:' + codes[-1]
+  # Dutch RD New without authority: the ESRI WKT names the projection first,
+  #   PROJCS["RD_New",GEOGCS["GCS_Amersfoort",...],PROJECTION["Double_Stereographic"],...
+  # other writers "Amersfoort / RD New" or only the Amersfoort datum and the stereographic projection
+  if re.search(r'RD[ _]New|Amersfoort.*Stereographic', wkt, re.I | re.S):
+    return 'EPSG:28992'
+  return None
+
+# Read the headers of a shapefile; None when it cannot be read
+def readheader(path):
+  try:
+    header = readshp(path)
+    dbf = sidecar(path, '.dbf')
+    if dbf is not None:
+      records, fields, encoding = readdbf(dbf)
+      header['fields'] = fields
+      header['encoding'] = encoding
+      header.setdefault('features', records)
+    if 'features' not in header:
+      header['features'] = countrecords(path)
+    srs = readprj(path)
+    if srs is not None:
+      header['srs'] = srs
+    return header
+  except (ShapeHeaderError, IOError, OSError, struct.error, ValueError):
+    return None
+
+#########################################################
+# Features
+# Geometries are (type, coordinates), 2D (Z/M values are dropped):
+#   ('Point', (x, y)), ('MultiPoint', [(x, y), ...]), ('MultiLineString', [[(x, y), ...], ...]),
+#   ('MultiPolygon', [[ring, hole, ...], ...]); None for null shapes
+# Polylines and polygons are always multi geometries (a shapefile does not tell them apart).
+def points(m, offset, n):
+  values = struct.unpack_from('<%dd' % (2 * n), m, offset)
+  return zip(values[0::2], values[1::2])
+
+def parts(m, offset):
+  numparts, numpoints = struct.unpack_from('<ii', m, offset + 32)
+  if numparts < 0 or numpoints < 0 or offset + 40 + 4 * numparts + 16 * numpoints > len(m):
+    raise ShapeHeaderError("corrupt shape record")
+  starts = struct.unpack_from('<%di' % numparts, m, offset + 40) + (numpoints,)
+  coordinates = points(m, offset + 40 + 4 * numparts, numpoints)
+  return [coordinates[starts[i]:starts[i + 1]] for i in range(numparts)]
+
+# Signed area of a ring: negative for clockwise rings (outer rings in a shapefile)
+def ringarea(ring):
+  return sum([ring[i][0] * ring[i + 1][1] - ring[i + 1][0] * ring[i][1] for i in range(len(ring) - 1)]) / 2
+
+def readgeometry(m, offset):
+  shapetype = struct.unpack_from('<i', m, offset)[0]
+  if shapetype == 0:
+    return None
+  if shapetype in (1, 11, 21):
+    return ('Point', struct.unpack_from('<2d', m, offset + 4))
+  if shapetype in (8, 18, 28):
+    numpoints = struct.unpack_from('<i', m, offset + 36)[0]
+    if numpoints < 0 or offset + 40 + 16 * numpoints > len(m):
+      raise ShapeHeaderError("corrupt shape record")
+    return ('MultiPoint', points(m, offset + 40, numpoints))
+  if shapetype in (3, 13, 23):
+    return ('MultiLineString', parts(m, offset + 4))
+  if shapetype in (5, 15, 25):
+    # an outer ring (clockwise) starts a polygon, the holes that follow belong to it
+    polygons = []
+    for ring in parts(m, offset + 4):
+      if ringarea(ring) <= 0 or len(polygons) == 0:
+        polygons.append([ring])
+      else:
+        polygons[-1].append(ring)
+    return ('MultiPolygon', polygons)
+  raise ShapeHeaderError("unsupported shape type: " + SHAPETYPES.get(shapetype, str(shapetype)))
+
+def dbfvalue(value, fieldtype, encoding):
+  value = value.strip()
+  if value == '' or (fieldtype in 'NFD' and value.strip('*?') == ''):
+    return None
+  if fieldtype == 'C':
+    return value.decode(encoding or 'latin-1', 'replace')
+  if fieldtype == 'L':
+    return True if value in 'TtYy' else False if value in 'FfNn' else None
+  return value
+
+# Stream the features of a shapefile: (geometry, [attribute values]); the values are unicode
+# (character fields), True/False (logical) or strings as stored (numbers, dates as YYYYMMDD).
+# Deleted records are skipped.
+def readfeatures(path):
+  shp = mapfile(path)
+  dbffile = sidecar(path, '.dbf')
+  try:
+    if dbffile is None:
+      offset = 100
+      while offset + 8 <= len(shp):
+        length = struct.unpack_from('>i', shp, offset + 4)[0] * 2
+        yield readgeometry(shp, offset + 8), []
+        offset += 8 + length
+      return
+    records, fields, encoding = readdbf(dbffile)
+    dbf = mapfile(dbffile)
+    try:
+      headerlength, recordlength = struct.unpack_from('<HH', dbf, 8)
+      offset, dbfoffset = 100, headerlength
+      for i in range(records):
+        if offset + 8 > len(shp):
+          break
+        length = struct.unpack_from('>i', shp, offset + 4)[0] * 2
+        record = dbf[dbfoffset:dbfoffset + recordlength]
+        if record[0] != '*':
+          values, start = [], 1
+          for name, fieldtype, size, decimals in fields:
+            values.append(dbfvalue(record[start:start + size], fieldtype, encoding))
+            start += size
+          yield readgeometry(shp, offset + 8), values
+        offset += 8 + length
+        dbfoffset += recordlength
+    finally:
+      dbf.close()
+  finally:
+    shp.close()
+
+# Shapefiles: the files themselves, directories are walked (sorted)
+def findshapefiles(paths):
+  for p in paths:
+    if os.path.isdir(p):
+      for directory, dirs, files in os.walk(p):
+        dirs.sort()
+        for f in sorted(files):
+          if fnmatch.fnmatch(f.lower(), '*.shp'):
+            yield os.path.join(directory, f)
+    else:
+      yield p
+
+# #####################################################################
+# Ze script (commandline)
+if __name__ == '__main__':
+  if len(sys.argv) == 1:
+    print "Usage: shapeheader.py [--geometry] file.shp|directory ..."
+    exit(0)
+  geometryonly = '--geometry' in sys.argv
+  status = 0
+  for f in findshapefiles([a for a in sys.argv[1:] if not a.startswith('--')]):
+    header = readheader(f)
+    if header is None:
+      print >> sys.stderr, "ERROR: could not read shapefile:", f
+      status = 1
+    elif geometryonly:
+      print header['geometry']
+    else:
+      print str.format("{0}  {1}  {2} features  bbox {3}  {4}  {5} fields", f, header['geometry'], header['features']
+        , ','.join([repr(v) for v in header['bbox']]), header.get('srs', '-'), len(header.get('fields', [])))
+  exit(status)